@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the jip* commands.
+
+Each scenario runs a command in a fresh interpreter against the local fake Jira
+server (jipdate.fakejira), for several sizes of the synthetic project. The wall
+time, the peak memory (max RSS) and the number of HTTP requests per endpoint
+are recorded and compared to the budgets stored in budgets.json. The run fails
+when a scenario needs more requests than its budget (e.g. a new N+1 request
+pattern) or is slower / bigger than its budget by more than the tolerance.
+
+Use --update to store the current results as the new budgets.
+"""
+
+from argparse import ArgumentParser
+
+import collections
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from jipdate import fakejira
+
+BUDGETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "budgets.json")
+
+# Wall time differences below this (in seconds) are considered noise.
+WALL_SLACK = 0.25
+
+# Synthetic project sizes: initiatives per project (each with 5 epics of 5
+# stories) and number of issues in the jipcreate file.
+SIZES = {
+    "small": {"initiatives": 2, "create": 20},
+    "medium": {"initiatives": 10, "create": 100},
+    "large": {"initiatives": 40, "create": 500},
+}
+
+CONFIG = """version: 1
+server:
+  url: %s
+  token: benchmark
+username: %s
+text-editor: False
+comments:
+  - "# No updates since last week."
+"""
+
+
+################################################################################
+# Input files
+################################################################################
+def get_user(store):
+    """Returns the email of the user with the most assigned issues, the
+    commands run as this user."""
+    counts = collections.Counter(
+        i["fields"]["assignee"]["emailAddress"]
+        for i in store.issues.values()
+        if i["fields"]["assignee"]
+    )
+    return counts.most_common(1)[0][0]
+
+
+def write_status_file(store, filename, user):
+    """Writes a jipdate status file updating all issues assigned to user."""
+    rnd = random.Random(0)
+    with open(filename, "w") as f:
+        for issue in store.issues.values():
+            assignee = issue["fields"]["assignee"]
+            if not assignee or assignee["emailAddress"] != user:
+                continue
+            f.write("[%s]\n" % issue["key"])
+            f.write("Worked on %s.\n" % issue["fields"]["summary"])
+            if issue["fields"]["status"]["name"] in ["To Do", "In Progress"]:
+                if rnd.random() < 0.5:
+                    f.write("Status: Resolved / Done\n")
+            f.write("\n")
+
+
+def write_issue_file(store, filename, count):
+    """Writes a jipcreate file with count stories in existing epics."""
+    import yaml
+
+    rnd = random.Random(0)
+    epics = [
+        i for i in store.issues.values() if i["fields"]["issuetype"]["name"] == "Epic"
+    ]
+    sprints = [s["name"] for s in store.sprints[1]]
+    issues = []
+    for n in range(count):
+        issues.append(
+            {
+                "Project": "SWG",
+                "IssueType": "Story",
+                "Summary": "Benchmark story %d" % n,
+                "Description": "Created by the benchmark suite",
+                "AssigneeEmail": rnd.choice(store.users)["emailAddress"],
+                "EpicLink": rnd.choice(epics)["key"],
+                "ClientStakeholder": rnd.choice(fakejira.SPONSORS),
+                "OriginalEstimate": "%dd" % rnd.randint(1, 5),
+                "Components": rnd.choice(fakejira.COMPONENTS),
+                "Sprint": rnd.choice(sprints),
+                "Share Visibility": [rnd.choice(store.users)["emailAddress"]],
+            }
+        )
+    with open(filename, "w") as f:
+        yaml.safe_dump(issues, f)
+
+
+################################################################################
+# Scenarios
+################################################################################
+def get_scenarios(store, workdir, size, user):
+    """Returns the (name, module, arguments) of all scenarios."""
+    status_file = os.path.join(workdir, "status.txt")
+    write_status_file(store, status_file, user)
+    issue_file = os.path.join(workdir, "issues.yml")
+    write_issue_file(store, issue_file, SIZES[size]["create"])
+
+    return [
+        ("jipdate-query", "jipdate.jipdate", ["-q", "-l", "-p", "--all"]),
+        ("jipdate-parse", "jipdate.jipdate", ["-f", status_file, "--dry-run", "-s"]),
+        ("jipstatus", "jipdate.jipstatus", ["-p", "SWG", "--days", "30", "--html"]),
+        ("jipsearch", "jipdate.jipsearch", ["--jql", "project = SWG"]),
+        ("jipfp", "jipdate.jipfp", ["-p", "SWG", "--all"]),
+        ("jipcreate", "jipdate.jipcreate", ["-f", issue_file]),
+    ]
+
+
+# Runs a command module and stores its peak RSS in the file named by argv[1].
+# VmHWM is used rather than ru_maxrss, which also accounts the memory of the
+# benchmark process the command was forked from.
+RUNNER = """
+import atexit, resource, runpy, sys
+
+def report(filename=sys.argv[1]):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    rss = int(line.split()[1])
+    except OSError:
+        pass
+    with open(filename, "w") as f:
+        f.write(str(rss))
+
+atexit.register(report)
+module = sys.argv[2]
+sys.argv = [module] + sys.argv[3:]
+runpy.run_module(module, run_name="__main__", alter_sys=True)
+"""
+
+
+def run_command(module, args, env, workdir):
+    """Runs a command and returns its wall time (s), peak RSS (MB) and exit
+    status."""
+    rss_file = os.path.join(workdir, "rss.txt")
+    start = time.perf_counter()
+    with open(os.path.join(workdir, "output.txt"), "w") as out:
+        p = subprocess.run(
+            [sys.executable, "-c", RUNNER, rss_file, module] + args,
+            stdin=subprocess.DEVNULL,
+            stdout=out,
+            stderr=subprocess.STDOUT,
+            cwd=workdir,
+            env=env,
+        )
+    wall = time.perf_counter() - start
+    with open(rss_file) as f:
+        rss = int(f.read()) / 1024.0
+    return wall, rss, p.returncode
+
+
+def run_size(size, scenarios, runs):
+    """Runs all scenarios on a project of the given size and returns the
+    results keyed by scenario name."""
+    store = fakejira.generate(initiatives=SIZES[size]["initiatives"])
+    server = fakejira.start_server(store)
+    workdir = tempfile.mkdtemp(prefix="jipdate-bench-")
+    user = get_user(store)
+    results = {}
+    try:
+        with open(os.path.join(workdir, ".jipdate.yml"), "w") as f:
+            f.write(CONFIG % (server.url, user))
+        env = dict(os.environ)
+        env["HOME"] = workdir
+        env["XDG_CACHE_HOME"] = os.path.join(workdir, "cache")
+        env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+        env.pop("JIRA_USERNAME", None)
+        env.pop("JIRA_PASSWORD", None)
+
+        for name, module, args in get_scenarios(store, workdir, size, user):
+            if scenarios and name not in scenarios:
+                continue
+            best = None
+            for _ in range(runs):
+                # Commands writing to Jira must see the same data each run.
+                snapshot = json.dumps(store.issues)
+                server.reset_stats()
+                wall, rss, returncode = run_command(module, args, env, workdir)
+                requests = dict(
+                    ("%s %s" % k, v) for k, v in sorted(server.stats.items())
+                )
+                store.issues.clear()
+                store.issues.update((k, v) for k, v in json.loads(snapshot).items())
+                store.query_cache.clear()
+                if returncode != 0:
+                    with open(os.path.join(workdir, "output.txt")) as f:
+                        print(f.read()[-2000:])
+                    raise RuntimeError("%s failed (%d)" % (name, returncode))
+                if best is None or wall < best["wall"]:
+                    best = {"wall": wall, "max_rss_mb": rss, "requests": requests}
+            best["issues"] = len(store.issues)
+            results[name] = best
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+################################################################################
+# Budgets
+################################################################################
+def load_budgets():
+    if not os.path.isfile(BUDGETS_FILE):
+        return {}
+    with open(BUDGETS_FILE) as f:
+        return json.load(f)
+
+
+def store_budgets(budgets):
+    with open(BUDGETS_FILE, "w") as f:
+        json.dump(budgets, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def check(result, budget, checks, tolerance):
+    """Returns the list of budget violations of a scenario."""
+    errors = []
+    if budget is None:
+        return ["no budget, run with --update"]
+
+    if "requests" in checks:
+        for endpoint, count in sorted(result["requests"].items()):
+            allowed = budget["requests"].get(endpoint, 0)
+            if count > allowed:
+                errors.append(
+                    "%s: %d requests (budget %d)" % (endpoint, count, allowed)
+                )
+
+    limit = 1 + tolerance
+    if "wall" in checks and result["wall"] > budget["wall"] * limit + WALL_SLACK:
+        errors.append(
+            "wall time %.2f s (budget %.2f s)" % (result["wall"], budget["wall"])
+        )
+    if "memory" in checks and result["max_rss_mb"] > budget["max_rss_mb"] * limit:
+        errors.append(
+            "max RSS %.1f MB (budget %.1f MB)"
+            % (result["max_rss_mb"], budget["max_rss_mb"])
+        )
+    return errors
+
+
+################################################################################
+# Argument parser
+################################################################################
+def get_parser():
+    """Takes care of script argument parsing."""
+    parser = ArgumentParser(description="Benchmark suite for the jip* commands")
+
+    parser.add_argument(
+        "--sizes",
+        required=False,
+        action="store",
+        default="small,medium,large",
+        help="Comma separated list of project sizes (%s)" % ", ".join(SIZES),
+    )
+
+    parser.add_argument(
+        "--scenario",
+        required=False,
+        action="append",
+        default=None,
+        help="Only run this scenario, can be given several times",
+    )
+
+    parser.add_argument(
+        "--runs",
+        required=False,
+        action="store",
+        type=int,
+        default=3,
+        help="Number of runs per scenario, the fastest one is reported",
+    )
+
+    parser.add_argument(
+        "--checks",
+        required=False,
+        action="store",
+        default="requests,wall,memory",
+        help="Comma separated list of budgets to check (requests, wall, memory)",
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        required=False,
+        action="store",
+        type=float,
+        default=0.5,
+        help="Allowed relative increase of wall time and memory (0.5 = +50%%)",
+    )
+
+    parser.add_argument(
+        "--update",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Store the results as the new budgets",
+    )
+
+    parser.add_argument(
+        "--json",
+        required=False,
+        action="store",
+        default=None,
+        help="Also write the results to this JSON file",
+    )
+
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    checks = args.checks.split(",")
+    budgets = load_budgets()
+    results = {}
+    failed = False
+
+    print(
+        "%-8s %-14s %8s %10s %9s %9s   %s"
+        % ("size", "scenario", "issues", "wall [s]", "RSS [MB]", "requests", "status")
+    )
+    for size in args.sizes.split(","):
+        results[size] = run_size(size, args.scenario, args.runs)
+        for name, result in results[size].items():
+            errors = check(
+                result, budgets.get(size, {}).get(name), checks, args.tolerance
+            )
+            print(
+                "%-8s %-14s %8d %10.2f %9.1f %9d   %s"
+                % (
+                    size,
+                    name,
+                    result["issues"],
+                    result["wall"],
+                    result["max_rss_mb"],
+                    sum(result["requests"].values()),
+                    "OK" if not errors else "FAIL",
+                )
+            )
+            for e in errors:
+                print("    %s" % e)
+            if errors:
+                failed = True
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.update:
+        for size, scenarios in results.items():
+            budgets.setdefault(size, {}).update(scenarios)
+        store_budgets(budgets)
+        print("\nBudgets updated in %s" % BUDGETS_FILE)
+    elif failed:
+        print("\nFAIL: budget exceeded")
+        sys.exit(1)
+    else:
+        print("\nOK: all scenarios within budget")
+
+
+if __name__ == "__main__":
+    main()
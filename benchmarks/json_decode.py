@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+JSON decoding benchmark on search pages of the Jira server.
+
+Search replies with all fields and the changelog (what jipstatus and the mirror
+ask for) are generated from a synthetic project (jipdate.fakejira), for several
+page sizes: 100 issues is the maximum of Jira Cloud, 1000 the one of Jira
+Server. Each page is decoded with the json module of the standard library and
+with every faster backend that is installed (orjson, used by jipdate.jsonlib,
+and for comparison simdjson and ujson). The best decode throughput is reported.
+"""
+
+from argparse import ArgumentParser
+
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from jipdate import fakejira
+
+# Issues per initiative of the synthetic project.
+ISSUES_PER_INITIATIVE = 31
+
+
+def get_parser():
+    """Takes care of script argument parsing."""
+    parser = ArgumentParser(description="JSON decoding benchmark for jipdate")
+
+    parser.add_argument(
+        "--pages",
+        required=False,
+        action="store",
+        default="100,1000",
+        help="Comma separated list of page sizes (issues per search reply)",
+    )
+
+    parser.add_argument(
+        "--runs",
+        required=False,
+        action="store",
+        type=int,
+        default=5,
+        help="Number of decodes per page and backend, the best one is reported",
+    )
+
+    return parser
+
+
+def get_backends():
+    """Returns the (name, loads) of the installed JSON backends."""
+    backends = [("json", json.loads)]
+    try:
+        import orjson
+
+        backends.append(("orjson", orjson.loads))
+    except ImportError:
+        pass
+    try:
+        import simdjson
+
+        parser = simdjson.Parser()
+        # Decodes to Python objects, like the others.
+        backends.append(("simdjson", lambda s: parser.parse(s).as_dict()))
+    except ImportError:
+        pass
+    try:
+        import ujson
+
+        backends.append(("ujson", ujson.loads))
+    except ImportError:
+        pass
+    return backends
+
+
+def get_page(store, size):
+    """Returns the reply (bytes) of a search returning size issues."""
+    issues = list(store.issues.values())[:size]
+    reply = {"startAt": 0, "maxResults": size, "total": size, "issues": issues}
+    return json.dumps(reply).encode("utf-8")
+
+
+def best_time(loads, page, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        loads(page)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def main():
+    args = get_parser().parse_args()
+    sizes = [int(s) for s in args.pages.split(",")]
+    store = fakejira.generate(initiatives=max(sizes) // ISSUES_PER_INITIATIVE + 1)
+    backends = get_backends()
+
+    print(
+        "%-7s %9s %-10s %10s %9s %8s"
+        % ("issues", "size [MB]", "backend", "time [ms]", "MB/s", "speedup")
+    )
+    for size in sizes:
+        page = get_page(store, size)
+        mb = len(page) / 1024.0 / 1024.0
+        reference = None
+        for name, loads in backends:
+            duration = best_time(loads, page, args.runs)
+            reference = reference or duration
+            print(
+                "%-7d %9.1f %-10s %10.1f %9.1f %7.1fx"
+                % (size, mb, name, duration * 1000, mb / duration, reference / duration)
+            )
+
+
+if __name__ == "__main__":
+    main()
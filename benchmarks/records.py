@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Decoding benchmark of search results: jira Issue resources vs. the slotted
+records of jipdate.records.
+
+A synthetic project (jipdate.fakejira) is turned into the reply of a search
+with the fields and changelog jipstatus asks for. Each decoder then runs in a
+fresh interpreter which loads the reply, decodes all issues and reads them like
+jipstatus does. The decode and read times are reported, with the memory used
+above the one of the interpreter: peak, and retained once the reply is dropped.
+"""
+
+from argparse import ArgumentParser
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from jipdate import fakejira
+from jipdate import projection
+
+# Issues per initiative of the synthetic project.
+ISSUES_PER_INITIATIVE = 31
+
+# Decodes the search reply in the file argv[1] with the decoder argv[2] and
+# prints the results as JSON.
+RUNNER = """
+import gc, json, sys, time
+
+def rss(name):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(name + ":"):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+from jipdate import projection, records
+from jira.client import JIRA
+from jira.resources import Issue
+
+plan = projection.plan_jipstatus("updates")
+before = rss("VmRSS")
+with open(sys.argv[1]) as f:
+    raws = json.load(f)["issues"]
+
+start = time.perf_counter()
+if sys.argv[2] == "resources":
+    options = dict(JIRA.DEFAULT_OPTIONS, server="http://127.0.0.1")
+    issues = [Issue(options, None, raw=r) for r in raws]
+else:
+    decode = records.get_decoder(plan)
+    issues = [decode(r) for r in raws]
+decoded = time.perf_counter() - start
+del raws
+gc.collect()
+
+start = time.perf_counter()
+changes = 0
+for issue in issues:
+    str(issue)
+    str(issue.fields.assignee)
+    issue.fields.summary
+    [str(c) for c in issue.fields.components]
+    for comment in issue.fields.comment.comments:
+        comment.created, comment.body
+    for history in issue.changelog.histories:
+        for item in history.items:
+            changes += item.field == "resolution"
+read = time.perf_counter() - start
+
+result = {"decode": decoded, "read": read}
+result["peak"] = rss("VmHWM") - before
+result["retained"] = rss("VmRSS") - before
+print(json.dumps(result))
+"""
+
+
+def get_parser():
+    """Takes care of script argument parsing."""
+    parser = ArgumentParser(description="Issue decoding benchmark for jipdate")
+
+    parser.add_argument(
+        "--issues",
+        required=False,
+        action="store",
+        type=int,
+        default=20000,
+        help="Number of issues in the search result",
+    )
+
+    parser.add_argument(
+        "--runs",
+        required=False,
+        action="store",
+        type=int,
+        default=3,
+        help="Number of runs per decoder, the best one is reported",
+    )
+
+    return parser
+
+
+def write_reply(filename, count):
+    """Writes the reply of a search returning count issues."""
+    store = fakejira.generate(initiatives=max(1, count // ISSUES_PER_INITIATIVE))
+    plan = projection.plan_jipstatus("updates")
+    issues = []
+    for issue in list(store.issues.values())[:count]:
+        raw = dict((k, v) for k, v in issue.items() if k != "fields")
+        raw["fields"] = dict((f, issue["fields"].get(f)) for f in plan.fields)
+        issues.append(raw)
+    with open(filename, "w") as f:
+        json.dump({"startAt": 0, "total": len(issues), "issues": issues}, f)
+    return len(issues)
+
+
+def run_decoder(filename, decoder):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    p = subprocess.run(
+        [sys.executable, "-c", RUNNER, filename, decoder],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        env=env,
+        check=True,
+    )
+    return json.loads(p.stdout)
+
+
+def main():
+    args = get_parser().parse_args()
+    workdir = tempfile.mkdtemp(prefix="jipdate-bench-")
+    filename = os.path.join(workdir, "search.json")
+    try:
+        count = write_reply(filename, args.issues)
+        print(
+            "%d issues, %.1f MB of JSON\n"
+            % (count, os.path.getsize(filename) / 1024.0 / 1024.0)
+        )
+        print(
+            "%-10s %11s %9s %10s %14s"
+            % ("decoder", "decode [s]", "read [s]", "peak [MB]", "retained [MB]")
+        )
+        for decoder in ["resources", "records"]:
+            results = [run_decoder(filename, decoder) for _ in range(args.runs)]
+            best = min(results, key=lambda r: r["decode"] + r["read"])
+            print(
+                "%-10s %11.3f %9.3f %10.1f %14.1f"
+                % (
+                    decoder,
+                    best["decode"],
+                    best["read"],
+                    best["peak"],
+                    best["retained"],
+                )
+            )
+    finally:
+        os.remove(filename)
+        os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
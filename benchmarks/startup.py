@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Startup time benchmark for the jip* console scripts.
+
+Every command module is imported in a fresh interpreter with
+"python -X importtime" and the cumulative import time is checked against a
+threshold. It also fails if any of the heavy dependencies are imported at
+startup, since they should only be imported once they are needed.
+"""
+
+from argparse import ArgumentParser
+
+import os
+import subprocess
+import sys
+
+COMMANDS = ["jipcreate", "jipdate", "jipfp", "jipsearch", "jipstatus"]
+
+# Modules that must not be imported just to parse the arguments.
+HEAVY_MODULES = ["jira", "yaml", "jinja2", "dateutil", "requests", "pprint"]
+
+
+def get_parser():
+    """Takes care of script argument parsing."""
+    parser = ArgumentParser(description="Startup time benchmark for jipdate")
+
+    parser.add_argument(
+        "--threshold-ms",
+        required=False,
+        action="store",
+        type=float,
+        default=100.0,
+        help="Maximum cumulative import time (in ms) allowed for a command",
+    )
+
+    parser.add_argument(
+        "--runs",
+        required=False,
+        action="store",
+        type=int,
+        default=5,
+        help="Number of runs per command, the best one is reported",
+    )
+
+    return parser
+
+
+def import_time(command):
+    """Imports the command module in a new interpreter and returns the
+    cumulative import time (in ms) and the set of all imported modules."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = root + os.pathsep + env.get("PYTHONPATH", "")
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import jipdate.%s" % command],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=env,
+        check=True,
+    )
+
+    cumulative = 0
+    modules = set()
+    # Lines look like: "import time:   self [us] | cumulative | imported package"
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, us, name = line.split("|")
+        name = name.strip()
+        modules.add(name)
+        if name == "jipdate.%s" % command:
+            cumulative = int(us) / 1000.0
+    return cumulative, modules
+
+
+def main():
+    args = get_parser().parse_args()
+    failed = False
+
+    print("%-12s %12s   %s" % ("command", "import [ms]", "heavy modules"))
+    for command in COMMANDS:
+        results = [import_time(command) for _ in range(args.runs)]
+        best = min(r[0] for r in results)
+        heavy = sorted(set(HEAVY_MODULES) & results[0][1])
+        print("%-12s %12.1f   %s" % (command, best, ", ".join(heavy) or "-"))
+        if best > args.threshold_ms or heavy:
+            failed = True
+
+    if failed:
+        print("\nFAIL: startup budget of %.1f ms exceeded" % args.threshold_ms)
+        sys.exit(1)
+    print("\nOK: all commands within the %.1f ms budget" % args.threshold_ms)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Python API of jipdate, for services reusing the logic of the jip* commands
+without running them.
+
+A Session has its own config, Jira connection, options, metadata and user
+caches, tracer and deadline, it doesn't use the global state of the commands
+(cfg.args, the config loaded by cfg.initiate_config(), --trace, --metrics,
+--deadline), so sessions can be used from several threads at once.
+The options of the queries are the ones of the commands, named like their long
+options (jipsearch --created-after is created_after), and the results are
+generators.
+
+    from jipdate import api
+
+    with api.Session() as session:
+        for issue in session.search(project="SWG", assignee=["john.doe"]):
+            print(issue["key"], issue["fields"]["summary"])
+        for update in session.updates(team="my-team", days=14):
+            print(update["issue"], update["resolution"])
+
+Nothing is asked on the terminal: the username and the token (or password)
+are given to the Session or read from the config (server token, username) or
+the environment (JIRA_USERNAME, JIRA_PASSWORD).
+"""
+
+import contextlib
+import os
+
+# Local files
+from jipdate import cfg
+from jipdate import deadline
+from jipdate import jiralogin
+from jipdate import metadata
+from jipdate import metrics
+from jipdate import trace
+from jipdate import users
+from jipdate.deadline import Deadline
+
+
+def load_config(filename=None):
+    """Returns the content of a config file, by default the one the commands
+    use."""
+    return cfg.load_config(filename or cfg.get_config_file())
+
+
+def get_options(parser, **options):
+    """Returns the options of a command, i.e., the defaults of its argument
+    parser updated with options. Raises TypeError for unknown options."""
+    args = parser.parse_args([])
+    for name, value in options.items():
+        if not hasattr(args, name):
+            raise TypeError("Unknown option: %s" % name)
+        setattr(args, name, value)
+    return args
+
+
+class Session:
+    """A connection to a Jira server with its config. Its requests are recorded
+    by tracer, when set to a trace.Tracer."""
+
+    def __init__(
+        self,
+        config=None,
+        test=False,
+        username=None,
+        secret=None,
+        jira=None,
+        deadline=None,
+    ):
+        """config is the content of a config file (a dict), the name of the file
+        or None for the one of the commands. jira is an existing JIRA instance
+        to use instead of connecting to the server of the config. After
+        deadline seconds, the requests of the session fail with
+        deadline.Stopped."""
+        if config is None or isinstance(config, str):
+            config = load_config(config)
+        self.config = config
+        self.tracer = None
+        self.deadline = Deadline(deadline)
+        with self.using():
+            server = cfg.get_server(test)
+            username = (
+                username
+                or jiralogin.get_username_from_env()
+                or jiralogin.get_username_from_config()
+            )
+            if jira is None:
+                secret = (
+                    secret or server.get("token") or os.environ.get("JIRA_PASSWORD")
+                )
+                if not username or not secret:
+                    raise ValueError(
+                        "No username or token/password for %s" % server.get("url")
+                    )
+                # A session may live for long, the issues it fetches are
+                # fetched again each time.
+                jira = jiralogin.connect(
+                    server.get("url"), username, secret, identity_map=False
+                )
+        self.jira = jira
+        self.username = username
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        metadata.forget(self.jira)
+        users.forget(self.jira)
+        self.jira.close()
+
+    @contextlib.contextmanager
+    def using(self):
+        """Makes the current thread use the config, tracer and deadline of this
+        session, and keeps it out of the metrics of the command."""
+        with cfg.using(self.config), trace.using(self.tracer):
+            with deadline.using(self.deadline), metrics.disabled():
+                yield self
+
+    def iterate(self, generator):
+        """Yields the items of generator, running it with the config and the
+        state of this session each time it is resumed."""
+        while True:
+            with self.using():
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+            yield item
+
+    ############################################################################
+    # jipsearch
+    ############################################################################
+    def search(self, jql=None, **options):
+        """Yields the raw issues (dicts) matching jql (a string) restricted by
+        the options of jipsearch."""
+        from jipdate import jipsearch
+
+        if jql is not None:
+            options["jql"] = [jql]
+        args = get_options(jipsearch.get_parser(), **options)
+        return self.iterate(self._search(args))
+
+    def _search(self, args):
+        from jipdate import jipsearch
+
+        for jql in args.jql or [""]:
+            jql = jipsearch.create_jql(self.jira, jql, args)
+            yield from jipsearch.iter_issues(self.jira, jql, args)
+
+    ############################################################################
+    # jipstatus
+    ############################################################################
+    def get_status_options(self, options):
+        from jipdate import jipstatus
+
+        args = get_options(jipstatus.get_parser(), **options)
+        if args.user is None:
+            args.user = [self.username]
+        return args
+
+    def updates(self, **options):
+        """Yields the comments and resolutions of the last days (dicts, see
+        jipstatus.enumerate_updates()), with the options of jipstatus."""
+        from jipdate import jipstatus
+
+        args = self.get_status_options(options)
+        return self.iterate(jipstatus.enumerate_updates(self.jira, args))
+
+    def pending(self, **options):
+        """Yields the issues in progress (dicts, see
+        jipstatus.enumerate_pending()), with the options of jipstatus."""
+        from jipdate import jipstatus
+
+        args = self.get_status_options(options)
+        return self.iterate(jipstatus.enumerate_pending(self.jira, args))
+
+    ############################################################################
+    # jipdate
+    ############################################################################
+    def status_updates(self, text):
+        """Yields the updates found in the text of a status file, without
+        sending them. Each one is a dict with the issue key, comment, transition
+        and resolution ids, time spent and a summary of the transition. Raises
+        jipdate.StatusError when a new status isn't a transition of its
+        issue."""
+        return self.iterate(self._status_updates(text.splitlines(True)))
+
+    def _status_updates(self, lines):
+        from jipdate import jipdate
+        from jipdate import projection
+
+        plan = projection.plan_jipdate(None)
+        issue_comments = jipdate.read_status(self.jira, lines, None, plan)
+        for update in jipdate.plan_updates(self.jira, issue_comments):
+            issue, comment, transition, timespent, summary = update
+            yield {
+                "issue": str(issue),
+                "comment": comment,
+                "transition": transition["transition"],
+                "resolution": transition["resolution"],
+                "time_spent": timespent,
+                "summary": summary.strip(),
+            }
+
+    def update(self, updates):
+        """Sends updates (from status_updates()) to Jira, yielding each one
+        once it is done."""
+        return self.iterate(self._update(updates))
+
+    def _update(self, updates):
+        from jipdate import jipdate
+
+        for update in updates:
+            transition = {
+                "transition": update["transition"],
+                "resolution": update["resolution"],
+            }
+            jipdate.update_jira(
+                self.jira,
+                update["issue"],
+                update["comment"],
+                transition,
+                update["time_spent"],
+            )
+            yield update
@@ -0,0 +1,274 @@
+"""
+Cassettes of the requests sent to Jira and of their responses.
+
+With --record DIR, every request a command sends to Jira and the response of
+the server are written to DIR, without the credentials: the request headers
+(Authorization, cookies) and the cookies set by the server aren't kept. With
+--replay DIR, the requests are answered from DIR instead of the server,
+optionally as slowly as the server answered them (--replay-latency), so a real
+run can be profiled offline, again and again, against the same traffic.
+
+Requests are matched on their method, path, query parameters (with the JQL
+normalized) and body. When the same request was sent several times, its
+responses are replayed in the recorded order, the last one being repeated.
+
+Both recording and replaying start from an empty cache directory, so that the
+commands send the same requests each time.
+"""
+
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import atexit
+import base64
+import collections
+import hashlib
+import logging as log
+import os
+import re
+import sys
+import threading
+import time
+
+# Local files
+from jipdate import cfg
+from jipdate import jsonlib
+
+# Version of the format of the cassettes.
+VERSION = 1
+
+# Files of a cassette: the server it was recorded from and the interactions,
+# one JSON object per line.
+CASSETTE_FILE = "cassette.json"
+INTERACTIONS_FILE = "interactions.jsonl"
+
+# Query parameters holding a secret, their value isn't recorded.
+REGEX_SECRET = re.compile(r"pass|token|secret|auth", re.IGNORECASE)
+
+# Response headers that aren't recorded.
+DROPPED_HEADERS = ["set-cookie"]
+
+# JQL is split into quoted strings, kept as is, and the rest in which the case
+# and the spaces don't matter.
+REGEX_JQL_TOKENS = re.compile(r"\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*'|[^\"']+")
+REGEX_JQL_SPACES = re.compile(r"\s*([=!<>~,()])\s*|\s+")
+
+# The recorder or the player of this run, None when not enabled.
+recorder = None
+player = None
+
+
+def enabled():
+    return recorder is not None or player is not None
+
+
+################################################################################
+# Matching
+################################################################################
+def normalize_jql(jql):
+    """Returns jql without the differences that don't change its meaning: case
+    of the keywords and fields, and spaces outside of quoted values."""
+    tokens = []
+    for token in REGEX_JQL_TOKENS.findall(jql):
+        if token[0] not in "\"'":
+            token = REGEX_JQL_SPACES.sub(lambda m: m.group(1) or " ", token)
+            token = token.lower()
+        tokens.append(token)
+    return "".join(tokens).strip()
+
+
+def get_body(request):
+    """Returns the body of a request (bytes), JSON being normalized."""
+    body = request.body or b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if not body:
+        return body
+    try:
+        data = jsonlib.loads(body)
+    except ValueError:
+        return body
+    if isinstance(data, dict) and isinstance(data.get("jql"), str):
+        data["jql"] = normalize_jql(data["jql"])
+    return jsonlib.dumps(data, sort_keys=True).encode("utf-8")
+
+
+def get_key(request):
+    """Returns the key matching a request with the recorded ones."""
+    url = urlsplit(request.url)
+    params = []
+    for name, value in parse_qsl(url.query, keep_blank_values=True):
+        if name == "jql":
+            value = normalize_jql(value)
+        elif REGEX_SECRET.search(name):
+            value = ""
+        params.append((name, value))
+    key = "%s %s" % (request.method, url.path)
+    if params:
+        key += "?" + urlencode(sorted(params))
+    body = get_body(request)
+    if body:
+        key += " " + hashlib.sha1(body).hexdigest()[:16]
+    return key
+
+
+################################################################################
+# Record
+################################################################################
+class Recorder:
+    """Writes the requests and their responses to a cassette directory."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.file = open(os.path.join(directory, INTERACTIONS_FILE), "w")
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def set_server(self, url, username):
+        """Records the server and the user the requests are sent to/as."""
+        cassette = {
+            "version": VERSION,
+            "server": url,
+            "username": username,
+            "command": os.path.splitext(os.path.basename(sys.argv[0]))[0],
+            "recorded": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        }
+        with open(os.path.join(self.directory, CASSETTE_FILE), "w") as f:
+            jsonlib.dump(cassette, f, indent=2)
+
+    def record(self, request, response, start):
+        """Records a request sent at start (time.perf_counter()) and its
+        response, whose body is read first."""
+        from jipdate import httpcache
+
+        body = response.content or b""
+        interaction = {
+            "key": get_key(request),
+            "elapsed": round(time.perf_counter() - start, 6),
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": dict(
+                (k, v)
+                for k, v in httpcache.get_headers(response).items()
+                if k.lower() not in DROPPED_HEADERS
+            ),
+        }
+        try:
+            interaction["body"] = body.decode("utf-8")
+        except UnicodeDecodeError:
+            interaction["base64"] = base64.b64encode(body).decode("ascii")
+
+        line = jsonlib.dumps(interaction) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.count += 1
+
+    def close(self):
+        self.file.close()
+        print(
+            "Recorded %d requests to %s" % (self.count, self.directory),
+            file=sys.stderr,
+        )
+
+
+################################################################################
+# Replay
+################################################################################
+class Player:
+    """Answers the requests with the responses of a cassette directory."""
+
+    def __init__(self, directory, latency=None):
+        with open(os.path.join(directory, CASSETTE_FILE)) as f:
+            cassette = jsonlib.load(f)
+        if cassette.get("version") != VERSION:
+            raise ValueError("unknown cassette version %s" % cassette.get("version"))
+        self.directory = directory
+        self.server = cassette["server"]
+        self.username = cassette["username"]
+        self.latency = latency
+        self.responses = collections.defaultdict(collections.deque)
+        with open(os.path.join(directory, INTERACTIONS_FILE)) as f:
+            for line in f:
+                interaction = jsonlib.loads(line)
+                self.responses[interaction["key"]].append(interaction)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.missing = 0
+
+    def send(self, request):
+        """Returns the recorded response to request, raises ConnectionError if
+        there is none."""
+        from requests.exceptions import ConnectionError
+        from jipdate import httpcache
+
+        key = get_key(request)
+        with self.lock:
+            interactions = self.responses.get(key)
+            if not interactions:
+                self.missing += 1
+                raise ConnectionError(
+                    "No recorded response for %s in %s, are the options the "
+                    "ones of the recorded run?" % (key, self.directory),
+                    request=request,
+                )
+            if len(interactions) > 1:
+                interaction = interactions.popleft()
+            else:
+                interaction = interactions[0]
+            self.count += 1
+
+        if self.latency:
+            time.sleep(interaction["elapsed"] * self.latency)
+
+        if "base64" in interaction:
+            body = base64.b64decode(interaction["base64"])
+        else:
+            body = interaction["body"].encode("utf-8")
+        return httpcache.build_response(
+            request,
+            interaction["status"],
+            interaction["reason"],
+            interaction["headers"],
+            body,
+        )
+
+    def close(self):
+        log.debug("Replayed %d requests from %s" % (self.count, self.directory))
+        if self.missing:
+            print(
+                "%d requests were not found in %s" % (self.missing, self.directory),
+                file=sys.stderr,
+            )
+
+
+################################################################################
+# Setup
+################################################################################
+def use_empty_cache():
+    """Makes the command start with an empty cache directory, removed when it
+    is done."""
+    import shutil
+    import tempfile
+
+    cfg.cache_path = tempfile.mkdtemp(prefix="jipdate-cassette-")
+    atexit.register(shutil.rmtree, cfg.cache_path, True)
+
+
+def start(record=None, replay=None, latency=None):
+    """Records the requests to the directory record or replays them from the
+    directory replay."""
+    global recorder, player
+
+    if record:
+        recorder = Recorder(record)
+        atexit.register(recorder.close)
+    elif replay:
+        try:
+            player = Player(replay, latency)
+        except (OSError, KeyError, ValueError) as e:
+            log.error("Cannot replay %s: %s" % (replay, e))
+            sys.exit(os.EX_NOINPUT)
+        atexit.register(player.close)
+    else:
+        return
+    use_empty_cache()
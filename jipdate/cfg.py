@@ -1,11 +1,37 @@
+import contextlib
+import hashlib
 import logging as log
 import os
+import pickle
 import sys
-import yaml
+import threading
 
 TEST_SERVER = {"url": "https://dev-projects.linaro.org"}
 PRODUCTION_SERVER = {"url": "https://projects.linaro.org"}
 
+# Default settings for the HTTP connection to the Jira server, each of them can
+# be overridden in the "connection" section of the config file.
+DEFAULT_CONNECTION = {
+    "pool_connections": 4,
+    "pool_maxsize": 10,
+    "connect_timeout": 10,
+    "read_timeout": 60,
+    "retries": 5,
+    "backoff_factor": 0.5,
+    "rate_limit": 0,
+    "rate_burst": 10,
+    "throttle_retries": 10,
+    "cache_server_info": False,
+    "server_info_ttl": 86400,
+    "engine": "sync",
+    "concurrency": 8,
+    "http2": True,
+    "identity_map": True,
+    "hedge": False,
+    "hedge_percentile": 95,
+    "hedge_max_ratio": 0.05,
+}
+
 args = None
 
 # Config file paths and name, basically we allow the user to store the
@@ -17,6 +43,10 @@ config_home_dir = os.environ["HOME"]
 config_locations = [config_app_dir, config_home_dir, config_home_config_dir]
 config_path = config_home_config_dir
 
+# Directory used for files that can be thrown away at any time, like the cached
+# server information.
+cache_path = os.environ.get("XDG_CACHE_HOME", config_home_dir + "/.cache") + "/jipdate"
+
 # Config filenames
 config_filename = ".jipdate.yml"
 config_legacy_filename = "config.yml"
@@ -26,6 +56,13 @@ config_file = None
 
 yml_config = None
 
+# Per thread config used instead of yml_config, see using().
+local = threading.local()
+
+# The (get, using) functions of the other state kept per thread (trace,
+# deadline, metrics), see bind().
+thread_states = []
+
 
 ################################################################################
 # Global config file used by different scripts
@@ -46,6 +83,12 @@ version: 1
 #  url: https://<name_of_test_instance>.atlassian.net
 #  token: abcdefghijkl
 
+# HTTP connection settings (timeouts are in seconds)
+#connection:
+#  connect_timeout: 10
+#  read_timeout: 60
+#  retries: 5
+
 # Extra comments added to each Jira issue (multiline is OK)
 comments:
         - "# No updates since last week."
@@ -93,17 +136,151 @@ def get_config_file():
     return config_path + "/" + config_filename
 
 
+def get_yml_config():
+    """Returns the config of the current thread, i.e., the one given to using()
+    or the global one."""
+    config = getattr(local, "yml_config", None)
+    return yml_config if config is None else config
+
+
+@contextlib.contextmanager
+def using(config):
+    """Makes the functions of this module read config (the content of a config
+    file) in the current thread instead of the global config."""
+    previous = getattr(local, "yml_config", None)
+    local.yml_config = config
+    try:
+        yield config
+    finally:
+        local.yml_config = previous
+
+
+def bind(function):
+    """Returns function, to be called from another thread (a pool), running with
+    the config and the other per thread state of the current thread, e.g., the
+    deadline of an api.Session."""
+    config = getattr(local, "yml_config", None)
+    states = [(using_state, get()) for get, using_state in thread_states]
+
+    def run(*args, **kwargs):
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(using(config))
+            for using_state, state in states:
+                stack.enter_context(using_state(state))
+            return function(*args, **kwargs)
+
+    return run
+
+
 def get_server(use_test_server=False):
     # Get Jira Server details. Check first if using the test server
     # then try user config file, then default from cfg.py
     if use_test_server is False:
-        server = yml_config.get("server", PRODUCTION_SERVER)
+        server = get_yml_config().get("server", PRODUCTION_SERVER)
     else:
-        server = yml_config.get("test_server", TEST_SERVER)
+        server = get_yml_config().get("test_server", TEST_SERVER)
 
     return server
 
 
+def get_connection_config():
+    """Returns the HTTP connection settings, i.e., the defaults updated with
+    what is in the "connection" section of the config file."""
+    connection = dict(DEFAULT_CONNECTION)
+    connection.update(get_yml_config().get("connection") or {})
+    return connection
+
+
+def get_cache_file(name):
+    """Returns the full path to a file in the jipdate cache directory (which is
+    created if it doesn't exist)."""
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    return cache_path + "/" + name
+
+
+def get_option(name, default=None):
+    """Returns the value of a top level option in the config file."""
+    return get_yml_config().get(name, default)
+
+
+def get_bool(name, default=False):
+    """Returns a top level option of the config file as a boolean."""
+    value = get_yml_config().get(name, default)
+    if isinstance(value, str):
+        return value.strip().lower() in ["true", "yes", "y", "1"]
+    return bool(value)
+
+
+def get_str(name, default=None):
+    """Returns a top level option of the config file as a string."""
+    value = get_yml_config().get(name)
+    if value is None:
+        return default
+    return str(value)
+
+
+def get_list(name, default=None):
+    """Returns a top level option of the config file as a list of strings. A
+    single string is returned as a list with one element and an empty option as
+    an empty list."""
+    config = get_yml_config()
+    if name not in config:
+        return default
+    value = config[name]
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return [str(v) for v in value]
+
+
+def get_config_cache_file(filename):
+    """Returns the name of the file caching the parsed content of filename."""
+    digest = hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()
+    return get_cache_file("config-%s.pickle" % digest[:16])
+
+
+def parse_config(filename):
+    """Parses a YAML config file, using the libyaml based loader if it is
+    available."""
+    import yaml
+
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(filename, "r") as yml:
+        return yaml.load(yml, Loader=loader) or {}
+
+
+def load_config(filename):
+    """
+    Returns the content of the config file. The parsed config is cached (keyed
+    on the path, mtime and size of the file), so that the YAML parser is only
+    needed when the file has changed since the last run.
+    """
+    st = os.stat(filename)
+    stamp = (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+
+    cache_file = get_config_cache_file(filename)
+    try:
+        with open(cache_file, "rb") as f:
+            cached = pickle.load(f)
+        if cached["stamp"] == stamp:
+            log.debug("Using cached config: %s" % cache_file)
+            return cached["config"]
+    except (OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError):
+        pass
+
+    config = parse_config(filename)
+    try:
+        tmp_file = "%s.%d" % (cache_file, os.getpid())
+        with open(tmp_file, "wb") as f:
+            pickle.dump({"stamp": stamp, "config": config}, f)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        log.debug("Could not cache the config: %s" % e)
+    return config
+
+
 def initiate_config():
     """Reads the config file (yaml format) and returns the sets the global
     instance.
@@ -116,5 +293,4 @@ def initiate_config():
         create_default_config()
 
     log.debug("Using config file: %s" % config_file)
-    with open(config_file, "r") as yml:
-        yml_config = yaml.load(yml, Loader=yaml.FullLoader)
+    yml_config = load_config(config_file)
@@ -0,0 +1,156 @@
+"""
+Command line options shared by all the jip* commands.
+"""
+
+from argparse import ArgumentTypeError
+
+import atexit
+
+from jipdate import cassette
+from jipdate import cfg
+from jipdate import metrics
+from jipdate import profiler
+from jipdate import trace
+
+
+def add_common_arguments(parser):
+    """Adds the options common to all commands to an ArgumentParser."""
+    parser.add_argument(
+        "--trace",
+        required=False,
+        nargs="?",
+        action="store",
+        const="",
+        default=None,
+        metavar="FILE",
+        help="Print a summary of the Jira requests when done and, if FILE is \
+            given, write the full trace to FILE (JSON, can be loaded in \
+            chrome://tracing)",
+    )
+    parser.add_argument(
+        "--profile",
+        required=False,
+        nargs="?",
+        action="store",
+        const="",
+        default=None,
+        metavar="FILE",
+        help="Print the wall time and peak memory of each phase and the top \
+            memory allocations when done and, if FILE is given, write the \
+            cProfile statistics to FILE (slows the command down)",
+    )
+    parser.add_argument(
+        "--metrics",
+        required=False,
+        action="store",
+        default=None,
+        metavar="FILE",
+        help="Write the metrics of the run (duration, requests, throttling, \
+            issues, output size) to FILE in the OpenMetrics text format, e.g., \
+            for the textfile collector of the Prometheus node_exporter",
+    )
+    parser.add_argument(
+        "--engine",
+        required=False,
+        action="store",
+        choices=["sync", "async"],
+        default=None,
+        help="How requests are sent to Jira: one at a time (sync) or \
+            concurrently (async), overrides the 'engine' connection setting",
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--record",
+        required=False,
+        action="store",
+        default=None,
+        metavar="DIR",
+        help="Record the Jira requests and responses, without the credentials, \
+            to DIR to replay them with --replay",
+    )
+    group.add_argument(
+        "--replay",
+        required=False,
+        action="store",
+        default=None,
+        metavar="DIR",
+        help="Answer the Jira requests with the responses recorded to DIR \
+            instead of sending them",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        required=False,
+        nargs="?",
+        action="store",
+        type=float,
+        const=1.0,
+        default=None,
+        metavar="FACTOR",
+        help="With --replay, take as long as the server took to answer, \
+            multiplied by FACTOR (default: 1)",
+    )
+
+
+def get_seconds(value):
+    """Converts the value of --deadline, a number of seconds that can't be
+    negative."""
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = None
+    # Also rejects nan, which would never expire.
+    if seconds is None or not seconds >= 0:
+        raise ArgumentTypeError("invalid number of seconds: %r" % value)
+    return seconds
+
+
+def add_deadline_argument(parser):
+    """Adds --deadline to the commands rendering reports, see deadline.py."""
+    parser.add_argument(
+        "--deadline",
+        required=False,
+        action="store",
+        type=get_seconds,
+        default=None,
+        metavar="SECONDS",
+        help="Stop sending requests after SECONDS and render what has been \
+            collected so far, marked as incomplete (exit status 75). Ctrl-C \
+            does the same",
+    )
+
+
+def setup(args):
+    """Enables what the common options ask for, to be called right after the
+    arguments have been parsed."""
+    if args.trace is not None:
+        trace.enable()
+        atexit.register(trace.report, args.trace)
+    if args.profile is not None:
+        profiler.start(args.profile)
+        atexit.register(profiler.report, args.profile)
+    if args.metrics:
+        metrics.start()
+        atexit.register(metrics.write, args.metrics)
+    cassette.start(args.record, args.replay, args.replay_latency)
+    trace.phase("config")
+
+
+def phase(name):
+    """Marks the start of a new phase (login, query, render, write) of the
+    command."""
+    profiler.end_phase()
+    trace.phase(name)
+
+
+def open_engine(jira, args):
+    """Returns the asyncio engine when --engine or the config selects it, None
+    otherwise."""
+    connection = cfg.get_connection_config()
+    if (args.engine or connection["engine"]) != "async":
+        return None
+
+    from jipdate import engine
+
+    e = engine.Engine(jira, connection)
+    atexit.register(e.close)
+    return e
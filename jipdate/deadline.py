@@ -0,0 +1,155 @@
+"""
+Deadline of the commands rendering reports (--deadline).
+
+Once the deadline has passed, or after Ctrl-C, the requests still to be sent
+fail with Stopped, the requests being sent are cut short (their timeouts never
+go past the deadline) and the commands render what they have collected so far,
+marked as incomplete, instead of nothing at all.
+"""
+
+import contextlib
+import logging as log
+import os
+import sys
+import threading
+import time
+
+# Local files
+from jipdate import cfg
+
+
+class Stopped(Exception):
+    """Raised by the requests that aren't sent, or cut short, because of the
+    deadline or Ctrl-C."""
+
+
+class Deadline:
+    """When the collection of the results stops, for the command (see start())
+    or for an api.Session."""
+
+    def __init__(self, seconds=None):
+        # Time (time.monotonic()) after which no more requests are sent, None
+        # without deadline.
+        self.expires = None
+        self.seconds = seconds
+        if seconds is not None:
+            self.expires = time.monotonic() + seconds
+        # Why the collection of the results stopped ("deadline" or
+        # "interrupted"), None while it goes on.
+        self.stopped = None
+        # Whether the command renders partial results.
+        self.enabled = False
+
+
+# The deadline of this run.
+run = Deadline()
+
+# The deadlines of the threads running for an api.Session, see using().
+local = threading.local()
+
+
+@contextlib.contextmanager
+def using(d):
+    """Makes the current thread follow d (a Deadline) instead of the deadline of
+    the run."""
+    previous = getattr(local, "deadline", None)
+    local.deadline = d
+    try:
+        yield d
+    finally:
+        local.deadline = previous
+
+
+def get_deadline():
+    """Returns the Deadline of the current thread, see using()."""
+    return getattr(local, "deadline", None) or run
+
+
+cfg.thread_states.append((get_deadline, using))
+
+
+def start(deadline=None):
+    """Makes the command stop collecting results after deadline seconds or
+    when interrupted by Ctrl-C."""
+    run.enabled = True
+    if deadline is not None:
+        run.seconds = deadline
+        run.expires = time.monotonic() + deadline
+
+
+def remaining():
+    """Returns the time (s) left before the deadline, None without deadline."""
+    d = get_deadline()
+    if d.expires is None:
+        return None
+    return max(0.0, d.expires - time.monotonic())
+
+
+def expired():
+    d = get_deadline()
+    return d.expires is not None and time.monotonic() >= d.expires
+
+
+def is_stopped():
+    """Returns True once the collection of the results stopped."""
+    return get_deadline().stopped is not None
+
+
+def get_message():
+    d = get_deadline()
+    if d.stopped == "deadline":
+        reason = "stopped at the deadline (%g s)" % d.seconds
+    else:
+        reason = "interrupted"
+    return "Incomplete report: %s, some issues are missing" % reason
+
+
+def stop(reason):
+    """Stops the collection of the results, returns the exception to raise."""
+    d = get_deadline()
+    if d.stopped is None:
+        d.stopped = reason
+        log.debug("Collection of the results %s" % reason)
+    return Stopped(get_message())
+
+
+def check():
+    """Raises Stopped if no more requests may be sent."""
+    d = get_deadline()
+    if d.stopped is None and expired():
+        stop("deadline")
+    if d.stopped is not None:
+        raise Stopped(get_message())
+
+
+def stopping(e):
+    """Returns True if the exception e (Stopped or KeyboardInterrupt) stops the
+    collection of the results, the caller then goes on with what it has. False
+    means that it must be raised again."""
+    if not get_deadline().enabled:
+        return False
+    if isinstance(e, KeyboardInterrupt):
+        stop("interrupted")
+    return True
+
+
+def get_timeout(timeout):
+    """Returns timeout, as given to requests (a number or a (connect, read)
+    tuple), shortened so that the request doesn't go past the deadline."""
+    left = remaining()
+    if left is None:
+        return timeout
+    left = max(left, 0.001)
+    if timeout is None:
+        return left
+    if isinstance(timeout, tuple):
+        return tuple(left if t is None else min(t, left) for t in timeout)
+    return min(timeout, left)
+
+
+def finish():
+    """Tells that the results were incomplete, with the EX_TEMPFAIL exit
+    status."""
+    if is_stopped():
+        print(get_message(), file=sys.stderr)
+        sys.exit(os.EX_TEMPFAIL)
@@ -0,0 +1,360 @@
+"""
+asyncio engine sending independent Jira requests concurrently.
+
+The jira library sends one request at a time, hence the wall time of a command
+is the sum of the round trips. When selected (--engine async, or "engine: async"
+in the "connection" section of the config file), the commands hand the requests
+that don't depend on each other (search pages, issues, comments, transitions,
+updates of different issues) to this engine, which sends up to "concurrency"
+of them at the same time.
+
+Requests are sent with httpx (HTTP/2 when the h2 package is installed) if it is
+available, see the "async" extra. Otherwise, and when the requests must go
+through the jipd daemon, the HTTP cache or a cassette (--record, --replay), they
+are sent by a pool of threads using the session of the JIRA instance.
+"""
+
+import asyncio
+import functools
+import logging as log
+import time
+
+# Local files
+from jipdate import cassette
+from jipdate import cfg
+from jipdate import deadline
+from jipdate import jsonlib
+from jipdate import trace
+from jipdate import transport
+
+# Issues per search request.
+PAGE_SIZE = 100
+
+
+class SessionBackend:
+    """Sends the requests with the session of the JIRA instance, from a pool of
+    threads."""
+
+    def __init__(self, jira, concurrency):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.session = jira._session
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def request(self, method, url, params=None, data=None):
+        loop = asyncio.get_event_loop()
+        # The deadline, tracer etc. of an api.Session follow the request.
+        response = await loop.run_in_executor(
+            self.pool,
+            cfg.bind(
+                functools.partial(
+                    self.session.request, method, url, params=params, data=data
+                )
+            ),
+        )
+        return response.json() if response.content else None
+
+    async def close(self):
+        self.pool.shutdown()
+
+
+class HttpxBackend:
+    """Sends the requests with an httpx client, scheduled by the rate limiter of
+    the JIRA session."""
+
+    def __init__(self, jira, connection, concurrency):
+        import httpx
+
+        http2 = connection["http2"]
+        if http2:
+            try:
+                import h2
+            except ImportError:
+                http2 = False
+
+        session = jira._session
+        self.connection = connection
+        self.limiter = session.get_adapter(jira.server_url).limiter
+        self.client = httpx.AsyncClient(
+            auth=session.auth,
+            headers=dict(session.headers),
+            cookies=session.cookies,
+            timeout=httpx.Timeout(
+                connection["read_timeout"], connect=connection["connect_timeout"]
+            ),
+            transport=httpx.AsyncHTTPTransport(
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=concurrency, max_keepalive_connections=concurrency
+                ),
+                retries=connection["retries"],
+            ),
+        )
+
+    async def request(self, method, url, params=None, data=None):
+        from jira import JIRAError
+
+        loop = asyncio.get_event_loop()
+        attempt = 0
+        while True:
+            await loop.run_in_executor(None, cfg.bind(self.limiter.acquire))
+            log.debug("%s %s" % (method, url))
+            start = time.perf_counter()
+            response = await self.client.request(
+                method, url, params=params, content=data
+            )
+            trace.record_response(
+                method,
+                str(response.url),
+                response.status_code,
+                len(response.content),
+                start,
+            )
+            self.limiter.update(response)
+            if not transport.should_retry(method, response, attempt, self.connection):
+                break
+            self.limiter.throttle(response, attempt)
+            attempt += 1
+
+        if response.status_code >= 400:
+            raise JIRAError(
+                text=response.text, status_code=response.status_code, url=url
+            )
+        return jsonlib.loads(response.content) if response.content else None
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def get_backend(jira, connection, concurrency):
+    """Returns httpx when it is installed and the requests are sent straight to
+    the server, else the session backend."""
+    adapter = jira._session.get_adapter(jira.server_url)
+    if (
+        isinstance(adapter, transport.JiraAdapter)
+        and adapter.cache is None
+        and not cassette.enabled()
+    ):
+        try:
+            return HttpxBackend(jira, connection, concurrency)
+        except ImportError:
+            log.debug("httpx is not installed, using threads")
+    return SessionBackend(jira, concurrency)
+
+
+class Engine:
+    """
+    Runs coroutines sending requests to the server of a JIRA instance, at most
+    concurrency of them at a time. The fetch_* and run_* methods block until
+    all their requests are done.
+    """
+
+    def __init__(self, jira, connection):
+        self.jira = jira
+        self.url = "%s/rest/api/%s" % (
+            jira.server_url,
+            jira._options["rest_api_version"],
+        )
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        concurrency = max(1, int(connection["concurrency"]))
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.backend = get_backend(jira, connection, concurrency)
+        log.debug(
+            "asyncio engine: %s, %d concurrent requests"
+            % (type(self.backend).__name__, concurrency)
+        )
+
+    def run(self, coroutine):
+        try:
+            return self.loop.run_until_complete(coroutine)
+        except BaseException:
+            # Cancel the requests still running, e.g., after Ctrl-C.
+            all_tasks = getattr(asyncio, "all_tasks", None) or asyncio.Task.all_tasks
+            tasks = all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            raise
+
+    def close(self):
+        self.run(self.backend.close())
+        self.loop.close()
+
+    async def request(self, method, path, params=None, data=None):
+        """Sends a request to the REST API and returns the decoded reply."""
+        if data is not None:
+            data = jsonlib.dumps(data)
+        async with self.semaphore:
+            deadline.check()
+            request = self.backend.request(
+                method, self.url + path, params=params, data=data
+            )
+            left = deadline.remaining()
+            if left is None:
+                return await request
+            try:
+                return await asyncio.wait_for(request, left)
+            except asyncio.TimeoutError as e:
+                raise deadline.stop("deadline") from e
+
+    async def unless_stopped(self, coroutine):
+        """Returns the result of coroutine, or None if the deadline or Ctrl-C
+        stopped its requests."""
+        try:
+            return await coroutine
+        except deadline.Stopped as e:
+            if not deadline.stopping(e):
+                raise
+            return None
+
+    async def map(self, function, items):
+        """Returns [await function(item) for item in items], the calls being
+        run concurrently."""
+        return await asyncio.gather(*[function(item) for item in items])
+
+    ############################################################################
+    # Requests
+    ############################################################################
+    async def search(
+        self, jql, fields=None, expand=None, page_size=PAGE_SIZE, limit=None
+    ):
+        """Returns all the issues (raw) matching jql, or the first limit ones.
+        The first page tells how many issues there are, the other pages are
+        then fetched concurrently."""
+        if limit is not None:
+            page_size = min(page_size, limit)
+        params = {"jql": jql, "maxResults": page_size}
+        if fields is not None:
+            params["fields"] = fields if isinstance(fields, str) else ",".join(fields)
+        if expand is not None:
+            params["expand"] = expand
+        if self.jira._is_cloud:
+            return await self.search_cloud(params, limit)
+
+        first = await self.request("GET", "/search", dict(params, startAt=0))
+        issues = first["issues"]
+        total = first["total"] if limit is None else min(first["total"], limit)
+        # The server may return less issues per page than asked for.
+        starts = range(len(issues), total, len(issues) or page_size)
+
+        async def page(start):
+            result = await self.unless_stopped(
+                self.request("GET", "/search", dict(params, startAt=start))
+            )
+            return result["issues"] if result is not None else []
+
+        for p in await self.map(page, starts):
+            issues += p
+        return issues[:total]
+
+    async def search_cloud(self, params, limit=None):
+        """Returns the issues of a search on Jira Cloud, which only has
+        /search/jql. Its pages are chained by nextPageToken and it doesn't tell
+        the total, hence they are fetched one after the other."""
+        issues = []
+        token = None
+        while limit is None or len(issues) < limit:
+            if token is not None:
+                params = dict(params, nextPageToken=token)
+            result = await self.unless_stopped(
+                self.request("GET", "/search/jql", params)
+            )
+            if result is None:
+                break
+            issues += result["issues"]
+            token = result.get("nextPageToken")
+            if not result["issues"] or result.get("isLast") or token is None:
+                break
+        return issues[:limit]
+
+    async def get_issue(self, key, fields=None, expand=None):
+        """Returns an issue (raw), or None if it doesn't exist."""
+        from jira import JIRAError
+
+        params = {}
+        if fields is not None:
+            params["fields"] = fields if isinstance(fields, str) else ",".join(fields)
+        if expand is not None:
+            params["expand"] = expand
+        try:
+            return await self.request("GET", "/issue/%s" % key, params)
+        except JIRAError as e:
+            if e.status_code != 404:
+                raise
+            log.debug("%s: %s" % (key, e.text))
+            return None
+
+    async def get_comments(self, key):
+        result = await self.request("GET", "/issue/%s/comment" % key)
+        return result["comments"]
+
+    async def get_transitions(self, key):
+        result = await self.request("GET", "/issue/%s/transitions" % key)
+        return result["transitions"]
+
+    async def add_comment(self, key, body):
+        return await self.request(
+            "POST", "/issue/%s/comment" % key, data={"body": body}
+        )
+
+    async def add_worklog(self, key, time_spent, comment=None):
+        data = {"timeSpent": time_spent}
+        if comment is not None:
+            data["comment"] = comment
+        return await self.request("POST", "/issue/%s/worklog" % key, data=data)
+
+    async def transition_issue(self, key, transition, fields=None):
+        data = {"transition": {"id": str(transition)}}
+        if fields:
+            data["fields"] = fields
+        return await self.request("POST", "/issue/%s/transitions" % key, data=data)
+
+    async def update_issue(self, key, fields):
+        return await self.request("PUT", "/issue/%s" % key, data={"fields": fields})
+
+    async def create_issue(self, fields):
+        return await self.request("POST", "/issue", data={"fields": fields})
+
+    ############################################################################
+    # Blocking helpers
+    ############################################################################
+    def fetch_issues(self, keys, fields=None, expand=None):
+        """Returns the issues (raw) that exist in a dict keyed by issue key."""
+        keys = list(dict.fromkeys(str(k) for k in keys))
+
+        async def get(key):
+            return await self.unless_stopped(self.get_issue(key, fields, expand))
+
+        issues = {}
+        for key, raw in zip(keys, self.run(self.map(get, keys))):
+            if raw is not None:
+                issues[key] = raw
+        return issues
+
+    def fetch_comments(self, keys):
+        """Returns the comments of issues in a dict keyed by issue key."""
+        from jira.resources import Comment
+
+        keys = list(dict.fromkeys(str(k) for k in keys))
+
+        async def get(key):
+            return await self.unless_stopped(self.get_comments(key))
+
+        comments = {}
+        for key, raws in zip(keys, self.run(self.map(get, keys))):
+            if raws is None:
+                continue
+            comments[key] = [
+                Comment(self.jira._options, self.jira._session, raw=r) for r in raws
+            ]
+        return comments
+
+    def fetch_transitions(self, keys):
+        """Returns the transitions (raw) of issues in a dict keyed by issue key."""
+        keys = list(dict.fromkeys(str(k) for k in keys))
+        return dict(zip(keys, self.run(self.map(self.get_transitions, keys))))
+
+    def run_all(self, function, items):
+        """Runs the coroutine function on all items concurrently."""
+        return self.run(self.map(function, items))
@@ -0,0 +1,1119 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the Jira REST API, used to run and measure the jip*
+commands offline and at scale.
+
+The server keeps a synthetic data set in memory (see generate()) and serves the
+subset of the REST API used by jipdate: search, issues, comments, transitions,
+worklogs, resolutions, fields, createmeta, boards/sprints and users. Latency
+and throttling (429) can be injected to mimic a remote and busy server. Every
+request is counted per endpoint, so that benchmarks can check how many round
+trips a command needs.
+
+Run it with:
+
+    python -m jipdate.fakejira --port 8080 --initiatives 100
+
+and point the "server" (or "test_server") url in .jipdate.yml to it. Any
+username and password/token are accepted.
+"""
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import base64
+import collections
+import datetime
+import json
+import logging as log
+import random
+import re
+import threading
+import time
+
+from jipdate.jql import JqlError, JqlParser
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.000+0000"
+
+# Urls in the data set are relative to this, it is replaced by the real address
+# of the server in the responses.
+BASE_URL = "http://fakejira.invalid"
+
+FIRST_NAMES = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi"]
+LAST_NAMES = ["smith", "jones", "brown", "lee", "martin", "garcia", "clark"]
+
+ISSUE_TYPES = ["Initiative", "Epic", "Story", "Task", "Sub-task", "Bug"]
+STATUSES = ["To Do", "In Progress", "Blocked", "Resolved", "Closed"]
+RESOLUTIONS = ["Done", "Won't Do", "Duplicate", "Cannot Reproduce"]
+SPONSORS = ["Arm", "Hisilicon", "Qualcomm", "STE", "Linaro"]
+COMPONENTS = ["Build", "Docs", "Kernel", "Security", "Toolchain"]
+
+# Custom fields, with the names Jira knows them by.
+CUSTOM_FIELDS = {
+    "customfield_10005": "Parent Link",
+    "customfield_10011": "Epic Name",
+    "customfield_10014": "Epic Link",
+    "customfield_10020": "Sprint",
+    "customfield_10034": "Share Visibility",
+    "customfield_10101": "Sponsors",
+    "customfield_10104": "Client Stakeholder",
+}
+
+# Transitions available from each status: (transition name, new status).
+WORKFLOW = {
+    "To Do": [("Start Progress", "In Progress"), ("Resolved", "Resolved")],
+    "In Progress": [
+        ("Stop Progress", "To Do"),
+        ("Blocked", "Blocked"),
+        ("Resolved", "Resolved"),
+        ("Closed", "Closed"),
+    ],
+    "Blocked": [("In Progress", "In Progress"), ("Closed", "Closed")],
+    "Resolved": [("Reopen", "To Do"), ("Closed", "Closed")],
+    "Closed": [("Reopen", "To Do")],
+}
+
+
+################################################################################
+# Data set
+################################################################################
+def format_date(d):
+    return d.strftime(DATE_FORMAT)
+
+
+def parse_date(s):
+    return datetime.datetime.strptime(s[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+class Store:
+    """In-memory Jira data: users, groups, projects, issues, boards etc."""
+
+    def __init__(self):
+        self.base_url = BASE_URL
+        self.users = []
+        self.groups = {}
+        self.projects = {}
+        self.issues = collections.OrderedDict()
+        self.boards = []
+        self.sprints = {}
+        self.next_id = 10000
+        self.lock = threading.RLock()
+        # Matching keys of recent JQL queries, dropped on any write.
+        self.query_cache = {}
+
+    def new_id(self):
+        self.next_id += 1
+        return str(self.next_id)
+
+    def ref(self, kind, id):
+        return "%s/rest/api/2/%s/%s" % (self.base_url, kind, id)
+
+    def find_user(self, value):
+        value = str(value).lower()
+        for u in self.users:
+            if value in [
+                u["accountId"].lower(),
+                u["name"].lower(),
+                u["emailAddress"].lower(),
+                u["displayName"].lower(),
+            ]:
+                return u
+        return None
+
+    def resolution(self, name):
+        return {
+            "id": str(RESOLUTIONS.index(name) + 1),
+            "name": name,
+            "self": self.ref("resolution", RESOLUTIONS.index(name) + 1),
+        }
+
+    def status(self, name):
+        category = {"To Do": "To Do", "In Progress": "In Progress"}.get(name, "Done")
+        if name == "Blocked":
+            category = "In Progress"
+        return {
+            "id": str(STATUSES.index(name) + 1),
+            "name": name,
+            "self": self.ref("status", STATUSES.index(name) + 1),
+            "statusCategory": {"name": category, "key": category.lower()},
+        }
+
+    def issuetype(self, name):
+        return {
+            "id": str(ISSUE_TYPES.index(name) + 1),
+            "name": name,
+            "subtask": name == "Sub-task",
+            "self": self.ref("issuetype", ISSUE_TYPES.index(name) + 1),
+        }
+
+    def add_user(self, first, last):
+        name = "%s.%s" % (first, last)
+        user = {
+            "accountId": "acc-%s" % name,
+            "name": name,
+            "key": name,
+            "emailAddress": "%s@linaro.org" % name,
+            "displayName": "%s %s" % (first.title(), last.title()),
+            "active": True,
+            "self": "%s/rest/api/2/user?accountId=acc-%s" % (self.base_url, name),
+        }
+        self.users.append(user)
+        return user
+
+    def add_issue(self, project, issuetype, summary, created, fields=None):
+        with self.lock:
+            self.projects[project]["counter"] += 1
+            key = "%s-%d" % (project, self.projects[project]["counter"])
+            id = self.new_id()
+            issue = {
+                "id": id,
+                "key": key,
+                "self": self.ref("issue", id),
+                "fields": {
+                    "summary": summary,
+                    "description": "Description of %s" % summary,
+                    "issuetype": self.issuetype(issuetype),
+                    "status": self.status("To Do"),
+                    "resolution": None,
+                    "project": self.projects[project]["ref"],
+                    "assignee": None,
+                    "reporter": None,
+                    "created": format_date(created),
+                    "updated": format_date(created),
+                    "components": [],
+                    "labels": [],
+                    "issuelinks": [],
+                    "comment": {
+                        "comments": [],
+                        "maxResults": 0,
+                        "total": 0,
+                        "startAt": 0,
+                    },
+                    "worklog": {"worklogs": [], "maxResults": 0, "total": 0},
+                    "timetracking": {},
+                    "duedate": None,
+                },
+                "changelog": {
+                    "startAt": 0,
+                    "maxResults": 0,
+                    "total": 0,
+                    "histories": [],
+                },
+            }
+            for f in CUSTOM_FIELDS:
+                issue["fields"][f] = None
+            issue["fields"].update(fields or {})
+            self.issues[key] = issue
+            self.query_cache.clear()
+            return issue
+
+    def add_project(self, key):
+        id = self.new_id()
+        self.projects[key] = {
+            "counter": 0,
+            "ref": {
+                "id": id,
+                "key": key,
+                "name": "Project %s" % key,
+                "self": self.ref("project", id),
+            },
+            "components": [
+                {"id": self.new_id(), "name": c, "self": self.ref("component", c)}
+                for c in COMPONENTS
+            ],
+        }
+        board = {
+            "id": len(self.boards) + 1,
+            "name": "%s board" % key,
+            "type": "scrum",
+            "self": "%s/rest/agile/1.0/board/%d"
+            % (self.base_url, len(self.boards) + 1),
+            "location": {"projectKey": key},
+        }
+        self.boards.append(board)
+        self.sprints[board["id"]] = []
+        return self.projects[key]
+
+    def add_sprint(self, board_id, name, state):
+        sprint = {
+            "id": int(self.new_id()),
+            "name": name,
+            "state": state,
+            "originBoardId": board_id,
+            "self": "%s/rest/agile/1.0/sprint/%s" % (self.base_url, name),
+        }
+        self.sprints[board_id].append(sprint)
+        return sprint
+
+    def add_comment(self, issue, author, body, when):
+        comments = issue["fields"]["comment"]
+        comment = {
+            "id": self.new_id(),
+            "self": "%s/comment/%s" % (issue["self"], self.next_id),
+            "author": author,
+            "updateAuthor": author,
+            "body": body,
+            "created": format_date(when),
+            "updated": format_date(when),
+        }
+        comments["comments"].append(comment)
+        comments["total"] = comments["maxResults"] = len(comments["comments"])
+        issue["fields"]["updated"] = max(issue["fields"]["updated"], comment["updated"])
+        return comment
+
+    def add_history(self, issue, author, when, items):
+        histories = issue["changelog"]["histories"]
+        histories.append(
+            {
+                "id": self.new_id(),
+                "author": author,
+                "created": format_date(when),
+                "items": items,
+            }
+        )
+        issue["changelog"]["total"] = issue["changelog"]["maxResults"] = len(histories)
+        issue["fields"]["updated"] = max(issue["fields"]["updated"], format_date(when))
+
+    def set_status(self, issue, status, author, when, resolution=None):
+        old = issue["fields"]["status"]["name"]
+        items = [
+            {
+                "field": "status",
+                "fieldtype": "jira",
+                "fromString": old,
+                "toString": status,
+            }
+        ]
+        issue["fields"]["status"] = self.status(status)
+        if status in ["Resolved", "Closed"]:
+            resolution = resolution or "Done"
+            issue["fields"]["resolution"] = self.resolution(resolution)
+            items.append(
+                {
+                    "field": "resolution",
+                    "fieldtype": "jira",
+                    "fromString": None,
+                    "toString": resolution,
+                }
+            )
+        else:
+            issue["fields"]["resolution"] = None
+        self.add_history(issue, author, when, items)
+
+    def link(self, outward, inward):
+        """Adds an "implements" link, inward is implemented by outward."""
+        link_type = {
+            "id": "10001",
+            "name": "Implements",
+            "inward": "is implemented by",
+            "outward": "implements",
+        }
+        short = lambda i: {
+            "id": i["id"],
+            "key": i["key"],
+            "self": i["self"],
+            "fields": {
+                "summary": i["fields"]["summary"],
+                "status": i["fields"]["status"],
+                "issuetype": i["fields"]["issuetype"],
+            },
+        }
+        id = self.new_id()
+        outward["fields"]["issuelinks"].append(
+            {
+                "id": id,
+                "self": self.ref("issueLink", id),
+                "type": link_type,
+                "inwardIssue": short(inward),
+            }
+        )
+        inward["fields"]["issuelinks"].append(
+            {
+                "id": id,
+                "self": self.ref("issueLink", id),
+                "type": link_type,
+                "outwardIssue": short(outward),
+            }
+        )
+
+
+def generate(
+    projects=["SWG"],
+    initiatives=10,
+    epics=5,
+    stories=5,
+    comments=2,
+    changes=2,
+    users=20,
+    teams=3,
+    orphans=0.05,
+    days=60,
+    seed=1,
+):
+    """
+    Generates a data set with, for each project, a number of initiatives each
+    implemented by a number of epics each implemented by a number of stories.
+    Issues get comments and changelog entries spread over the last days, and a
+    share of the epics and stories (orphans) are only linked by the "Parent
+    Link" field or not at all.
+    """
+    rnd = random.Random(seed)
+    store = Store()
+    now = datetime.datetime.utcnow()
+
+    names = [(f, l) for l in LAST_NAMES for f in FIRST_NAMES]
+    for i in range(users):
+        first, last = names[i % len(names)]
+        if i >= len(names):
+            last = "%s%d" % (last, i // len(names))
+        store.add_user(first, last)
+    for t in range(teams):
+        store.groups["team-%d" % t] = store.users[t::teams]
+
+    def random_date(start):
+        return start + (now - start) * rnd.random()
+
+    def populate(issue, parent=None):
+        created = parse_date(issue["fields"]["created"])
+        f = issue["fields"]
+        f["assignee"] = rnd.choice(store.users + [None])
+        f["reporter"] = rnd.choice(store.users)
+        f["components"] = rnd.sample(
+            store.projects[f["project"]["key"]]["components"], 1
+        )
+        f["timetracking"] = {"originalEstimate": "%dd" % rnd.randint(1, 10)}
+        f["customfield_10101"] = [
+            {"value": s, "id": str(SPONSORS.index(s)), "self": store.ref("option", s)}
+            for s in rnd.sample(SPONSORS, rnd.randint(0, 2))
+        ]
+        if parent is not None:
+            f["customfield_10005"] = parent["key"]
+            if f["issuetype"]["name"] == "Story":
+                f["customfield_10014"] = parent["key"]
+        for _ in range(changes):
+            status = rnd.choice(STATUSES)
+            if status != f["status"]["name"]:
+                store.set_status(
+                    issue, status, rnd.choice(store.users), random_date(created)
+                )
+        for n in range(comments):
+            when = random_date(created)
+            store.add_comment(
+                issue,
+                rnd.choice(store.users),
+                "Update %d on %s" % (n, issue["key"]),
+                when,
+            )
+
+    for key in projects:
+        store.add_project(key)
+        board = store.boards[-1]
+        sprints = [
+            store.add_sprint(board["id"], "%s Sprint %d" % (key, s), state)
+            for s, state in enumerate(["closed", "closed", "active", "future"])
+        ]
+        for i in range(initiatives):
+            start = now - datetime.timedelta(days=days)
+            initiative = store.add_issue(
+                key, "Initiative", "Initiative %d" % i, random_date(start)
+            )
+            populate(initiative)
+            for e in range(epics):
+                epic = store.add_issue(
+                    key,
+                    "Epic",
+                    "Epic %d.%d" % (i, e),
+                    parse_date(initiative["fields"]["created"]),
+                    {"customfield_10011": "Epic %d.%d" % (i, e)},
+                )
+                populate(epic, initiative)
+                if rnd.random() >= orphans:
+                    store.link(initiative, epic)
+                for s in range(stories):
+                    story = store.add_issue(
+                        key,
+                        rnd.choice(["Story", "Story", "Task", "Bug"]),
+                        "Story %d.%d.%d" % (i, e, s),
+                        parse_date(epic["fields"]["created"]),
+                        {"customfield_10020": [rnd.choice(sprints)]},
+                    )
+                    populate(story, epic)
+                    if rnd.random() >= orphans:
+                        store.link(epic, story)
+    return store
+
+
+################################################################################
+# HTTP server
+################################################################################
+class FakeJira(ThreadingHTTPServer):
+    """The fake Jira server, see RequestHandler for the served endpoints."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        store,
+        latency=0.0,
+        jitter=0.0,
+        tail_ratio=0.0,
+        tail_factor=10.0,
+        throttle_ratio=0.0,
+        rate_limit=0,
+        retry_after=1,
+        max_results=1000,
+        deployment="Server",
+    ):
+        super().__init__(address, RequestHandler)
+        self.store = store
+        self.url = "http://%s:%d" % self.server_address[:2]
+        self.latency = latency
+        self.jitter = jitter
+        self.tail_ratio = tail_ratio
+        self.tail_factor = tail_factor
+        self.throttle_ratio = throttle_ratio
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.max_results = max_results
+        self.deployment = deployment
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.tokens = float(rate_limit)
+        self.refilled = time.monotonic()
+        self.stats = collections.Counter()
+        self.bytes_sent = 0
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats.clear()
+            self.bytes_sent = 0
+
+    def delay(self):
+        """Returns how long to wait before answering a request."""
+        if not self.latency:
+            return 0
+        with self.lock:
+            d = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            if self.random.random() < self.tail_ratio:
+                d *= self.tail_factor
+        return max(0, d)
+
+    def throttled(self):
+        """Decides whether a request should get a 429 response."""
+        with self.lock:
+            if self.throttle_ratio and self.random.random() < self.throttle_ratio:
+                return True
+            if not self.rate_limit:
+                return False
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate_limit, self.tokens + (now - self.refilled) * self.rate_limit
+            )
+            self.refilled = now
+            if self.tokens < 1:
+                return True
+            self.tokens -= 1
+            return False
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't let Nagle delay the body.
+    disable_nagle_algorithm = True
+
+    ROUTES = [
+        ("GET", r"/rest/api/2/serverInfo", "server_info"),
+        ("GET", r"/rest/api/2/myself", "myself"),
+        ("GET", r"/rest/api/2/search", "search"),
+        ("POST", r"/rest/api/2/search", "search"),
+        ("GET", r"/rest/api/2/search/jql", "search_jql"),
+        ("POST", r"/rest/api/2/search/jql", "search_jql"),
+        ("GET", r"/rest/api/2/issue/createmeta", "createmeta"),
+        ("POST", r"/rest/api/2/issue", "create_issue"),
+        ("GET", r"/rest/api/2/issue/(?P<key>[^/]+)", "get_issue"),
+        ("PUT", r"/rest/api/2/issue/(?P<key>[^/]+)", "update_issue"),
+        ("GET", r"/rest/api/2/issue/(?P<key>[^/]+)/comment", "get_comments"),
+        ("POST", r"/rest/api/2/issue/(?P<key>[^/]+)/comment", "add_comment"),
+        ("GET", r"/rest/api/2/issue/(?P<key>[^/]+)/transitions", "get_transitions"),
+        ("POST", r"/rest/api/2/issue/(?P<key>[^/]+)/transitions", "do_transition"),
+        ("POST", r"/rest/api/2/issue/(?P<key>[^/]+)/worklog", "add_worklog"),
+        ("GET", r"/rest/api/2/resolution", "resolutions"),
+        ("GET", r"/rest/api/2/status", "statuses"),
+        ("GET", r"/rest/api/2/issuetype", "issuetypes"),
+        ("GET", r"/rest/api/2/field", "fields"),
+        ("GET", r"/rest/api/2/project/(?P<key>[^/]+)/components", "components"),
+        ("GET", r"/rest/api/2/user/search", "search_users"),
+        ("GET", r"/rest/api/2/user/assignable/search", "search_users"),
+        ("GET", r"/rest/api/2/user/assignable/multiProjectSearch", "search_users"),
+        ("GET", r"/rest/api/2/group", "group"),
+        ("GET", r"/rest/api/2/group/member", "group_members"),
+        ("GET", r"/rest/agile/1.0/board", "boards"),
+        ("GET", r"/rest/agile/1.0/board/(?P<id>\d+)/sprint", "sprints"),
+        ("GET", r"/fake/stats", "fake_stats"),
+    ]
+
+    ROUTES = [(m, re.compile(p + "$"), h) for m, p, h in ROUTES]
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        self.query = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            self.body = json.loads(body) if body else {}
+        except ValueError:
+            self.body = {}
+        self.user = self.authenticated_user()
+
+        for m, regex, handler in self.ROUTES:
+            match = regex.match(url.path)
+            if m == method and match:
+                break
+        else:
+            self.server.stats[(method, "unknown")] += 1
+            return self.reply(404, {"errorMessages": ["Not found: %s" % url.path]})
+
+        self.server.stats[(method, regex.pattern.rstrip("$"))] += 1
+        delay = self.server.delay()
+        if delay:
+            time.sleep(delay)
+        if not handler.startswith("fake_") and self.server.throttled():
+            return self.reply(
+                429,
+                {"errorMessages": ["Rate limit exceeded"]},
+                {"Retry-After": str(self.server.retry_after)},
+            )
+        try:
+            params = dict((k, unquote(v)) for k, v in match.groupdict().items())
+            status, data = getattr(self, handler)(**params)
+        except JqlError as e:
+            status, data = 400, {"errorMessages": [str(e)], "errors": {}}
+        except KeyError as e:
+            status, data = 404, {"errorMessages": ["Does not exist: %s" % e]}
+        self.reply(status, data)
+
+    def reply(self, status, data, headers={}):
+        body = b""
+        if data is not None:
+            body = json.dumps(data).replace(BASE_URL, self.server.url).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+
+    def param(self, name, default=None):
+        if name in self.body:
+            return self.body[name]
+        if name in self.query:
+            return self.query[name][0]
+        return default
+
+    def param_list(self, name):
+        values = self.body.get(name) or self.query.get(name) or []
+        if isinstance(values, str):
+            values = [values]
+        return [v.strip() for value in values for v in value.split(",") if v.strip()]
+
+    def authenticated_user(self):
+        store = self.server.store
+        auth = self.headers.get("Authorization", "")
+        if auth.startswith("Basic "):
+            username = base64.b64decode(auth[6:]).decode("utf-8").split(":")[0]
+            user = store.find_user(username)
+            if user is None:
+                with store.lock:
+                    first, _, last = username.split("@")[0].partition(".")
+                    user = store.add_user(first or "user", last or "x")
+            return user
+        return store.users[0] if store.users else None
+
+    ############################################################################
+    # Projection
+    ############################################################################
+    def project_issue(self, issue, fields, expand):
+        """Returns the issue with only the requested fields."""
+        wanted = set(fields) if fields else set(["*all"])
+        result = {
+            "id": issue["id"],
+            "key": issue["key"],
+            "self": issue["self"],
+            "expand": "renderedFields,names,schema,transitions,changelog",
+        }
+        if "*all" in wanted or "*navigable" in wanted:
+            names = set(issue["fields"])
+        else:
+            names = wanted
+        names = set(n for n in names if not n.startswith("-"))
+        names -= set(n[1:] for n in wanted if n.startswith("-"))
+        result["fields"] = dict(
+            (n, issue["fields"][n]) for n in names if n in issue["fields"]
+        )
+        if "changelog" in expand:
+            result["changelog"] = issue["changelog"]
+        return result
+
+    def search_keys(self, jql):
+        store = self.server.store
+        cache_key = (jql, self.user["accountId"] if self.user else None)
+        with store.lock:
+            keys = store.query_cache.get(cache_key)
+            if keys is None:
+                parser = JqlParser(
+                    self.user["accountId"] if self.user else None,
+                    lambda group: [
+                        u["accountId"] for u in store.groups.get(group.lower(), [])
+                    ],
+                )
+                predicate = parser.compile(jql)
+                issues = parser.sort(i for i in store.issues.values() if predicate(i))
+                keys = [i["key"] for i in issues]
+                store.query_cache[cache_key] = keys
+        return keys
+
+    ############################################################################
+    # Handlers, each of them returns (status, data)
+    ############################################################################
+    def server_info(self):
+        return 200, {
+            "baseUrl": self.server.url,
+            "version": "8.20.0",
+            "versionNumbers": [8, 20, 0],
+            "deploymentType": self.server.deployment,
+            "serverTitle": "Fake Jira",
+        }
+
+    def myself(self):
+        return 200, self.user
+
+    def search(self):
+        store = self.server.store
+        keys = self.search_keys(self.param("jql", ""))
+        start = int(self.param("startAt", 0))
+        max_results = min(int(self.param("maxResults", 50)), self.server.max_results)
+        fields = self.param_list("fields")
+        expand = self.param_list("expand")
+        issues = [
+            self.project_issue(store.issues[k], fields, expand)
+            for k in keys[start : start + max_results]
+        ]
+        return 200, {
+            "startAt": start,
+            "maxResults": max_results,
+            "total": len(keys),
+            "issues": issues,
+        }
+
+    def search_jql(self):
+        store = self.server.store
+        keys = self.search_keys(self.param("jql", ""))
+        start = int(self.param("nextPageToken", 0) or 0)
+        max_results = min(int(self.param("maxResults", 50)), self.server.max_results)
+        fields = self.param_list("fields")
+        expand = self.param_list("expand")
+        issues = [
+            self.project_issue(store.issues[k], fields, expand)
+            for k in keys[start : start + max_results]
+        ]
+        data = {"issues": issues, "isLast": start + max_results >= len(keys)}
+        if not data["isLast"]:
+            data["nextPageToken"] = str(start + max_results)
+        return 200, data
+
+    def get_issue(self, key):
+        issue = self.find_issue(key)
+        return 200, self.project_issue(
+            issue, self.param_list("fields"), self.param_list("expand")
+        )
+
+    def find_issue(self, key):
+        store = self.server.store
+        if key in store.issues:
+            return store.issues[key]
+        for issue in store.issues.values():
+            if issue["id"] == key:
+                return issue
+        raise KeyError(key)
+
+    def create_issue(self):
+        store = self.server.store
+        fields = dict(self.body.get("fields", {}))
+        project = fields.pop("project", {}).get("key")
+        issuetype = fields.pop("issuetype", {}).get("name", "Story")
+        if project not in store.projects:
+            return 400, {"errors": {"project": "valid project is required"}}
+        summary = fields.pop("summary", "")
+        issue = store.add_issue(
+            project, issuetype, summary, datetime.datetime.utcnow(), fields
+        )
+        return 201, {"id": issue["id"], "key": issue["key"], "self": issue["self"]}
+
+    def update_issue(self, key):
+        store = self.server.store
+        issue = self.find_issue(key)
+        with store.lock:
+            issue["fields"].update(self.body.get("fields", {}))
+            issue["fields"]["updated"] = format_date(datetime.datetime.utcnow())
+            store.query_cache.clear()
+        return 204, None
+
+    def get_comments(self, key):
+        comments = self.find_issue(key)["fields"]["comment"]
+        return 200, {
+            "comments": comments["comments"],
+            "startAt": 0,
+            "maxResults": len(comments["comments"]),
+            "total": len(comments["comments"]),
+        }
+
+    def add_comment(self, key):
+        store = self.server.store
+        issue = self.find_issue(key)
+        with store.lock:
+            comment = store.add_comment(
+                issue, self.user, self.body.get("body", ""), datetime.datetime.utcnow()
+            )
+            store.query_cache.clear()
+        return 201, comment
+
+    def transitions(self, issue):
+        status = issue["fields"]["status"]["name"]
+        return [
+            {
+                "id": str(11 + i),
+                "name": name,
+                "to": self.server.store.status(to),
+                "fields": {},
+            }
+            for i, (name, to) in enumerate(WORKFLOW[status])
+        ]
+
+    def get_transitions(self, key):
+        return 200, {"transitions": self.transitions(self.find_issue(key))}
+
+    def do_transition(self, key):
+        store = self.server.store
+        issue = self.find_issue(key)
+        wanted = str(self.body.get("transition", {}).get("id"))
+        for t in self.transitions(issue):
+            if t["id"] == wanted:
+                break
+        else:
+            return 400, {"errorMessages": ["Transition %s is not valid" % wanted]}
+
+        resolution = None
+        resolution_id = (
+            self.body.get("fields", {}).get("resolution", {}).get("id")
+            if self.body.get("fields")
+            else None
+        )
+        if resolution_id is not None:
+            resolution = RESOLUTIONS[int(resolution_id) - 1]
+        with store.lock:
+            store.set_status(
+                issue,
+                t["to"]["name"],
+                self.user,
+                datetime.datetime.utcnow(),
+                resolution,
+            )
+            store.query_cache.clear()
+        return 204, None
+
+    def add_worklog(self, key):
+        store = self.server.store
+        issue = self.find_issue(key)
+        worklog = {
+            "id": store.new_id(),
+            "author": self.user,
+            "timeSpent": self.body.get("timeSpent"),
+            "comment": self.body.get("comment"),
+            "started": format_date(datetime.datetime.utcnow()),
+        }
+        with store.lock:
+            issue["fields"]["worklog"]["worklogs"].append(worklog)
+            issue["fields"]["worklog"]["total"] += 1
+        return 201, worklog
+
+    def resolutions(self):
+        store = self.server.store
+        return 200, [store.resolution(r) for r in RESOLUTIONS]
+
+    def statuses(self):
+        store = self.server.store
+        return 200, [store.status(s) for s in STATUSES]
+
+    def issuetypes(self):
+        store = self.server.store
+        return 200, [store.issuetype(t) for t in ISSUE_TYPES]
+
+    def fields(self):
+        store = self.server.store
+        sample = next(iter(store.issues.values()), {"fields": {}})
+        fields = [
+            {
+                "id": f,
+                "key": f,
+                "name": CUSTOM_FIELDS.get(f, f.title()),
+                "custom": f in CUSTOM_FIELDS,
+                "navigable": True,
+                "searchable": True,
+                "clauseNames": [f],
+            }
+            for f in sorted(set(sample["fields"]) | set(CUSTOM_FIELDS))
+        ]
+        return 200, fields
+
+    def createmeta(self):
+        store = self.server.store
+        projects = []
+        for key in self.param_list("projectKeys"):
+            if key not in store.projects:
+                continue
+            names = self.param_list("issuetypeNames") or ISSUE_TYPES
+            issuetypes = []
+            for name in names:
+                if name not in ISSUE_TYPES:
+                    continue
+                fields = dict(
+                    (
+                        f,
+                        {
+                            "required": f in ["project", "issuetype", "summary"],
+                            "hasDefaultValue": False,
+                            "name": CUSTOM_FIELDS.get(f, f.title()),
+                        },
+                    )
+                    for f in list(next(iter(store.issues.values()))["fields"])
+                    + list(CUSTOM_FIELDS)
+                    if f
+                    not in ["comment", "issuelinks", "status", "created", "updated"]
+                )
+                fields["customfield_10104"]["allowedValues"] = [
+                    {"self": store.ref("option", s), "value": s, "id": i}
+                    for i, s in enumerate(SPONSORS)
+                ]
+                if name != "Epic":
+                    del fields["customfield_10011"]
+                issuetypes.append(dict(store.issuetype(name), fields=fields))
+            projects.append(dict(store.projects[key]["ref"], issuetypes=issuetypes))
+        return 200, {"projects": projects}
+
+    def components(self, key):
+        return 200, self.server.store.projects[key]["components"]
+
+    def search_users(self):
+        store = self.server.store
+        query = (
+            self.param("query")
+            or self.param("username")
+            or self.param("accountId")
+            or ""
+        ).lower()
+        users = [
+            u
+            for u in store.users
+            if query
+            and (
+                query in u["emailAddress"].lower()
+                or query in u["displayName"].lower()
+                or query == u["accountId"].lower()
+            )
+        ]
+        start = int(self.param("startAt", 0))
+        return 200, users[start : start + int(self.param("maxResults", 50))]
+
+    def group(self):
+        return self.group_members()
+
+    def group_members(self):
+        name = (self.param("groupname") or "").lower()
+        members = self.server.store.groups[name]
+        return 200, {
+            "name": name,
+            "users": {
+                "size": len(members),
+                "items": members,
+                "max-results": len(members),
+                "start-index": 0,
+                "end-index": len(members) - 1,
+            },
+            "values": members,
+            "startAt": 0,
+            "maxResults": len(members),
+            "total": len(members),
+            "isLast": True,
+        }
+
+    def boards(self):
+        store = self.server.store
+        key = self.param("projectKeyOrId")
+        boards = [b for b in store.boards if key in [None, b["location"]["projectKey"]]]
+        return 200, self.page(boards)
+
+    def sprints(self, id):
+        return 200, self.page(self.server.store.sprints[int(id)])
+
+    def page(self, values):
+        start = int(self.param("startAt", 0))
+        max_results = int(self.param("maxResults", 50))
+        return {
+            "maxResults": max_results,
+            "startAt": start,
+            "total": len(values),
+            "isLast": start + max_results >= len(values),
+            "values": values[start : start + max_results],
+        }
+
+    def fake_stats(self):
+        return 200, {
+            "requests": dict(
+                ("%s %s" % k, v) for k, v in sorted(self.server.stats.items())
+            ),
+            "bytes": self.server.bytes_sent,
+        }
+
+
+def start_server(store, host="127.0.0.1", port=0, **kwargs):
+    """Starts a fake Jira server in a background thread and returns it, use
+    server.url to reach it and server.shutdown() to stop it."""
+    server = FakeJira((host, port), store, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+################################################################################
+# Argument parser
+################################################################################
+def get_parser():
+    """Takes care of script argument parsing."""
+    parser = ArgumentParser(description="Local fake Jira server for testing jipdate")
+
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument(
+        "--project",
+        action="append",
+        default=None,
+        help="Project key to generate, can be given several times (default SWG)",
+    )
+    parser.add_argument(
+        "--initiatives", type=int, default=10, help="Initiatives per project"
+    )
+    parser.add_argument("--epics", type=int, default=5, help="Epics per initiative")
+    parser.add_argument("--stories", type=int, default=5, help="Stories per epic")
+    parser.add_argument("--comments", type=int, default=2, help="Comments per issue")
+    parser.add_argument(
+        "--changes", type=int, default=2, help="Status changes per issue"
+    )
+    parser.add_argument("--users", type=int, default=20, help="Number of users")
+    parser.add_argument("--teams", type=int, default=3, help="Number of groups")
+    parser.add_argument(
+        "--orphans",
+        type=float,
+        default=0.05,
+        help="Share of epics and stories not linked to their parent",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Latency (ms) added to each request"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0, help="Random +/- variation of the latency"
+    )
+    parser.add_argument(
+        "--tail-ratio",
+        type=float,
+        default=0,
+        help="Share of requests that are --tail-factor times slower",
+    )
+    parser.add_argument("--tail-factor", type=float, default=10)
+    parser.add_argument(
+        "--throttle-ratio",
+        type=float,
+        default=0,
+        help="Share of requests randomly answered with 429",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        help="Answer 429 above this many requests per second",
+    )
+    parser.add_argument(
+        "--retry-after", type=int, default=1, help="Retry-After sent with 429"
+    )
+    parser.add_argument(
+        "--deployment",
+        choices=["Server", "Cloud"],
+        default="Server",
+        help="Deployment type reported by serverInfo",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        default=False,
+        help="Log every request",
+    )
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    log.basicConfig(level=log.DEBUG if args.verbose else log.INFO)
+
+    start = time.time()
+    store = generate(
+        projects=args.project or ["SWG"],
+        initiatives=args.initiatives,
+        epics=args.epics,
+        stories=args.stories,
+        comments=args.comments,
+        changes=args.changes,
+        users=args.users,
+        teams=args.teams,
+        orphans=args.orphans,
+        seed=args.seed,
+    )
+    log.info("Generated %d issues in %.1f s" % (len(store.issues), time.time() - start))
+
+    server = FakeJira(
+        (args.host, args.port),
+        store,
+        latency=args.latency / 1000.0,
+        jitter=args.jitter / 1000.0,
+        tail_ratio=args.tail_ratio,
+        tail_factor=args.tail_factor,
+        throttle_ratio=args.throttle_ratio,
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+        deployment=args.deployment,
+    )
+    log.info("Fake Jira listening on %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
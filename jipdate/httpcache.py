@@ -0,0 +1,519 @@
+"""
+On-disk cache of the responses of the Jira server.
+
+Idempotent requests for data that rarely changes (resolutions, statuses,
+createmeta, components, boards, sprints, users, transitions, ...) are answered
+from a SQLite file in the cache directory, for as long as the TTL of their
+endpoint class allows. The file is bounded in size, the least recently used
+responses are dropped first. Any write we send (comment, transition, create,
+update) drops the cached responses of the issues it touches.
+
+The cache is disabled unless enabled in the "http_cache" section of the config
+file.
+
+Within a run, the IdentityMap also makes sure that an issue is only fetched
+once, and that identical requests sent at the same time are only sent once.
+"""
+
+import collections
+import hashlib
+import logging as log
+import re
+import threading
+import time
+
+# Local files
+from jipdate import cfg
+from jipdate import jsonlib
+from jipdate import trace
+
+# Default settings, each of them can be overridden in the "http_cache" section
+# of the config file. TTLs are in seconds, 0 means never cached.
+DEFAULT_HTTP_CACHE = {
+    "enabled": False,
+    "max_size": 64 * 1024 * 1024,
+    "metadata_ttl": 3600,
+    "users_ttl": 3600,
+    "transitions_ttl": 600,
+    "issues_ttl": 0,
+}
+
+# Issues are addressed by key or, e.g. by the self links of the resources, by
+# id.
+REGEX_ISSUE = re.compile(
+    r"/rest/api/[^/]+/issue/([A-Z][A-Z0-9_]*-[0-9]+|[0-9]+)(?=/|$)"
+)
+REGEX_TRANSITIONS = re.compile(r"/rest/api/[^/]+/issue/[^/]+/transitions$")
+REGEX_USERS = re.compile(r"/rest/api/[^/]+/(user|group|groupuserpicker)\b")
+REGEX_METADATA = re.compile(
+    r"/rest/(api/[^/]+/(serverInfo|resolution|status|issuetype|field|priority|"
+    r"project|issue/createmeta)|agile/)"
+)
+
+# Issue keys mentioned in the body of a write request (parent, epic link, ...).
+REGEX_KEY = re.compile(r"\b[A-Z][A-Z0-9_]*-[0-9]+\b")
+
+# Id and key of an issue, at the top of its JSON.
+REGEX_ISSUE_ID = re.compile(rb'"id"\s*:\s*"([0-9]+)"')
+REGEX_ISSUE_KEY = re.compile(rb'"key"\s*:\s*"([A-Z][A-Z0-9_]*-[0-9]+)"')
+
+# Cache classes of the responses about an issue.
+ISSUE_CLASSES = ["issues", "transitions"]
+
+# Bytes of responses kept by a MemoryCache.
+MEMORY_CACHE_SIZE = 256 * 1024 * 1024
+
+# Headers describing the encoding of the original response, the cached body is
+# already decoded.
+DROPPED_HEADERS = ["content-encoding", "content-length", "transfer-encoding"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    class TEXT,
+    url TEXT,
+    issue TEXT,
+    stored REAL,
+    used REAL,
+    size INTEGER,
+    status INTEGER,
+    reason TEXT,
+    headers TEXT,
+    body BLOB
+);
+CREATE INDEX IF NOT EXISTS responses_issue ON responses (issue);
+CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+"""
+
+
+def get_http_cache_config():
+    config = dict(DEFAULT_HTTP_CACHE)
+    config.update(cfg.get_option("http_cache") or {})
+    return config
+
+
+def get_cache_class(method, path):
+    """Returns the cache class of a request, or None if it can't be cached."""
+    if method != "GET":
+        return None
+    if REGEX_METADATA.search(path):
+        return "metadata"
+    if REGEX_USERS.search(path):
+        return "users"
+    if REGEX_TRANSITIONS.search(path):
+        return "transitions"
+    if REGEX_ISSUE.search(path):
+        return "issues"
+    return None
+
+
+def get_touched_issues(request):
+    """Returns the keys (or ids) of the issues a write request may change."""
+    from urllib.parse import urlsplit
+
+    keys = set(REGEX_ISSUE.findall(urlsplit(request.url).path))
+    body = request.body or b""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    keys.update(REGEX_KEY.findall(body))
+    return keys
+
+
+class IssueIds:
+    """
+    The ids and keys of the issues seen in responses, so that a write to
+    /issue/<id> drops the responses of /issue/<key> and conversely. A cache
+    dropping the responses of issues it can't resolve must drop the responses
+    of all the issues.
+    """
+
+    def __init__(self):
+        self.aliases = {}
+        self.lock = threading.Lock()
+
+    def learn(self, path, body):
+        """Learns the id and key of the issue returned by GET path."""
+        m = REGEX_ISSUE.search(path)
+        if m is None or m.end() != len(path):
+            # Not the issue itself (comments, transitions, ...).
+            return
+        # The top-level id and key come before the fields.
+        head = body.split(b'"fields"', 1)[0]
+        issue_id = REGEX_ISSUE_ID.search(head)
+        issue_key = REGEX_ISSUE_KEY.search(head)
+        if issue_id and issue_key:
+            issue_id = issue_id.group(1).decode()
+            issue_key = issue_key.group(1).decode()
+            with self.lock:
+                self.aliases[issue_id] = issue_key
+                self.aliases[issue_key] = issue_id
+
+    def resolve(self, issues):
+        """Returns the keys and ids of issues, and whether all the ids among
+        them are known."""
+        resolved = set(issues)
+        complete = True
+        with self.lock:
+            for issue in issues:
+                alias = self.aliases.get(issue)
+                if alias is not None:
+                    resolved.add(alias)
+                elif issue.isdigit():
+                    complete = False
+        return resolved, complete
+
+
+def get_key(request):
+    """Returns the cache key of a request. Responses depend on who asks, hence
+    the credentials are part of the key."""
+    auth = request.headers.get("Authorization") or ""
+    digest = hashlib.sha1(auth.encode("utf-8")).hexdigest()[:16]
+    return "%s %s %s" % (digest, request.method, request.url)
+
+
+def get_headers(response):
+    """Returns the headers of a response to keep with its decoded body."""
+    return dict(
+        (k, v) for k, v in response.headers.items() if k.lower() not in DROPPED_HEADERS
+    )
+
+
+def get_cache_file(url):
+    """Returns the SQLite file caching the responses of the server at url."""
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return cfg.get_cache_file("http-%s.sqlite" % digest)
+
+
+class ResponseCache:
+    """The SQLite file holding the cached responses of a server."""
+
+    def __init__(self, filename, config):
+        import sqlite3
+
+        self.config = config
+        self.db = sqlite3.connect(filename, timeout=10, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.ids = IssueIds()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "invalidated": 0}
+
+    def get_ttl(self, cache_class):
+        return self.config.get("%s_ttl" % cache_class) or 0
+
+    def get(self, request):
+        """Returns the cached response to a request, or None."""
+        from urllib.parse import urlsplit
+
+        cache_class = get_cache_class(request.method, urlsplit(request.url).path)
+        if cache_class is None or self.get_ttl(cache_class) <= 0:
+            return None
+
+        key = get_key(request)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT stored, status, reason, headers, body FROM responses "
+                "WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None or now - row[0] > self.get_ttl(cache_class):
+                self.stats["misses"] += 1
+                return None
+            with self.db:
+                self.db.execute(
+                    "UPDATE responses SET used = ? WHERE key = ?", (now, key)
+                )
+            self.stats["hits"] += 1
+        log.debug("Cached: %s %s" % (request.method, request.url))
+        return build_response(request, row[1], row[2], jsonlib.loads(row[3]), row[4])
+
+    def update(self, request, response, stream=False):
+        """Stores the response to a cacheable request, or drops the cached
+        responses of the issues changed by a write request."""
+        from urllib.parse import urlsplit
+
+        if request.method not in ["GET", "HEAD", "OPTIONS"]:
+            self.invalidate(get_touched_issues(request))
+            return
+
+        path = urlsplit(request.url).path
+        cache_class = get_cache_class(request.method, path)
+        if (
+            cache_class is None
+            or self.get_ttl(cache_class) <= 0
+            or stream
+            or response.status_code != 200
+        ):
+            return
+
+        m = REGEX_ISSUE.search(path)
+        headers = get_headers(response)
+        body = response.content or b""
+        if cache_class == "issues":
+            self.ids.learn(path, body)
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    get_key(request),
+                    cache_class,
+                    request.url,
+                    m.group(1) if m else None,
+                    now,
+                    now,
+                    len(body),
+                    response.status_code,
+                    response.reason,
+                    jsonlib.dumps(headers),
+                    body,
+                ),
+            )
+            self.stats["stored"] += 1
+            self.evict()
+
+    def invalidate(self, keys):
+        """Drops the cached responses of issues."""
+        if not keys:
+            return
+        keys, complete = self.ids.resolve(keys)
+        keys = sorted(keys)
+        if complete:
+            query = "DELETE FROM responses WHERE issue IN (%s)" % ",".join(
+                "?" * len(keys)
+            )
+            params = keys
+        else:
+            query = "DELETE FROM responses WHERE class IN (%s)" % ",".join(
+                "?" * len(ISSUE_CLASSES)
+            )
+            params = ISSUE_CLASSES
+        with self.lock, self.db:
+            cursor = self.db.execute(query, params)
+            self.stats["invalidated"] += cursor.rowcount
+        log.debug(
+            "Dropped the cached responses of %s"
+            % (", ".join(keys) if complete else "all the issues")
+        )
+
+    def evict(self):
+        """Drops the least recently used responses until the cache fits in
+        max_size bytes, the lock must be held."""
+        total = self.db.execute("SELECT SUM(size) FROM responses").fetchone()[0] or 0
+        excess = total - self.config["max_size"]
+        if excess <= 0:
+            return
+        keys = []
+        for key, size in self.db.execute(
+            "SELECT key, size FROM responses ORDER BY used"
+        ):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.db.executemany("DELETE FROM responses WHERE key = ?", keys)
+        log.debug("Evicted %d responses from the HTTP cache" % len(keys))
+
+    def close(self):
+        log.debug("HTTP cache: %s" % self.stats)
+        self.db.close()
+
+
+class MemoryCache:
+    """
+    In memory cache of all the successful GET responses (searches included), in
+    front of the response cache of the server if there is one. It is used while
+    the steps of jipbatch share a session, so that what several steps ask for
+    is only fetched once. Any write drops all the cached responses.
+    """
+
+    def __init__(self, cache=None, max_size=MEMORY_CACHE_SIZE):
+        self.cache = cache
+        self.max_size = max_size
+        self.size = 0
+        self.responses = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "invalidated": 0}
+
+    def get(self, request):
+        """Returns the cached response to a request, or None."""
+        key = get_key(request)
+        with self.lock:
+            cached = self.responses.get(key)
+            if cached is not None:
+                self.responses.move_to_end(key)
+                self.stats["hits"] += 1
+            else:
+                self.stats["misses"] += 1
+        if cached is not None:
+            log.debug("Cached: %s %s" % (request.method, request.url))
+            return build_response(request, *cached)
+        if self.cache is not None:
+            return self.cache.get(request)
+        return None
+
+    def update(self, request, response, stream=False):
+        """Stores the response to a GET request, or drops everything after a
+        write request."""
+        if self.cache is not None:
+            self.cache.update(request, response, stream)
+
+        if request.method not in ["GET", "HEAD", "OPTIONS"]:
+            with self.lock:
+                self.stats["invalidated"] += len(self.responses)
+                self.responses.clear()
+                self.size = 0
+            return
+        if request.method != "GET" or stream or response.status_code != 200:
+            return
+
+        key = get_key(request)
+        body = response.content or b""
+        cached = (response.status_code, response.reason, get_headers(response), body)
+        with self.lock:
+            previous = self.responses.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[3])
+            self.responses[key] = cached
+            self.size += len(body)
+            self.stats["stored"] += 1
+            while self.size > self.max_size:
+                _, evicted = self.responses.popitem(last=False)
+                self.size -= len(evicted[3])
+
+    def close(self):
+        log.debug("Memory cache: %s" % self.stats)
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+
+class Call:
+    """A GET request being sent, identical requests wait for its response."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+
+class IdentityMap:
+    """
+    Per run memo of the requests sent to a server. The responses of the issues
+    (including their comments) and of their transitions are kept for the rest
+    of the run, so that an issue is fetched once however many times the
+    commands ask for it, and a GET sent while the same one is in flight waits
+    for its response instead of being sent again. A write drops the responses
+    of the issues it touches.
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.calls = {}
+        self.ids = IssueIds()
+        self.lock = threading.Lock()
+        self.stats = {"memoized": 0, "coalesced": 0, "invalidated": 0}
+
+    def send(self, request, send, **kwargs):
+        """Returns the response to request, sent with send(request, **kwargs)
+        unless it is memoized or in flight."""
+        from urllib.parse import urlsplit
+
+        if request.method != "GET" or kwargs.get("stream"):
+            response = send(request, **kwargs)
+            if request.method not in ["GET", "HEAD", "OPTIONS"]:
+                self.invalidate(get_touched_issues(request))
+            return response
+
+        key = get_key(request)
+        with self.lock:
+            memoized = self.responses.get(key)
+            call = self.calls.get(key)
+            if memoized is not None:
+                kind = "memoized"
+            elif call is not None:
+                kind = "coalesced"
+            else:
+                call = self.calls[key] = Call()
+                kind = None
+            if kind is not None:
+                self.stats[kind] += 1
+
+        if kind == "memoized":
+            trace.record_saved(request, kind)
+            return build_response(request, *memoized[1:])
+        if kind == "coalesced":
+            call.done.wait()
+            if call.response is None:
+                # It failed, try again.
+                return send(request, **kwargs)
+            trace.record_saved(request, kind)
+            return build_response(request, *call.response)
+
+        try:
+            response = send(request, **kwargs)
+            if response.status_code == 200:
+                call.response = (
+                    response.status_code,
+                    response.reason,
+                    get_headers(response),
+                    response.content or b"",
+                )
+                path = urlsplit(request.url).path
+                m = REGEX_ISSUE.search(path)
+                if m and get_cache_class("GET", path) in ISSUE_CLASSES:
+                    self.ids.learn(path, call.response[3])
+                    with self.lock:
+                        self.responses[key] = (m.group(1),) + call.response
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return response
+
+    def invalidate(self, issues):
+        """Drops the responses of issues."""
+        if not issues:
+            return
+        issues, complete = self.ids.resolve(issues)
+        with self.lock:
+            for key in [
+                k for k, r in self.responses.items() if not complete or r[0] in issues
+            ]:
+                del self.responses[key]
+                self.stats["invalidated"] += 1
+
+    def close(self):
+        log.debug("Identity map: %s" % self.stats)
+
+
+def build_response(request, status, reason, headers, body):
+    """Returns a requests Response built from a cached response."""
+    from requests.models import Response
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+
+    response = Response()
+    response.status_code = status
+    response.reason = reason
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = body
+    response.url = request.url
+    response.request = request
+    return response
+
+
+def open_cache(url):
+    """Returns the response cache of the server at url, or None if the cache
+    is disabled."""
+    import sqlite3
+
+    config = get_http_cache_config()
+    if not config["enabled"]:
+        return None
+    try:
+        return ResponseCache(get_cache_file(url), config)
+    except (OSError, sqlite3.Error) as e:
+        log.warning("Could not open the HTTP cache: %s" % e)
+        return None
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+jipbatch, runs a list of jipsearch, jipstatus, jipfp and jipdate (query mode)
+invocations in one process.
+
+The steps share the login, the JIRA instance, the metadata and user caches and
+an in-memory cache of the responses (httpcache.MemoryCache), so what several
+steps ask for is only fetched once. Independent steps run concurrently, each
+one printing to its own output file, or to stdout in the order of the steps.
+
+The batch file either has one invocation per line, optionally redirected to a
+file:
+
+    # Weekly reports
+    jipstatus -p SWG --html swg.html > swg.txt
+    jipsearch -j "project = SWG AND updated >= -7d"
+    jipfp -p SWG
+
+or, for files ending in .yml or .yaml, a list of steps:
+
+    steps:
+      - run: jipstatus -p SWG --html swg.html
+        output: swg.txt
+      - run: jipsearch -j "project = SWG AND updated >= -7d"
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import io
+import logging as log
+import os
+import shlex
+import sys
+import threading
+
+# Local files
+from jipdate import cfg
+from jipdate import cli
+from jipdate import jiralogin
+from jipdate import __version__
+
+# Commands that can be run by a step.
+COMMANDS = ["jipdate", "jipfp", "jipsearch", "jipstatus"]
+
+# Common options that only apply to the whole batch.
+BATCH_OPTIONS = ["trace", "profile", "metrics", "record", "replay", "replay_latency"]
+
+# Options of the commands choosing the test server, which is the one of the
+# batch (-t).
+TEST_SERVER_OPTIONS = {"jipdate": "t", "jipfp": "t", "jipstatus": "test"}
+
+
+################################################################################
+# Steps
+################################################################################
+class Step:
+    """An invocation of a command in the batch file."""
+
+    def __init__(self, number, line, output=None):
+        self.number = number
+        self.line = line
+        self.output = output
+        self.command = None
+        self.args = None
+        self.status = None
+        self.text = None
+
+    def __str__(self):
+        return "step %d (%s)" % (self.number, self.line)
+
+
+def parse_line(number, line):
+    """Returns the step of a line of a batch file, "command args [> file]"."""
+    output = None
+    words = shlex.split(line)
+    if len(words) >= 2 and words[-2] == ">":
+        output = words[-1]
+        words = words[:-2]
+    step = Step(number, " ".join(shlex.quote(w) for w in words), output)
+    return step, words
+
+
+def get_command_parser(command):
+    import importlib
+
+    module = importlib.import_module("jipdate.%s" % command)
+    parser = module.get_parser()
+    parser.prog = command
+    return parser
+
+
+def parse_step(number, line, output=None):
+    """Returns the step of an invocation, raises ValueError if it can't be
+    run."""
+    step, words = parse_line(number, line)
+    step.output = output or step.output
+    if not words or words[0] not in COMMANDS:
+        raise ValueError("%s: the command must be one of %s" % (step, COMMANDS))
+
+    step.command = words[0]
+    try:
+        step.args = get_command_parser(step.command).parse_args(words[1:])
+    except SystemExit:
+        # The parser already told what is wrong.
+        raise ValueError("%s: invalid arguments" % step)
+
+    if step.command == "jipdate" and not step.args.q:
+        raise ValueError("%s: only the query mode (-q) of jipdate is supported" % step)
+    for name in BATCH_OPTIONS:
+        if getattr(step.args, name, None) is not None:
+            log.warning(
+                "%s: --%s only applies to the whole batch"
+                % (step, name.replace("_", "-"))
+            )
+    if getattr(step.args, TEST_SERVER_OPTIONS.get(step.command, ""), False):
+        log.warning("%s: the server is the one of the batch (-t)" % step)
+    return step
+
+
+def read_steps(filename):
+    """Returns the steps of a batch file, raises ValueError if there is an
+    invalid one."""
+    if filename.endswith((".yml", ".yaml")):
+        content = cfg.parse_config(filename)
+        if isinstance(content, dict):
+            content = content.get("steps") or []
+        steps = []
+        for number, item in enumerate(content, 1):
+            if isinstance(item, str):
+                item = {"run": item}
+            if not isinstance(item, dict) or "run" not in item:
+                raise ValueError("step %d: expected a 'run' command" % number)
+            steps.append(parse_step(number, item["run"], item.get("output")))
+        return steps
+
+    steps = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                steps.append(parse_step(len(steps) + 1, line))
+    return steps
+
+
+################################################################################
+# Runners
+################################################################################
+def run_jipdate(jira, username, args):
+    """jipdate in query mode: writes the status file (-f or a temporary file)
+    and prints it with -p. Sending the updates needs the editor and a
+    confirmation, hence it's left to jipdate itself."""
+    from jipdate import jipdate
+
+    engine = cli.open_engine(jira, args)
+    filename, _ = jipdate.get_jira_issues(jira, username, args, engine)
+    if args.p:
+        jipdate.print_status_file(filename)
+
+
+def get_runner(command):
+    """Returns the function running a command with the given JIRA instance."""
+    if command == "jipdate":
+        return run_jipdate
+
+    import importlib
+
+    return importlib.import_module("jipdate.%s" % command).run
+
+
+class StepOutput:
+    """Replaces sys.stdout while the steps run: what a step prints goes to the
+    output of the step running in the current thread."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def get_stream(self):
+        return getattr(self.local, "stream", None) or self.stream
+
+    def write(self, s):
+        return self.get_stream().write(s)
+
+    def flush(self):
+        return self.get_stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_step(jira, username, step, stdout):
+    """Runs a step, its output goes to its file or is kept in step.text."""
+    if step.output:
+        output = open(step.output, "w")
+    else:
+        output = io.StringIO()
+    stdout.local.stream = output
+    try:
+        get_runner(step.command)(jira, username, step.args)
+        step.status = 0
+    except SystemExit as e:
+        step.status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception as e:
+        log.debug("%s failed" % step, exc_info=True)
+        print("jipbatch: %s failed: %s" % (step, e), file=sys.stderr)
+        step.status = 1
+    finally:
+        stdout.local.stream = None
+        if step.output:
+            output.close()
+        else:
+            step.text = output.getvalue()
+    return step
+
+
+def share_responses(jira):
+    """Puts an in-memory cache of the responses in front of the server, unless
+    jipd already caches them."""
+    from jipdate import httpcache
+    from jipdate import transport
+
+    adapter = jira._session.get_adapter(jira.server_url)
+    if isinstance(adapter, transport.JiraAdapter):
+        adapter.cache = httpcache.MemoryCache(adapter.cache)
+
+
+def run_steps(jira, username, steps, jobs):
+    """Runs the steps, jobs at a time, and returns the exit status of the
+    batch. The outputs not written to files are printed in the order of the
+    steps."""
+    stdout = StepOutput(sys.stdout)
+    sys.stdout = stdout
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [
+                executor.submit(run_step, jira, username, s, stdout) for s in steps
+            ]
+            for future in futures:
+                step = future.result()
+                if step.text:
+                    if len(steps) > 1:
+                        print("==> %s <==" % step.line)
+                    print(step.text, end="")
+                if step.status:
+                    failed += 1
+    finally:
+        sys.stdout = stdout.stream
+
+    if failed:
+        print("jipbatch: %d of %d steps failed" % (failed, len(steps)), file=sys.stderr)
+        return 1
+    return 0
+
+
+################################################################################
+# Argument parser
+################################################################################
+def get_parser():
+    """Takes care of script argument parsing."""
+    parser = ArgumentParser(
+        description="Run many jip* commands in one process, sharing one Jira session"
+    )
+
+    parser.add_argument(
+        "file",
+        help="Batch file, one command per line or a YAML list of steps",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        action="store",
+        type=int,
+        default=4,
+        help="Number of steps run concurrently (default: 4)",
+    )
+
+    parser.add_argument(
+        "-t",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Use the test server",
+    )
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Output some verbose debugging info",
+    )
+
+    parser.add_argument(
+        "--version", action="version", version=f"%(prog)s, {__version__}"
+    )
+
+    cli.add_common_arguments(parser)
+
+    return parser
+
+
+def initialize_logger(args):
+    LOG_FMT = "[%(levelname)s] %(funcName)s():%(lineno)d   %(message)s"
+    lvl = log.ERROR
+    if args.verbose:
+        lvl = log.DEBUG
+
+    log.basicConfig(
+        # filename="core.log",
+        level=lvl,
+        format=LOG_FMT,
+        filemode="w",
+    )
+
+
+################################################################################
+# Main function
+################################################################################
+def main():
+    parser = get_parser()
+
+    # The parser arguments (cfg.args) are accessible everywhere after this call.
+    cfg.args = parser.parse_args()
+
+    initialize_logger(cfg.args)
+    cli.setup(cfg.args)
+
+    # This initiates the global yml configuration instance so it will be
+    # accessible everywhere after this call.
+    cfg.initiate_config()
+
+    try:
+        steps = read_steps(cfg.args.file)
+    except (OSError, ValueError) as e:
+        log.error(e)
+        sys.exit(os.EX_DATAERR)
+
+    for step in steps:
+        if step.command in TEST_SERVER_OPTIONS:
+            setattr(step.args, TEST_SERVER_OPTIONS[step.command], cfg.args.t)
+        if step.args.engine is None:
+            step.args.engine = cfg.args.engine
+
+    cli.phase("login")
+    jira, username = jiralogin.get_jira_instance(cfg.args.t)
+    share_responses(jira)
+
+    cli.phase("query")
+    sys.exit(run_steps(jira, username, steps, cfg.args.jobs))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,17 +3,18 @@ from argparse import ArgumentParser
 from subprocess import call
 from time import gmtime, strftime
 
-import json
 import logging as log
 import os
 import re
 import sys
 import tempfile
-import yaml
 
 # Local files
 from jipdate import cfg
+from jipdate import cli
 from jipdate import jiralogin
+from jipdate import metadata
+from jipdate import users
 from jipdate import __version__
 
 
@@ -64,6 +65,8 @@ def get_parser():
         help="Do not make any changes to JIRA",
     )
 
+    cli.add_common_arguments(parser)
+
     return parser
 
 
@@ -72,6 +75,7 @@ def get_parser():
 ################################################################################
 def parse_issue_file(new_issue_file):
     """Reads new issue file and parse it into a python object"""
+    import yaml
 
     if not os.path.isfile(new_issue_file):
         sys.exit(-1)
@@ -97,23 +101,43 @@ def initialize_logger(args):
     )
 
 
+# Custom fields are given by name, their ids depend on the Jira server.
 jira_field_to_yaml = {
     "issuetype": "IssueType",
     "project": "Project",
     "summary": "Summary",
     "description": "Description",
     "assignee": "AssigneeEmail",
-    "customfield_10014": "EpicLink",
-    "customfield_10104": "ClientStakeholder",
+    "Epic Link": "EpicLink",
+    "Client Stakeholder": "ClientStakeholder",
     "timetracking": "OriginalEstimate",
     "components": "Components",
-    "customfield_10020": "Sprint",
+    "Sprint": "Sprint",
     "duedate": "Due date",
-    "customfield_10011": "Epic Name",
-    "customfield_10034": "Share Visibility",
+    "Epic Name": "Epic Name",
+    "Share Visibility": "Share Visibility",
+}
+
+# Ids of the custom fields on projects.linaro.org, used if the server doesn't
+# know them by name.
+custom_field_ids = {
+    "Epic Link": "customfield_10014",
+    "Client Stakeholder": "customfield_10104",
+    "Sprint": "customfield_10020",
+    "Epic Name": "customfield_10011",
+    "Share Visibility": "customfield_10034",
 }
 
 
+def get_custom_field_ids(jira):
+    """Returns the ids of the custom fields we set, keyed by name."""
+    registry = metadata.get_registry(jira)
+    return dict(
+        (name, registry.field_id(name, default))
+        for name, default in custom_field_ids.items()
+    )
+
+
 def get_sprints(jira, board_id):
     # We need to loop over sprints the API returns maximum 50 sprints.
     MAX_SPRINTS = 50
@@ -143,6 +167,7 @@ def main():
     cfg.args = parser.parse_args()
 
     initialize_logger(cfg.args)
+    cli.setup(cfg.args)
 
     # This initiates the global yml configuration instance so it will be
     # accessible everywhere after this call.
@@ -153,12 +178,16 @@ def main():
         parser.print_help()
         sys.exit(os.EX_USAGE)
 
+    cli.phase("login")
     jira, username = jiralogin.get_jira_instance(False)
 
     if cfg.args.file is not None:
+        ids = get_custom_field_ids(jira)
+        field_to_yaml = dict((ids.get(k, k), v) for k, v in jira_field_to_yaml.items())
         filename = cfg.args.file
         issues = parse_issue_file(filename)
         for issue in issues:
+            cli.phase("query")
             # We should only find one project and one issue type otherwise something is wrong
             issue_fields_dict = {}
             try:
@@ -194,8 +223,8 @@ def main():
                     }
 
                 if "AssigneeEmail" in issue.keys():
-                    assignee = jira.search_assignable_users_for_issues(
-                        query=issue["AssigneeEmail"], project=issue["Project"]
+                    assignee = users.get_directory(jira).search_assignable_users(
+                        issue["AssigneeEmail"], issue["Project"]
                     )
                     log.debug(f"Assignee email: {issue['AssigneeEmail']}")
                     log.debug(f"Assignee: {assignee}")
@@ -205,17 +234,17 @@ def main():
 
                 if "EpicLink" in issue.keys():
                     if issue["EpicLink"] in created_cards.keys():
-                        fields["customfield_10014"] = created_cards[issue["EpicLink"]]
+                        fields[ids["Epic Link"]] = created_cards[issue["EpicLink"]]
                     else:
-                        fields["customfield_10014"] = issue["EpicLink"]
+                        fields[ids["Epic Link"]] = issue["EpicLink"]
 
                 if "ClientStakeholder" in issue.keys():
                     csh_fields_dict = issue_meta_data["projects"][0]["issuetypes"][0][
                         "fields"
-                    ]["customfield_10104"]["allowedValues"]
+                    ][ids["Client Stakeholder"]]["allowedValues"]
                     for s in csh_fields_dict:
                         if s["value"] == issue["ClientStakeholder"]:
-                            fields["customfield_10104"] = [
+                            fields[ids["Client Stakeholder"]] = [
                                 {
                                     "self": s["self"],
                                     "value": s["value"],
@@ -249,7 +278,7 @@ def main():
                         for sprint in sprints_in_board:
                             log.debug(f"  - {sprint}")
                             if sprint.name == issue["Sprint"]:
-                                fields["customfield_10020"] = sprint.id
+                                fields[ids["Sprint"]] = sprint.id
                                 sprint_found = True
 
                 if "Due date" in issue.keys():
@@ -257,22 +286,22 @@ def main():
 
                 if "IssueType" in issue.keys() and issue["IssueType"] == "Epic":
                     if "Epic Name" in issue.keys():
-                        fields["customfield_10011"] = issue["Epic Name"]
+                        fields[ids["Epic Name"]] = issue["Epic Name"]
                     else:
-                        fields["customfield_10011"] = issue["Summary"]
+                        fields[ids["Epic Name"]] = issue["Summary"]
 
                 if "Share Visibility" in issue.keys():
                     share_visibility = []
                     for shared_with in issue["Share Visibility"]:
-                        tmp_share = jira.search_assignable_users_for_issues(
-                            query=shared_with, project=issue["Project"]
+                        tmp_share = users.get_directory(jira).search_assignable_users(
+                            shared_with, issue["Project"]
                         )[0]
                         share_visibility.append({"id": tmp_share.accountId})
                     log.debug(f"shared with: {issue['Share Visibility']}")
                     log.debug(f"share_visibility: {share_visibility}")
                     # We assume that the first entry in the returned user array is the one we want
                     if len(share_visibility) > 0:
-                        fields["customfield_10034"] = share_visibility
+                        fields[ids["Share Visibility"]] = share_visibility
 
                 if not sprint_found:
                     print(
@@ -298,11 +327,10 @@ def main():
                         and not issue_fields_dict[field]["hasDefaultValue"]
                     ):
                         if field not in fields.keys():
-                            print(
-                                f"Field {jira_field_to_yaml[field]} required but not set."
-                            )
+                            print(f"Field {field_to_yaml[field]} required but not set.")
                             sys.exit(os.EX_USAGE)
 
+                cli.phase("write")
                 if cfg.args.dry_run:
                     print(
                         f"This issue would have been created when running without '--dry-run':"
@@ -0,0 +1,598 @@
+#!/usr/bin/env python3
+"""
+jipd, an optional background daemon keeping an authenticated Jira session and
+in-memory caches warm between runs of the jip* commands.
+
+The daemon listens on a Unix domain socket in the jipdate cache directory. When
+it is running, jiralogin.get_jira_instance returns a JIRA instance whose HTTP
+requests are forwarded to the daemon instead of being sent to the server
+directly. When it is not running, everything works as before.
+"""
+
+from argparse import ArgumentParser
+
+import base64
+import collections
+import hashlib
+import logging as log
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+# Local files
+from jipdate import cfg
+from jipdate import deadline
+from jipdate import httpcache
+from jipdate import jsonlib
+from jipdate import trace
+from jipdate import __version__
+
+# Time to live (seconds) for each class of cached responses.
+DEFAULT_TTL = {
+    "metadata": 3600,
+    "users": 3600,
+    "transitions": 60,
+    "issues": 60,
+}
+
+# Seconds between two purges of the expired responses from the cache.
+PURGE_INTERVAL = 60
+
+# Headers never forwarded to the daemon, it authenticates the requests itself.
+DROPPED_HEADERS = ["authorization", "cookie", "content-length", "connection"]
+
+
+################################################################################
+# Wire protocol
+################################################################################
+def send_message(sock, message):
+    """Sends a length prefixed JSON message."""
+    data = jsonlib.dumps(message).encode("utf-8")
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("jipd connection closed")
+        data += chunk
+    return data
+
+
+def recv_message(sock):
+    """Receives a length prefixed JSON message."""
+    (size,) = struct.unpack("!I", recv_exactly(sock, 4))
+    return jsonlib.loads(recv_exactly(sock, size))
+
+
+def encode_body(body):
+    if body is None:
+        return None
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return base64.b64encode(body).decode("ascii")
+
+
+def decode_body(body):
+    if body is None:
+        return None
+    return base64.b64decode(body)
+
+
+def get_socket_file(url):
+    """Returns the socket the daemon serving url listens on."""
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return cfg.get_cache_file("jipd-%s.sock" % digest)
+
+
+def open_connection(url):
+    """Returns a socket connected to the daemon serving url, or None if no
+    daemon is running."""
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+
+    socket_file = get_socket_file(url)
+    if not os.path.exists(socket_file):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_file)
+    except OSError:
+        log.debug("Stale jipd socket: %s" % socket_file)
+        sock.close()
+        return None
+    return sock
+
+
+def call(url, message):
+    """Sends a single message to the daemon serving url and returns the reply,
+    or None if no daemon is running."""
+    sock = open_connection(url)
+    if sock is None:
+        return None
+    try:
+        send_message(sock, message)
+        return recv_message(sock)
+    finally:
+        sock.close()
+
+
+################################################################################
+# Client side
+################################################################################
+def get_daemon_adapter():
+    """Returns the requests adapter class forwarding requests to the daemon
+    (requests is only imported when a daemon is in use)."""
+    from requests.adapters import BaseAdapter
+    from requests.exceptions import ConnectionError
+    from requests.models import Response
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+
+    class DaemonAdapter(BaseAdapter):
+        """Adapter sending the requests through the jipd daemon."""
+
+        def __init__(self, url):
+            super().__init__()
+            self.url = url
+            self._local = threading.local()
+
+        def _connection(self):
+            sock = getattr(self._local, "sock", None)
+            if sock is None:
+                sock = open_connection(self.url)
+                if sock is None:
+                    raise ConnectionError("jipd is not running anymore")
+                self._local.sock = sock
+            return sock
+
+        def send(self, request, timeout=None, **kwargs):
+            headers = dict(
+                (k, v)
+                for k, v in request.headers.items()
+                if k.lower() not in DROPPED_HEADERS
+            )
+            message = {
+                "op": "request",
+                "method": request.method,
+                "url": request.url,
+                "headers": headers,
+                "body": encode_body(request.body),
+            }
+            deadline.check()
+            sock = self._connection()
+            # The daemon has its own timeouts, only the deadline cuts the wait
+            # short.
+            sock.settimeout(deadline.get_timeout(None))
+            start = time.perf_counter()
+            try:
+                send_message(sock, message)
+                reply = recv_message(sock)
+            except (OSError, EOFError) as e:
+                # The reply may still come, the connection can't be reused.
+                self.close()
+                if deadline.expired():
+                    raise deadline.stop("deadline") from e
+                raise ConnectionError("jipd: %s" % e, request=request)
+            if "error" in reply:
+                raise ConnectionError("jipd: %s" % reply["error"])
+
+            response = Response()
+            response.status_code = reply["status"]
+            response.reason = reply["reason"]
+            response.headers = CaseInsensitiveDict(reply["headers"])
+            response.encoding = get_encoding_from_headers(response.headers)
+            response._content = decode_body(reply["body"])
+            response.url = reply["url"]
+            response.request = request
+            response.connection = self
+            trace.record(request, response, start)
+            return response
+
+        def close(self):
+            sock = getattr(self._local, "sock", None)
+            if sock is not None:
+                sock.close()
+                self._local.sock = None
+
+    return DaemonAdapter
+
+
+def get_jira_instance(url):
+    """
+    Returns a (jira, username) tuple using the daemon serving url, or None if
+    no daemon is running for that server.
+    """
+    try:
+        hello = call(url, {"op": "hello"})
+    except (OSError, EOFError, ValueError) as e:
+        log.debug("Could not talk to jipd: %s" % e)
+        return None
+    if hello is None or hello.get("url") != url:
+        return None
+
+    from jira import JIRA
+    from jipdate import metadata
+
+    log.debug("Using jipd (pid %s) for %s" % (hello["pid"], url))
+    jira = JIRA(
+        url,
+        options={"headers": {"Accept": "application/json;1=1.0, */*;q=0.9"}},
+        max_retries=0,
+        get_server_info=False,
+    )
+    jira._session.mount(url, get_daemon_adapter()(url))
+    jsonlib.install(jira._session)
+    si = hello["server_info"]
+    jira._version = tuple(si["versionNumbers"])
+    jira.deploymentType = si.get("deploymentType")
+    metadata.get_registry(jira)
+    return (jira, hello["username"])
+
+
+################################################################################
+# Daemon side
+################################################################################
+class Daemon:
+    """Owns the JIRA instance and the response caches shared by all clients."""
+
+    def __init__(self, jira, username, ttl):
+        self.jira = jira
+        self.username = username
+        self.url = jira.client_info()
+        self.ttl = ttl
+        # Least recently used first, holding size bytes of response bodies.
+        self.cache = collections.OrderedDict()
+        self.size = 0
+        self.max_size = httpcache.MEMORY_CACHE_SIZE
+        self.purged = time.time()
+        self.ids = httpcache.IssueIds()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.last_used = time.time()
+        self.stats = {"requests": 0, "hits": 0, "misses": 0, "invalidated": 0}
+
+    def hello(self):
+        return {
+            "pid": os.getpid(),
+            "url": self.url,
+            "username": self.username,
+            "server_info": {
+                "versionNumbers": list(self.jira._version),
+                "deploymentType": self.jira.deploymentType,
+            },
+        }
+
+    def get_stats(self):
+        with self.lock:
+            self.purge()
+            stats = dict(self.stats)
+            stats["cached"] = len(self.cache)
+        stats["pid"] = os.getpid()
+        stats["uptime"] = int(time.time() - self.started)
+        return stats
+
+    def invalidate(self, request):
+        """Drops the cached responses of the issues a write request touches."""
+        issues = httpcache.get_touched_issues(request)
+        if not issues:
+            return
+        issues, complete = self.ids.resolve(issues)
+        with self.lock:
+            for key, cached in list(self.cache.items()):
+                if cached[3] in issues or (
+                    not complete and cached[2] in httpcache.ISSUE_CLASSES
+                ):
+                    self.drop(key)
+                    self.stats["invalidated"] += 1
+
+    def drop(self, key):
+        """Drops a cached response, the lock must be held."""
+        cached = self.cache.pop(key)
+        self.size -= len(cached[1]["body"])
+
+    def purge(self):
+        """Drops the expired responses, the lock must be held."""
+        now = time.time()
+        for key in [k for k, cached in self.cache.items() if cached[0] <= now]:
+            self.drop(key)
+        self.purged = now
+
+    def store(self, key, cached):
+        """Caches a response, evicting the least recently used ones beyond
+        max_size, the lock must be held."""
+        if key in self.cache:
+            self.drop(key)
+        if time.time() - self.purged > PURGE_INTERVAL:
+            self.purge()
+        self.cache[key] = cached
+        self.size += len(cached[1]["body"])
+        while self.size > self.max_size:
+            self.drop(next(iter(self.cache)))
+
+    def request(self, message):
+        from requests import Request
+        from urllib.parse import urlsplit
+
+        self.last_used = time.time()
+        url = message["url"]
+        # Never send our credentials anywhere else than to our own server.
+        if not (url == self.url or url.startswith(self.url + "/")):
+            return {"error": "%s is not served by this daemon" % url}
+
+        method = message["method"].upper()
+        path = urlsplit(url).path
+        cache_class = httpcache.get_cache_class(method, path)
+        key = (method, url)
+        with self.lock:
+            self.stats["requests"] += 1
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > time.time():
+                self.cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return cached[1]
+            if cached is not None:
+                self.drop(key)
+            self.stats["misses"] += 1
+
+        session = self.jira._session
+        request = session.prepare_request(
+            Request(
+                method,
+                url,
+                headers=message["headers"],
+                data=decode_body(message["body"]),
+            )
+        )
+        if method != "GET":
+            self.invalidate(request)
+
+        response = session.send(request, timeout=session.timeout)
+        reply = {
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": dict(response.headers),
+            "body": encode_body(response.content),
+            "url": response.url,
+        }
+
+        if cache_class is not None and response.status_code == 200:
+            m = httpcache.REGEX_ISSUE.search(path)
+            if cache_class == "issues":
+                self.ids.learn(path, response.content or b"")
+            with self.lock:
+                self.store(
+                    key,
+                    (
+                        time.time() + self.ttl[cache_class],
+                        reply,
+                        cache_class,
+                        m.group(1) if m else None,
+                    ),
+                )
+        return reply
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.jipd
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (OSError, EOFError, ValueError):
+                return
+
+            op = message.get("op")
+            try:
+                if op == "hello":
+                    reply = daemon.hello()
+                elif op == "stats":
+                    reply = daemon.get_stats()
+                elif op == "request":
+                    reply = daemon.request(message)
+                elif op == "stop":
+                    reply = {"stopped": os.getpid()}
+                    threading.Thread(target=self.server.shutdown).start()
+                else:
+                    reply = {"error": "unknown operation %s" % op}
+            except Exception as e:
+                log.exception("Request failed")
+                reply = {"error": str(e)}
+            send_message(self.request, reply)
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def watch_idle(server, idle_timeout):
+    """Shuts the daemon down when it hasn't been used for idle_timeout
+    seconds."""
+    while True:
+        time.sleep(min(idle_timeout, 60))
+        if time.time() - server.jipd.last_used > idle_timeout:
+            log.info("Idle for %d seconds, exiting" % idle_timeout)
+            server.shutdown()
+            return
+
+
+def daemonize():
+    """Detaches the process from the terminal, the parent returns False and the
+    daemon returns True."""
+    if os.fork() > 0:
+        return False
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in [0, 1, 2]:
+        os.dup2(devnull, fd)
+    return True
+
+
+def get_ttl():
+    """Returns the cache TTLs, updated with the "daemon" section of the config
+    file."""
+    ttl = dict(DEFAULT_TTL)
+    daemon_cfg = cfg.get_option("daemon") or {}
+    for k in ttl:
+        ttl[k] = daemon_cfg.get("%s_ttl" % k, ttl[k])
+    return ttl
+
+
+def start(use_test_server, foreground, idle_timeout):
+    # Local import, jiralogin itself imports this module to find the daemon.
+    from jipdate import jiralogin
+
+    url = cfg.get_server(use_test_server).get("url")
+    if call(url, {"op": "hello"}) is not None:
+        print("jipd is already running for %s" % url)
+        sys.exit(os.EX_OK)
+
+    # The daemon caches the responses for its clients, with their own TTLs.
+    jira, username = jiralogin.get_jira_instance(use_test_server, identity_map=False)
+
+    socket_file = get_socket_file(url)
+    if os.path.exists(socket_file):
+        os.unlink(socket_file)
+    old_umask = os.umask(0o177)
+    try:
+        server = DaemonServer(socket_file, RequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.jipd = Daemon(jira, username, get_ttl())
+
+    if not foreground and not daemonize():
+        print("jipd started for %s" % url)
+        return
+
+    if idle_timeout:
+        threading.Thread(
+            target=watch_idle, args=(server, idle_timeout), daemon=True
+        ).start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_file):
+            os.unlink(socket_file)
+
+
+################################################################################
+# Argument parser
+################################################################################
+def get_parser():
+    """Takes care of script argument parsing."""
+    parser = ArgumentParser(
+        description="Background daemon keeping a Jira session and caches warm"
+    )
+
+    parser.add_argument(
+        "command",
+        choices=["start", "stop", "status"],
+        help="Start, stop or show the status of the daemon",
+    )
+
+    parser.add_argument(
+        "-t",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Use the test server",
+    )
+
+    parser.add_argument(
+        "--foreground",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Don't detach from the terminal",
+    )
+
+    parser.add_argument(
+        "--idle-timeout",
+        required=False,
+        action="store",
+        type=int,
+        default=8 * 3600,
+        help="Exit after being idle for this many seconds (0 to never exit)",
+    )
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Output some verbose debugging info",
+    )
+
+    parser.add_argument(
+        "--version", action="version", version=f"%(prog)s, {__version__}"
+    )
+
+    return parser
+
+
+def initialize_logger(args):
+    LOG_FMT = "[%(levelname)s] %(funcName)s():%(lineno)d   %(message)s"
+    lvl = log.ERROR
+    if args.verbose:
+        lvl = log.DEBUG
+
+    log.basicConfig(
+        # filename="core.log",
+        level=lvl,
+        format=LOG_FMT,
+        filemode="w",
+    )
+
+
+################################################################################
+# Main function
+################################################################################
+def main():
+    parser = get_parser()
+
+    # The parser arguments (cfg.args) are accessible everywhere after this call.
+    cfg.args = parser.parse_args()
+
+    initialize_logger(cfg.args)
+
+    # This initiates the global yml configuration instance so it will be
+    # accessible everywhere after this call.
+    cfg.initiate_config()
+
+    if not hasattr(socket, "AF_UNIX"):
+        log.error("jipd needs Unix domain sockets")
+        sys.exit(os.EX_UNAVAILABLE)
+
+    url = cfg.get_server(cfg.args.t).get("url")
+    if cfg.args.command == "start":
+        start(cfg.args.t, cfg.args.foreground, cfg.args.idle_timeout)
+    elif cfg.args.command == "stop":
+        reply = call(url, {"op": "stop"})
+        if reply is None:
+            print("jipd is not running for %s" % url)
+        else:
+            print("jipd (pid %s) stopped" % reply["stopped"])
+    else:
+        reply = call(url, {"op": "stats"})
+        if reply is None:
+            print("jipd is not running for %s" % url)
+            sys.exit(1)
+        print("jipd (pid %s) serving %s" % (reply.pop("pid"), url))
+        for k in sorted(reply):
+            print("  %-12s %s" % (k, reply[k]))
+
+
+if __name__ == "__main__":
+    main()
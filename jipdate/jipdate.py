@@ -3,17 +3,20 @@ from argparse import ArgumentParser
 from subprocess import call
 from time import gmtime, strftime
 
-import json
 import logging as log
 import os
 import re
 import sys
 import tempfile
-import yaml
 
 # Local files
 from jipdate import cfg
+from jipdate import cli
 from jipdate import jiralogin
+from jipdate import metadata
+from jipdate import projection
+from jipdate import records
+from jipdate import users
 from jipdate import __version__
 
 
@@ -191,6 +194,8 @@ def get_parser():
         help="Do not make any changes to JIRA",
     )
 
+    cli.add_common_arguments(parser)
+
     return parser
 
 
@@ -231,11 +236,30 @@ def update_jira(jira, i, c, t, ts=None):
             jira.add_worklog(i, timeSpent=ts, comment=c)
 
 
-def write_last_jira_comment(f, jira, issue):
-    """Pulls the last comment from Jira from an issue and writes it to the file
-    object.
+async def update_jira_async(engine, i, c, t, ts=None):
+    """
+    Same as update_jira, with the asyncio engine. The updates of an issue are
+    sent in order, the ones of different issues concurrently.
+    """
+    if t["transition"]:
+        fields = None
+        if t["resolution"]:
+            fields = {"resolution": {"id": t["resolution"]}}
+        log.debug("Updating Jira issue: %s with transition: %s" % (i, t["transition"]))
+        await engine.transition_issue(str(i), t["transition"], fields)
+
+    if c != "":
+        log.debug("Updating Jira issue: %s with comment:\n%s" % (i, c))
+        await engine.add_comment(str(i), c)
+        if ts:
+            await engine.add_worklog(str(i), ts, c)
+
+
+def write_last_jira_comment(f, jira, issue, comments=None):
+    """Pulls the last comment from Jira from an issue (unless its comments are
+    given) and writes it to the file object.
     """
-    c = jira.comments(issue)
+    c = comments if comments is not None else jira.comments(issue)
     if len(c) > 0:
         try:
             comment = "# Last comment:\n# ---8<---\n# %s\n# --->8---\n" % "\n# ".join(
@@ -246,17 +270,17 @@ def write_last_jira_comment(f, jira, issue):
             log.debug("Can't encode character")
 
 
-def get_jira_issues(jira, username):
+def get_jira_issues(jira, username, args, engine=None):
     """
     Query Jira and then creates a status update file (either temporary or named)
     containing all information found from the JQL query.
     """
-    exclude_stories = cfg.args.x
-    epics_only = cfg.args.e
-    all_status = cfg.args.all
-    filename = cfg.args.file
-    user = cfg.args.user
-    last_comment = cfg.args.l
+    exclude_stories = args.x
+    epics_only = args.e
+    all_status = args.all
+    filename = args.file
+    user = args.user
+    last_comment = args.l
 
     issue_types = ["Sub-task", "Epic"]
     if not epics_only:
@@ -272,15 +296,18 @@ def get_jira_issues(jira, username):
     if user is None:
         user = "currentUser()"
     else:
-        user = '"%s"' % add_domain(user)
+        user = '"%s"' % users.get_directory(jira).get_jql_user(add_domain(user))
 
     jql = "%s AND assignee = %s AND %s" % (issue_type, user, status)
     log.debug(jql)
 
-    my_issues = jira.search_issues(jql)
-    if my_issues.total > my_issues.maxResults:
-        my_issues = jira.search_issues(jql, maxResults=my_issues.total)
+    cli.phase("query")
+    my_issues = records.search(jira, jql, projection.plan_jipdate(args), engine)
+    comments = {}
+    if engine is not None and last_comment:
+        comments = engine.fetch_comments(my_issues)
 
+    cli.phase("render")
     showdate = strftime("%Y-%m-%d", gmtime())
     subject = "Subject: [Weekly] Week ending " + showdate + "\n\n"
 
@@ -310,7 +337,7 @@ def get_jira_issues(jira, username):
         f.write("# Status: %s\n" % issue.fields.status)
         f.write(get_extra_comments())
         if last_comment:
-            write_last_jira_comment(f, jira, issue)
+            write_last_jira_comment(f, jira, issue, comments.get(str(issue)))
         f.write("\n")
 
     f.close()
@@ -336,11 +363,18 @@ def should_update():
             print("Incorrect input: %s" % answer)
 
 
-def parse_status_file(jira, filename, issues):
+class StatusError(Exception):
+    """An update of the status file that can't be done in Jira."""
+
+
+def read_status(jira, status, issues, plan, engine=None):
     """
     The main parsing function, which will decide what should go into the actual
     Jira call. This for example removes the beginning until it finds a
     standalone [ISSUE] tag. It will also remove all comments prefixed with '#'.
+    Returns the (issue, comment, new status, time spent) found in the lines of
+    the status file, the issues are taken from issues (the ones of the query,
+    if any) or fetched with the fields of plan.
     """
     # Regexp to match Jira issue on a single line, i.e:
     # [SWG-28]
@@ -363,18 +397,23 @@ def parse_status_file(jira, filename, issues):
     # match:
     regex_status = r"(?:^Status:) *(.+)\n$"
 
-    # Contains the status text, it could be a file or a status email
-    status = ""
-
     # Regexp to match for a time spent update, this will remove 'Time spent:'
     # from the match:
     regex_timespent = r"(^Time spent:) \d+\w\n$"
 
-    # List of resolutions (when doing a transition to Resolved). Query once globally.
-    resolution_map = dict([(t.name.title(), t.id) for t in jira.resolutions()])
-
-    with open(filename) as f:
-        status = f.readlines()
+    # With the asyncio engine, the issues we haven't queried are all fetched
+    # at once.
+    prefetched = {}
+    if engine is not None:
+        keys = []
+        for line in status:
+            match = re.search(regex, line)
+            if match:
+                keys.append(match.group(1))
+            elif re.search(regex_fin, line):
+                break
+        known = set(str(x) for x in issues or [])
+        prefetched = records.fetch(engine, (k for k in keys if k not in known), plan)
 
     myissue = ""
     mycomment = ""
@@ -404,7 +443,9 @@ def parse_status_file(jira, filename, issues):
             # TypeError: issues is None, we haven't queried Jira yet, at all
             except (IndexError, TypeError) as e:
                 try:
-                    issue = jira.issue(myissue)
+                    issue = prefetched.get(myissue)
+                    if issue is None:
+                        issue = records.get_issue(jira, myissue, plan)
                     issue_comments.append((issue, "", "", None))
                 except Exception as e:
                     if "Issue Does Not Exist" in e.text:
@@ -437,11 +478,33 @@ def parse_status_file(jira, filename, issues):
                 (i, c, t, ts) = issue_comments[-1]
                 issue_comments[-1] = (i, c + line, t, ts)
 
-    issue_upload = []
-    print("These JIRA cards will be updated as follows:\n")
-    for idx, t in enumerate(issue_comments):
-        (issue, comment, transition, timespent) = issue_comments[idx]
+    return issue_comments
+
+
+def plan_updates(jira, issue_comments, engine=None):
+    """
+    Yields the (issue, comment, transition, time spent, transition summary) of
+    the issues of read_status() that have a comment or a new status, the new
+    status being turned into the ids of the transition and resolution. Raises
+    StatusError if the new status isn't a transition of the issue.
+    """
+    # List of resolutions (when doing a transition to Resolved). Query once globally.
+    resolution_map = dict(
+        [
+            (t["name"].title(), t["id"])
+            for t in metadata.get_registry(jira).resolutions()
+        ]
+    )
+
+    transitions = {}
+    if engine is not None:
+        transitions = engine.fetch_transitions(
+            str(i)
+            for (i, _, t, _) in issue_comments
+            if t != "" and t != str(i.fields.status)
+        )
 
+    for issue, comment, transition, timespent in issue_comments:
         # Strip beginning  and trailing blank lines
         comment = comment.strip("\n")
 
@@ -459,20 +522,27 @@ def parse_status_file(jira, filename, issues):
             ) and "/" in transition:
                 (transition, resolution) = map(str.strip, transition.split("/"))
                 if not resolution in resolution_map:
-                    print(
-                        'Invalid resolution "{}" for issue {}'.format(resolution, issue)
+                    raise StatusError(
+                        'Invalid resolution "{}" for issue {}\n'
+                        "Possible resolution: {}".format(
+                            resolution, issue, [t for t in resolution_map]
+                        )
                     )
-                    print("Possible resolution: {}".format([t for t in resolution_map]))
-                    sys.exit(1)
                 resolution_id = resolution_map[resolution]
 
+            issue_transitions = transitions.get(str(issue))
+            if issue_transitions is None:
+                issue_transitions = jira.transitions(issue)
             transition_map = dict(
-                [(t["name"].title(), t["id"]) for t in jira.transitions(issue)]
+                [(t["name"].title(), t["id"]) for t in issue_transitions]
             )
             if not transition in transition_map:
-                print('Invalid transition "{}" for issue {}'.format(transition, issue))
-                print("Possible transitions: {}".format([t for t in transition_map]))
-                sys.exit(1)
+                raise StatusError(
+                    'Invalid transition "{}" for issue {}\n'
+                    "Possible transitions: {}".format(
+                        transition, issue, [t for t in transition_map]
+                    )
+                )
 
             transition_id = transition_map[transition]
             if resolution:
@@ -491,20 +561,43 @@ def parse_status_file(jira, filename, issues):
             )
             continue
 
-        issue_upload.append(
-            (
-                issue,
-                comment,
-                {"transition": transition_id, "resolution": resolution_id},
-                timespent,
-            )
+        yield (
+            issue,
+            comment,
+            {"transition": transition_id, "resolution": resolution_id},
+            timespent,
+            transition_summary,
         )
-        print(
-            "[%s]%s\n  %s"
-            % (issue, transition_summary, "\n  ".join(comment.splitlines()))
-        )
-        if timespent:
-            print(" Time spent: %s" % timespent)
+
+
+def parse_status_file(jira, filename, issues, engine=None):
+    """
+    Reads the status file, shows the updates found in it and sends them to Jira
+    once confirmed.
+    """
+    cli.phase("query")
+    plan = projection.plan_jipdate(cfg.args)
+
+    with open(filename) as f:
+        status = f.readlines()
+
+    issue_comments = read_status(jira, status, issues, plan, engine)
+
+    issue_upload = []
+    print("These JIRA cards will be updated as follows:\n")
+    try:
+        for update in plan_updates(jira, issue_comments, engine):
+            issue, comment, transition, timespent, transition_summary = update
+            issue_upload.append((issue, comment, transition, timespent))
+            print(
+                "[%s]%s\n  %s"
+                % (issue, transition_summary, "\n  ".join(comment.splitlines()))
+            )
+            if timespent:
+                print(" Time spent: %s" % timespent)
+    except StatusError as e:
+        print(e)
+        sys.exit(1)
     print("")
 
     issue_comments = issue_upload
@@ -518,8 +611,12 @@ def parse_status_file(jira, filename, issues):
         sys.exit()
 
     # if we found something, let's update jira
-    for issue, comment, transition, timespent in issue_comments:
-        update_jira(jira, issue, comment, transition, timespent)
+    cli.phase("write")
+    if engine is not None:
+        engine.run_all(lambda u: update_jira_async(engine, *u), issue_comments)
+    else:
+        for issue, comment, transition, timespent in issue_comments:
+            update_jira(jira, issue, comment, transition, timespent)
 
     print("Successfully updated your Jira tickets!\n")
     if not cfg.args.s:
@@ -538,56 +635,35 @@ def print_status_file(filename):
 
 def get_extra_comments():
     """Read the jipdate config file and return all option comments."""
-    try:
-        yml_iter = cfg.yml_config["comments"]
-    except:
-        # Probably no "comments" section in the yml-file.
-        return "\n"
-
-    return ("\n".join(yml_iter) + "\n") if yml_iter is not None else "\n"
+    comments = cfg.get_list("comments", [])
+    return ("\n".join(comments) + "\n") if comments else "\n"
 
 
 def get_header():
     """Read the jipdate config file and return all option header."""
-    try:
-        yml_iter = cfg.yml_config["header"]
-    except:
-        # Probably no "comments" section in the yml-file.
+    header = cfg.get_list("header")
+    if header is None:
+        # No "header" section in the yml-file.
         return ""
 
-    return ("\n".join(yml_iter) + "\n\n") if yml_iter is not None else "\n"
+    return ("\n".join(header) + "\n\n") if header else "\n"
 
 
 def merge_issue_header():
     """Read the configuration flag which decides if the issue and issue header
     shall be combined."""
-    try:
-        yml_iter = cfg.yml_config["use_combined_issue_header"]
-    except:
-        # Probably no "use_combined_issue_header" section in the yml-file.
-        return False
-    return yml_iter
+    return cfg.get_bool("use_combined_issue_header", False)
 
 
 def get_header_separator():
     """Read the separator from the jipdate config file."""
-    try:
-        yml_iter = cfg.yml_config["separator"]
-    except:
-        # Probably no "separator" section in the yml-file.
-        return " | "
-    return yml_iter
+    return cfg.get_str("separator", " | ")
 
 
 def get_editor():
     """Read the configuration flag that will decide whether to show the text
     editor by default or not."""
-    try:
-        yml_iter = cfg.yml_config["text-editor"]
-    except:
-        # Probably no "text-editor" section in the yml-file.
-        return True
-    return yml_iter
+    return cfg.get_bool("text-editor", True)
 
 
 def initialize_logger(args):
@@ -615,6 +691,7 @@ def main():
     cfg.args = parser.parse_args()
 
     initialize_logger(cfg.args)
+    cli.setup(cfg.args)
 
     # This initiates the global yml configuration instance so it will be
     # accessible everywhere after this call.
@@ -625,7 +702,9 @@ def main():
         parser.print_help()
         sys.exit(os.EX_USAGE)
 
+    cli.phase("login")
     jira, username = jiralogin.get_jira_instance(cfg.args.t)
+    engine = cli.open_engine(jira, cfg.args)
 
     if cfg.args.x or cfg.args.e:
         if not cfg.args.q:
@@ -637,7 +716,7 @@ def main():
         sys.exit(os.EX_USAGE)
 
     if cfg.args.q:
-        (filename, issues) = get_jira_issues(jira, username)
+        (filename, issues) = get_jira_issues(jira, username, cfg.args, engine)
 
         if cfg.args.p:
             print_status_file(filename)
@@ -657,9 +736,9 @@ def main():
         issues
     # issues is not defined, we haven't made any query yet.
     except NameError:
-        parse_status_file(jira, filename, None)
+        parse_status_file(jira, filename, None, engine)
     else:
-        parse_status_file(jira, filename, issues)
+        parse_status_file(jira, filename, issues, engine)
 
 
 if __name__ == "__main__":
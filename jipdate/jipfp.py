@@ -4,15 +4,20 @@
 from argparse import ArgumentParser
 
 import logging as log
-import os
 import re
 import sys
+import tempfile
 import unicodedata
-import yaml
 
 # Local files
 from jipdate import cfg
+from jipdate import cli
+from jipdate import deadline
 from jipdate import jiralogin
+from jipdate import metadata
+from jipdate import metrics
+from jipdate import projection
+from jipdate import records
 from jipdate import __version__
 
 
@@ -154,17 +159,17 @@ class Node:
         for c in self.childrens:
             c.gen_tree(self._indent + 4)
 
-    def to_xml(self, f, indent=0):
+    def to_xml(self, f, args, indent=0):
         self._indent = indent
         # Main node
         fold = "false"
         if self.issuetype in ["Epic", "Story"]:
             fold = "true"
 
-        if cfg.args.s and self.issuetype == "Epic":
+        if args.s and self.issuetype == "Epic":
             fold = "false"
 
-        if cfg.args.i and self.issuetype == "Initiative":
+        if args.i and self.issuetype == "Initiative":
             fold = "true"
 
         xml_start = '%s<node LINK="%s" TEXT="%s/%s: %s" FOLDED="%s" COLOR="%s">\n' % (
@@ -215,7 +220,7 @@ class Node:
 
         # Recursive print all childrens
         for c in sorted(self.childrens):
-            c.to_xml(f, self._indent + 4)
+            c.to_xml(f, args, self._indent + 4)
 
         # Add the closing element
         xml_end = "%s%s" % (" " * self._indent, "</node>\n")
@@ -231,12 +236,23 @@ def open_file(filename):
     if filename:
         return open(filename, "w")
     else:
-        return tempfile.NamedTemporaryFile(delete=False)
+        return tempfile.NamedTemporaryFile(mode="w+t", delete=False)
+
+
+def get_server_url(use_test_server):
+    """Returns the url of the Jira server in use."""
+    return cfg.get_server(use_test_server).get("url")
+
+
+def get_field_id(jira, name, default):
+    """Returns the id of a custom field on the server, from its name."""
+    return metadata.get_registry(jira).field_id(name, default)
 
 
 def get_parent_key(jira, issue):
-    if hasattr(issue.fields, "customfield_10005"):
-        return getattr(issue.fields, "customfield_10005")
+    parent_link = get_field_id(jira, "Parent Link", "customfield_10005")
+    if hasattr(issue.fields, parent_link):
+        return getattr(issue.fields, parent_link)
     return None
 
 
@@ -319,17 +335,28 @@ def get_parser():
         help="Run test case and then exit",
     )
 
+    parser.add_argument(
+        "--cached",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Sync the local mirror of the project(s) and answer from it",
+    )
+
+    cli.add_deadline_argument(parser)
+    cli.add_common_arguments(parser)
+
     return parser
 
 
 ################################################################################
 # General nodes
 ################################################################################
-def root_nodes_start(f, key):
+def root_nodes_start(f, key, server_url):
     f.write('<map version="freeplane 1.6.0">\n')
     f.write(
         '<node LINK="%s" TEXT="%s" FOLDED="false" COLOR="#000000" LOCALIZED_STYLE_REF="AutomaticLayout.level.root">\n'
-        % (cfg.server + "/projects/" + key, key)
+        % (server_url + "/projects/" + key, key)
     )
 
 
@@ -345,12 +372,21 @@ def orphan_node_end(f):
     f.write("</node>\n")
 
 
+def incomplete_node(f):
+    """Tells in the map that it is incomplete, see deadline.py."""
+    if deadline.is_stopped():
+        f.write(
+            '<node TEXT="%s" POSITION="right" COLOR="#ff0000"/>\n'
+            % deadline.get_message()
+        )
+
+
 ################################################################################
 # Test
 ################################################################################
 def test():
     f = open_file("test" + ".mm")
-    root_nodes_start(f, "Test")
+    root_nodes_start(f, "Test", get_server_url(cfg.args.t))
     n1 = Node("SWG-1", "My issue 1", "Initiative")
 
     n12 = Node("SWG-12", "My issue 12", "Epic")
@@ -382,23 +418,93 @@ def test():
     n14.add_sponsor("STE")
     n14.add_sponsor("Arm")
     n14.add_sponsor("Hisilicon")
-    n14.set_base_url(cfg.server)
+    n14.set_base_url(get_server_url(cfg.args.t))
 
     n1.add_child(n12)
     n1.add_child(n13)
     n1.add_child(n14)
 
     n1.gen_tree()
-    n1.to_xml(f)
+    n1.to_xml(f, cfg.args)
     root_nodes_end(f)
     f.close()
 
 
+################################################################################
+# Tree walk
+################################################################################
+# Issues per search, the default of JIRA.search_issues() that was used so far.
+MAX_RESULTS = 50
+
+
+class Tree:
+    """The state of the walk building the tree of a project: the connection,
+    the fields asked for the issues (see projection.plan_jipfp()) and the
+    issues fetched ahead of the walk by the asyncio engine, keyed by key."""
+
+    def __init__(self, jira, engine, plan, server_url):
+        self.jira = jira
+        self.engine = engine
+        self.plan = plan
+        self.server_url = server_url
+        self.prefetched = {}
+
+
+def get_issue(tree, key):
+    """Returns an issue, from the prefetched issues if it's there."""
+    issue = tree.prefetched.get(key)
+    if issue is None:
+        issue = records.get_issue(tree.jira, key, tree.plan)
+    return issue
+
+
+def fetch(tree, keys):
+    """Fetches concurrently the issues that haven't been fetched yet and returns
+    the issues that exist."""
+    missing = [k for k in keys if k not in tree.prefetched]
+    if missing:
+        try:
+            tree.prefetched.update(records.fetch(tree.engine, missing, tree.plan))
+        except (deadline.Stopped, KeyboardInterrupt) as e:
+            if not deadline.stopping(e):
+                raise
+    return [tree.prefetched[k] for k in keys if k in tree.prefetched]
+
+
+def prefetch(tree, issues, depth):
+    """Fetches the issues implementing (inward links) the open issues, then the
+    ones implementing them and so on, down to depth levels. That's what the tree
+    walk will ask for, one issue at a time."""
+    if tree.engine is None:
+        return
+    for _ in range(depth):
+        keys = []
+        for issue in issues:
+            if issue.fields.status.name in ["Closed", "Resolved", "Completed"]:
+                continue
+            for link in issue.fields.issuelinks:
+                if "inwardIssue" in link.raw:
+                    keys.append(str(link.inwardIssue.key))
+        issues = fetch(tree, keys)
+
+
+def build_partial(build, tree, issue, d_handled):
+    """Returns build(tree, issue, d_handled), or the part of the node built
+    before the deadline or Ctrl-C stopped the requests."""
+    try:
+        return build(tree, issue, d_handled)
+    except (deadline.Stopped, KeyboardInterrupt) as e:
+        if not deadline.stopping(e):
+            raise
+        key = str(getattr(issue, "key", issue))
+        return d_handled.get(key, [None])[0]
+
+
 ################################################################################
 # Stories
 ################################################################################
-def build_story_node(jira, story_key, d_handled=None, epic_node=None):
-    si = jira.issue(story_key)
+def build_story_node(tree, story_key, d_handled=None, epic_node=None):
+    si = get_issue(tree, story_key)
     if si.fields.status.name in ["Closed", "Resolved", "Completed"]:
         d_handled[str(si.key)] = [None, si]
         return None
@@ -416,7 +522,7 @@ def build_story_node(jira, story_key, d_handled=None, epic_node=None):
     story.add_assignee(assignee)
 
     story.set_state(str(si.fields.status.name))
-    story.set_base_url(cfg.server)
+    story.set_base_url(tree.server_url)
 
     if epic_node is not None:
         story.add_parent(epic_node.get_key())
@@ -424,7 +530,7 @@ def build_story_node(jira, story_key, d_handled=None, epic_node=None):
     else:
         # This cateches when people are not using implements/implemented by, but
         # there is atleast an "Epic" link that we can use.
-        parent = get_parent_key(jira, si)
+        parent = get_parent_key(tree.jira, si)
         if parent is not None and parent in d_handled:
             parent_node = d_handled[parent][0]
             if parent_node is not None:
@@ -441,8 +547,8 @@ def build_story_node(jira, story_key, d_handled=None, epic_node=None):
 ################################################################################
 # Epics
 ################################################################################
-def build_epics_node(jira, epic_key, d_handled=None, initiative_node=None):
-    ei = jira.issue(epic_key)
+def build_epics_node(tree, epic_key, d_handled=None, initiative_node=None):
+    ei = get_issue(tree, epic_key)
 
     if ei.fields.status.name in ["Closed", "Resolved", "Completed"]:
         d_handled[str(ei.key)] = [None, ei]
@@ -462,14 +568,16 @@ def build_epics_node(jira, epic_key, d_handled=None, initiative_node=None):
     epic.set_state(str(ei.fields.status.name))
 
     try:
-        sponsors = ei.fields.customfield_10101
+        sponsors = getattr(
+            ei.fields, get_field_id(tree.jira, "Sponsors", "customfield_10101")
+        )
         if sponsors is not None:
             for s in sponsors:
                 epic.add_sponsor(str(s.value))
     except AttributeError:
         epic.add_sponsor("No sponsor")
 
-    epic.set_base_url(cfg.server)
+    epic.set_base_url(tree.server_url)
 
     if initiative_node is not None:
         epic.add_parent(initiative_node.get_key())
@@ -477,7 +585,7 @@ def build_epics_node(jira, epic_key, d_handled=None, initiative_node=None):
     else:
         # This cateches when people are not using implements/implemented by, but
         # there is atleast an "Initiative" link that we can use.
-        parent = get_parent_key(jira, ei)
+        parent = get_parent_key(tree.jira, ei)
         if parent is not None and parent in d_handled:
             parent_node = d_handled[parent][0]
             if parent_node is not None:
@@ -492,7 +600,7 @@ def build_epics_node(jira, epic_key, d_handled=None, initiative_node=None):
     for link in ei.fields.issuelinks:
         if "inwardIssue" in link.raw:
             story_key = str(link.inwardIssue.key)
-            build_story_node(jira, story_key, d_handled, epic)
+            build_story_node(tree, story_key, d_handled, epic)
 
     print(epic)
     return epic
@@ -501,7 +609,7 @@ def build_epics_node(jira, epic_key, d_handled=None, initiative_node=None):
 ################################################################################
 # Initiatives
 ################################################################################
-def build_initiatives_node(jira, issue, d_handled):
+def build_initiatives_node(tree, issue, d_handled):
     if issue.fields.status.name in ["Closed", "Resolved", "Completed"]:
         d_handled[str(issue.key)] = [None, issue]
         return None
@@ -520,13 +628,14 @@ def build_initiatives_node(jira, issue, d_handled):
     initiative.set_state(str(issue.fields.status.name))
 
     sponsors = None
-    if hasattr(issue.fields, "customfield_10101"):
-        sponsors = issue.fields.customfield_10101
+    sponsors_field = get_field_id(tree.jira, "Sponsors", "customfield_10101")
+    if hasattr(issue.fields, sponsors_field):
+        sponsors = getattr(issue.fields, sponsors_field)
 
     if sponsors is not None:
         for s in sponsors:
             initiative.add_sponsor(str(s.value))
-    initiative.set_base_url(cfg.server)
+    initiative.set_base_url(tree.server_url)
     print(initiative)
 
     d_handled[initiative.get_key()] = [initiative, issue]  # Initiative
@@ -535,26 +644,27 @@ def build_initiatives_node(jira, issue, d_handled):
     for link in issue.fields.issuelinks:
         if "inwardIssue" in link.raw:
             epic_key = str(link.inwardIssue.key)
-            build_epics_node(jira, epic_key, d_handled, initiative)
+            build_epics_node(tree, epic_key, d_handled, initiative)
 
     return initiative
 
 
-def build_initiatives_tree(jira, key, d_handled):
+def build_initiatives_tree(tree, key, d_handled):
     jql = "project=%s AND issuetype in (Initiative)" % (key)
-    initiatives = jira.search_issues(jql)
+    initiatives = records.search(tree.jira, jql, tree.plan, tree.engine, MAX_RESULTS)
+    prefetch(tree, initiatives, 2)
 
     nodes = []
     for i in initiatives:
-        node = build_initiatives_node(jira, i, d_handled)
+        node = build_partial(build_initiatives_node, tree, i, d_handled)
         if node is not None:
             nodes.append(node)
     return nodes
 
 
-def build_orphans_tree(jira, key, d_handled):
+def build_orphans_tree(tree, key, d_handled):
     jql = "project=%s" % (key)
-    all_issues = jira.search_issues(jql)
+    all_issues = records.search(tree.jira, jql, tree.plan, tree.engine, MAX_RESULTS)
 
     orphans_initiatives = []
     orphans_epics = []
@@ -571,6 +681,11 @@ def build_orphans_tree(jira, key, d_handled):
                 elif i.fields.issuetype.name == "Story":
                     orphans_stories.append(i)
 
+    if tree.engine is not None:
+        fetch(tree, [str(i.key) for i in orphans_epics + orphans_stories])
+        prefetch(tree, orphans_initiatives, 2)
+        prefetch(tree, fetch(tree, [str(i.key) for i in orphans_epics]), 1)
+
     # Now we three list of Jira tickets not touched before, let's go over them
     # staring with Initiatives, then Epics and last Stories. By doing so we
     # should get them nicely layed out in the orphan part of the tree.
@@ -578,104 +693,107 @@ def build_orphans_tree(jira, key, d_handled):
     nodes = []
     log.debug("Orphan Initiatives ...")
     for i in orphans_initiatives:
-        node = build_initiatives_node(jira, i, d_handled)
-        nodes.append(node)
+        node = build_partial(build_initiatives_node, tree, i, d_handled)
+        if node is not None:
+            nodes.append(node)
 
     log.debug("Orphan Epics ...")
     for i in orphans_epics:
-        node = build_epics_node(jira, str(i.key), d_handled)
-        nodes.append(node)
+        node = build_partial(build_epics_node, tree, str(i.key), d_handled)
+        if node is not None:
+            nodes.append(node)
 
     log.debug("Orphan Stories ...")
     for i in orphans_stories:
-        node = build_story_node(jira, str(i.key), d_handled)
-        nodes.append(node)
+        node = build_partial(build_story_node, tree, str(i.key), d_handled)
+        if node is not None:
+            nodes.append(node)
 
     return nodes
 
 
-################################################################################
-# Config files
-################################################################################
-def get_config_file():
-    """Returns the location for the config file (including the path)."""
-    for d in cfg.config_locations:
-        for f in [cfg.config_filename, cfg.config_legacy_filename]:
-            checked_file = d + "/" + f
-            if os.path.isfile(checked_file):
-                return d + "/" + f
-
-
-def initiate_config():
-    """Reads the config file (yaml format) and returns the sets the global
-    instance.
-    """
-    cfg.config_file = get_config_file()
-    if not os.path.isfile(cfg.config_file):
-        create_default_config()
-
-    log.debug("Using config file: %s" % cfg.config_file)
-    with open(cfg.config_file, "r") as yml:
-        cfg.yml_config = yaml.load(yml)
-
-
 ################################################################################
 # Main function
 ################################################################################
-def main():
-    argv = sys.argv
-    parser = get_parser()
+def run(jira, username, args):
+    """Builds the tree of the project of args and writes it to PROJECT.mm."""
+    key = args.project or "SWG"
 
-    # The parser arguments (cfg.args) are accessible everywhere after this call.
-    cfg.args = parser.parse_args()
+    if args.cached:
+        from jipdate import mirror
 
-    # This initiates the global yml configuration instance so it will be
-    # accessible everywhere after this call.
-    initiate_config()
-
-    key = "SWG"
-
-    if cfg.args.test:
-        test()
-        exit()
-
-    jira, username = jiralogin.get_jira_instance(cfg.args.t)
-
-    if cfg.args.project:
-        key = cfg.args.project
+        cli.phase("sync")
+        jira = mirror.open_mirror(jira, username, [key])
+        engine = None
+    else:
+        engine = cli.open_engine(jira, args)
+    plan = projection.plan_jipfp(jira, args)
+    tree = Tree(jira, engine, plan, get_server_url(args.t))
 
     # Open and initialize the file
     f = open_file(key + ".mm")
-    root_nodes_start(f, key)
+    root_nodes_start(f, key, tree.server_url)
 
     # Temporary dictorionary to keep track the data (issues) that we already
     # have dealt with.
     d_handled = {}
 
     # Build the main tree with Initiatives beloninging to the project.
-    nodes = build_initiatives_tree(jira, key, d_handled)
+    cli.phase("query")
+    nodes = build_initiatives_tree(tree, key, d_handled)
 
     # Take care of the orphans, i.e., those who has no connection to any
     # initiative in your project.
-    nodes_orpans = build_orphans_tree(jira, key, d_handled)
+    nodes_orpans = build_orphans_tree(tree, key, d_handled)
 
     # FIXME: We run through this once more since, when we run it the first time
     # we will catch Epics and Stories who are not linked with
     # "implements/implemented by" but instead uses the so called "Epic" link.
-    nodes_orpans = build_orphans_tree(jira, key, d_handled)
+    if not deadline.is_stopped():
+        nodes_orpans = build_orphans_tree(tree, key, d_handled)
 
     # Dump the main tree to file
+    cli.phase("write")
     for n in sorted(nodes):
-        n.to_xml(f)
+        n.to_xml(f, args)
 
     orphan_node_start(f)
     for n in sorted(nodes_orpans):
-        n.to_xml(f)
+        n.to_xml(f, args)
     orphan_node_end(f)
+    incomplete_node(f)
 
     # End the file
     root_nodes_end(f)
     f.close()
+    metrics.add_output(f.name)
+
+
+def main():
+    argv = sys.argv
+    parser = get_parser()
+
+    # The parser arguments (cfg.args) are accessible everywhere after this call.
+    cfg.args = parser.parse_args()
+    cli.setup(cfg.args)
+    deadline.start(cfg.args.deadline)
+
+    # This initiates the global yml configuration instance so it will be
+    # accessible everywhere after this call.
+    cfg.initiate_config()
+
+    if cfg.args.test:
+        test()
+        exit()
+
+    cli.phase("login")
+    try:
+        jira, username = jiralogin.get_jira_instance(cfg.args.t)
+    except deadline.Stopped:
+        # Stopped before anything could be collected.
+        deadline.finish()
+    run(jira, username, cfg.args)
+    deadline.finish()
 
 
 if __name__ == "__main__":
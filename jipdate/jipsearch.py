@@ -4,13 +4,16 @@ import logging as log
 import re
 import os
 import sys
-import yaml
-from dateutil import parser
-from jira import JIRAError
 
 # Local files
 from jipdate import cfg
+from jipdate import cli
+from jipdate import deadline
 from jipdate import jiralogin
+from jipdate import metrics
+from jipdate import projection
+from jipdate import records
+from jipdate import users
 from jipdate import __version__
 
 
@@ -200,6 +203,17 @@ def get_parser():
         help="""Do not make any changes to JIRA""",
     )
 
+    parser.add_argument(
+        "--cached",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Sync the local mirror of the project(s) and answer from it",
+    )
+
+    cli.add_deadline_argument(parser)
+    cli.add_common_arguments(parser)
+
     return parser
 
 
@@ -217,60 +231,60 @@ def initialize_logger(args):
     )
 
 
-def create_jql(jira, initial_jql):
+def create_jql(jira, initial_jql, args):
+    """Returns the JQL of a search, initial_jql restricted by the options (args,
+    like the parsed arguments) of jipsearch."""
     jql_parts = []
     if initial_jql and initial_jql != "":
         jql_parts.append(initial_jql)
 
-    if cfg.args.key:
-        key_parts = f"key in ({cfg.args.key[0]}"
-        for v in cfg.args.key[1:]:
+    if args.key:
+        key_parts = f"key in ({args.key[0]}"
+        for v in args.key[1:]:
             key_parts += f", {v}"
         jql_parts.append(f"{key_parts})")
 
-    if cfg.args.project:
-        jql_parts.append("project in (%s)" % cfg.args.project)
+    if args.project:
+        jql_parts.append("project in (%s)" % args.project)
 
-    if cfg.args.sprint:
-        jql_parts.append("sprint in ('%s')" % cfg.args.sprint)
+    if args.sprint:
+        jql_parts.append("sprint in ('%s')" % args.sprint)
 
-    if cfg.args.reporter:
+    if args.reporter:
         reporter_ids = []
-        reporters = cfg.args.reporter.split(",")
+        reporters = args.reporter.split(",")
         for r in reporters:
-            reporter_ids += jira.search_users(query=r)
+            reporter_ids += users.get_directory(jira).search_users(r)
         if len(reporter_ids) > 0:
             account_ids = []
             for ri in reporter_ids:
                 account_ids.append(ri.accountId)
             jql_parts.append("reporter in (%s)" % ",".join(account_ids))
 
-    if cfg.args.assignee:
+    if args.assignee:
         assignee_ids = []
-        for r in cfg.args.assignee:
-            assignee_ids += jira.search_users(query=r)
+        for r in args.assignee:
+            assignee_ids += users.get_directory(jira).search_users(r)
         if len(assignee_ids) > 0:
             account_ids = []
             for ai in assignee_ids:
                 account_ids.append(ai.accountId)
             jql_parts.append("assignee in (%s)" % ",".join(account_ids))
 
-    if cfg.args.epic:
-        jql_parts.append(
-            "(key = %s or parentepic = %s)" % (cfg.args.epic, cfg.args.epic)
-        )
+    if args.epic:
+        jql_parts.append("(key = %s or parentepic = %s)" % (args.epic, args.epic))
 
-    if cfg.args.created_after:
-        jql_parts.append("created >= %s" % cfg.args.created_after)
+    if args.created_after:
+        jql_parts.append("created >= %s" % args.created_after)
 
-    if cfg.args.created_before:
-        jql_parts.append("created <= %s" % cfg.args.created_before)
+    if args.created_before:
+        jql_parts.append("created <= %s" % args.created_before)
 
-    if cfg.args.updated_after:
-        jql_parts.append("updated >= %s" % cfg.args.updated_after)
+    if args.updated_after:
+        jql_parts.append("updated >= %s" % args.updated_after)
 
-    if cfg.args.updated_before:
-        jql_parts.append("updated <= %s" % cfg.args.updated_before)
+    if args.updated_before:
+        jql_parts.append("updated <= %s" % args.updated_before)
 
     jql_string = " AND ".join(jql_parts)
 
@@ -278,63 +292,62 @@ def create_jql(jira, initial_jql):
     return jql_string
 
 
-def search_issues(jira, jql):
-    issues = []
-    result = {"startAt": 0, "total": 1}
+def iter_issues(jira, jql, args, engine=None):
+    """Yields the raw issues matching jql, with the fields the options (args)
+    need, one page at a time. Raises JIRAError if the search fails, stops at
+    the deadline."""
     max_results = 50
+    kwargs = projection.plan_jipsearch(args).kwargs()
 
-    while result["startAt"] < result["total"]:
-        fields = [
-            "summary",
-            "description",
-            "created",
-            "status",
-            "issuetype",
-            "assignee",
-            "timetracking",
-        ]
-
-        if cfg.args.format:
-            regex = r"\{(.+?)\}"
-            for keys in re.findall(regex, cfg.args.format):
-                fields.append(keys.split(":")[0])
+    try:
+        if engine is not None:
+            yield from engine.run(engine.search(jql, page_size=max_results, **kwargs))
+            return
 
-        if cfg.args.parent:
-            fields.append("parent")
+        for page in records.search_pages(jira, jql, max_results, **kwargs):
+            yield from page
+    except (deadline.Stopped, KeyboardInterrupt) as e:
+        if not deadline.stopping(e):
+            raise
 
-        try:
-            result = jira.search_issues(
-                jql,
-                startAt=result["startAt"],
-                maxResults=max_results,
-                fields=fields,
-                json_result=True,
-            )
-        except JIRAError as e:
-            print(f"{e.text}")
-            exit(1)
-        issues += result["issues"]
-        result["startAt"] += max_results
 
-    return issues
+def search_issues(jira, jql, args, engine=None):
+    from jira import JIRAError
+
+    try:
+        return list(iter_issues(jira, jql, args, engine))
+    except JIRAError as e:
+        print(f"{e.text}")
+        exit(1)
 
 
-def call_jqls(jira, jql):
+def call_jqls(jira, jql, args, engine=None):
     issues = []
     for j in jql:
-        jql_str = create_jql(jira, j)
-        issues += search_issues(jira, jql_str)
+        jql_str = create_jql(jira, j, args)
+        issues += search_issues(jira, jql_str, args, engine)
+    metrics.count_issues(len(issues))
     return issues
 
 
-def print_issues(jira, issues):
+def print_issues(jira, issues, args, engine=None):
+    from dateutil import parser
+
+    comments = {}
+    if engine is not None and args.comments:
+        try:
+            comments = engine.fetch_comments(issue["key"] for issue in issues)
+        except (deadline.Stopped, KeyboardInterrupt) as e:
+            if not deadline.stopping(e):
+                raise
+
     for issue in issues:
         jira_link = "https://linaro.atlassian.net/browse"
-        if cfg.args.format:
+        if args.format:
             regex = r"\{(.+?)\}"
-            format_line = re.sub(regex, "{}", cfg.args.format)
+            format_line = re.sub(regex, "{}", args.format)
             out = []
-            for keys in re.findall(regex, cfg.args.format):
+            for keys in re.findall(regex, args.format):
                 tmp_output = issue["fields"]
                 for k in keys.split(":"):
                     if len(keys.split(":")) == 1 and "key" == k:
@@ -353,7 +366,7 @@ def print_issues(jira, issues):
             assignee_ = f", Assignee: {issue['fields']['assignee']['displayName']}, Assignee email: {issue['fields']['assignee']['emailAddress']}"
             output += assignee_
 
-        if cfg.args.parent:
+        if args.parent:
             try:
                 field = issue["fields"]["parent"]
                 value = f" parent: {jira_link}/{field['key']}"
@@ -363,7 +376,7 @@ def print_issues(jira, issues):
             continue
 
         print(f"{output}")
-        if cfg.args.description:
+        if args.description:
             print(f"# Description:")
             descriptions = issue["fields"]["description"]
             if descriptions:
@@ -371,8 +384,16 @@ def print_issues(jira, issues):
                     print(f"#   {line}")
                 print(f"#\n")
 
-        if cfg.args.comments:
-            c = jira.comments(issue["key"])
+        if args.comments:
+            c = comments.get(issue["key"])
+            if c is None:
+                try:
+                    c = jira.comments(issue["key"])
+                except (deadline.Stopped, KeyboardInterrupt) as e:
+                    # Print the issue without its comments.
+                    if not deadline.stopping(e):
+                        raise
+                    c = []
             if len(c) > 0:
                 try:
                     timespent = issue["fields"]["timetracking"]["timeSpent"]
@@ -399,6 +420,32 @@ def print_issues(jira, issues):
 ################################################################################
 # Main function
 ################################################################################
+def run(jira, username, args):
+    """Prints the issues matching the options args."""
+    issues = []
+
+    if args.cached:
+        from jipdate import mirror
+
+        cli.phase("sync")
+        projects = args.project.split(",") if args.project else []
+        jira = mirror.open_mirror(jira, username, projects)
+        engine = None
+    else:
+        engine = cli.open_engine(jira, args)
+
+    cli.phase("query")
+    if args.jql:
+        jql = args.jql
+        log.debug(f"JQL: " + jql[0])
+        issues = call_jqls(jira, jql, args, engine)
+    else:
+        issues = call_jqls(jira, [""], args, engine)
+
+    cli.phase("render")
+    print_issues(jira, issues, args, engine)
+
+
 def main():
     argv = sys.argv
     parser = get_parser()
@@ -410,21 +457,21 @@ def main():
     cfg.args = parser.parse_args()
 
     initialize_logger(cfg.args)
+    cli.setup(cfg.args)
+    deadline.start(cfg.args.deadline)
 
     # This initiates the global yml configuration instance so it will be
     # accessible everywhere after this call.
     cfg.initiate_config()
 
-    jira, username = jiralogin.get_jira_instance(False)
-    issues = []
-    if cfg.args.jql:
-        jql = cfg.args.jql
-        log.debug(f"JQL: " + jql[0])
-        issues = call_jqls(jira, jql)
-    else:
-        issues = call_jqls(jira, [""])
-
-    print_issues(jira, issues)
+    cli.phase("login")
+    try:
+        jira, username = jiralogin.get_jira_instance(False)
+    except deadline.Stopped:
+        # Stopped before anything could be collected.
+        deadline.finish()
+    run(jira, username, cfg.args)
+    deadline.finish()
 
 
 if __name__ == "__main__":
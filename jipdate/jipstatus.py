@@ -2,26 +2,25 @@
 from argparse import ArgumentParser
 from subprocess import call
 from time import gmtime, strftime
-from jinja2 import Template
 
 import datetime
-import json
 import logging as log
 import os
 import re
 import sys
 import tempfile
-import yaml
 
 # Local files
 from jipdate import cfg
+from jipdate import cli
+from jipdate import deadline
 from jipdate import jiralogin
+from jipdate import metrics
+from jipdate import projection
+from jipdate import records
+from jipdate import users
 from jipdate import __version__
 
-import pprint
-
-pprint = pprint.PrettyPrinter().pprint
-
 
 def add_domain(user):
     """
@@ -33,9 +32,12 @@ def add_domain(user):
     return user
 
 
-def default_jql():
-    project = cfg.args.project
-    team = cfg.args.team
+def default_jql(args, jira=None):
+    """Returns the JQL selecting the issues of the project, team or users of the
+    options (args, like the parsed arguments) of jipstatus. With jira, the users
+    are looked up in the user directory of its server, see users.py."""
+    project = args.project
+    team = args.team
 
     if team and project:
         jql = "(project = %s or assignee in membersOf('%s')) " % (project, team)
@@ -44,34 +46,32 @@ def default_jql():
     elif project:
         jql = "project =  '%s' " % project
     else:
-        # cfg.args.user is a list with 1 or more users
+        # args.user is a list with 1 or more users
         # we construct the query as:
         # (assignee = 'user1' or assignee = 'user2' )
-        users = list(map(add_domain, cfg.args.user))
+        assignees = list(map(add_domain, args.user))
+        if jira is not None:
+            directory = users.get_directory(jira)
+            assignees = list(map(directory.get_jql_user, assignees))
         jql = (
-            "(" + " or ".join(map(lambda str: "assignee = '" + str + "'", users)) + ")"
+            "("
+            + " or ".join(map(lambda str: "assignee = '" + str + "'", assignees))
+            + ")"
         )
 
     return jql
 
 
-def enumerate_updates(jira):
-    since = datetime.datetime.now() - datetime.timedelta(days=int(cfg.args.days))
+def enumerate_updates(jira, args):
+    """Yields the comments and resolutions of the last args.days days, per
+    issue."""
+    since = datetime.datetime.now() - datetime.timedelta(days=int(args.days))
 
-    jql = default_jql()
-    jql += "AND updatedDate > -%sd" % cfg.args.days
+    jql = default_jql(args, jira)
+    jql += "AND updatedDate > -%sd" % args.days
     log.debug(jql)
 
-    my_issues = jira.search_issues(
-        jql, expand="changelog", fields="summary,comment,components,assignee,created"
-    )
-    if my_issues.total > my_issues.maxResults:
-        my_issues = jira.search_issues(
-            jql,
-            expand="changelog",
-            fields="summary,comment,components,assignee,created",
-            maxResults=my_issues.total,
-        )
+    my_issues = records.search(jira, jql, projection.plan_jipstatus("updates"))
 
     for issue in my_issues:
         changelog = issue.changelog
@@ -113,25 +113,18 @@ def enumerate_updates(jira):
             yield (status)
 
 
-def enumerate_pending(jira):
+def enumerate_pending(jira, args):
+    """Yields the issues in progress, new ones being the ones created in the
+    last 7 days."""
     since = datetime.datetime.now() - datetime.timedelta(days=7)
 
-    jql = default_jql()
+    jql = default_jql(args, jira)
     jql += "AND status = 'In Progress' \
             AND issuetype != Initiative \
             AND issuetype != Epic"
     log.debug(jql)
 
-    my_issues = jira.search_issues(
-        jql, expand="changelog", fields="summary,assignee,created,components"
-    )
-    if my_issues.total > my_issues.maxResults:
-        my_issues = jira.search_issues(
-            jql,
-            expand="changelog",
-            fields="summary,assignee,created,components",
-            maxResults=my_issues.total,
-        )
+    my_issues = records.search(jira, jql, projection.plan_jipstatus("pending"))
 
     for issue in my_issues:
         status = {}
@@ -226,6 +219,17 @@ def get_parser():
         help="Output some verbose debugging info",
     )
 
+    parser.add_argument(
+        "--cached",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Sync the local mirror of the project(s) and answer from it",
+    )
+
+    cli.add_deadline_argument(parser)
+    cli.add_common_arguments(parser)
+
     return parser
 
 
@@ -247,6 +251,9 @@ def initialize_logger(args):
 # Template for outout
 ################################################################################
 output = """
+{%- if incomplete %}
+{{incomplete}}
+{%- endif %}
 {%- for assignee in assignees %}
 {{assignee}}:
 {%- for issue in updates | selectattr('assignee', 'equalto', assignee) | list %}
@@ -272,6 +279,9 @@ output = """
 output_html = """
 <html>
 <body>
+{%- if incomplete %}
+<p><b>{{incomplete}}</b></p>
+{%- endif %}
 {%- for assignee in assignees %}
 {{assignee}}:
 <ul>
@@ -314,26 +324,31 @@ output_html = """
 ################################################################################
 # Main function
 ################################################################################
-def main():
-    argv = sys.argv
-    parser = get_parser()
-
-    # The parser arguments (cfg.args) are accessible everywhere after this call.
-    cfg.args = parser.parse_args()
-
-    initialize_logger(cfg.args)
-
-    # This initiates the global yml configuration instance so it will be
-    # accessible everywhere after this call.
-    cfg.initiate_config()
-
-    jira, username = jiralogin.get_jira_instance(cfg.args.test)
-
-    if cfg.args.user is None:
-        cfg.args.user = [username]
-
-    updates = list(enumerate_updates(jira))
-    pendings = list(enumerate_pending(jira))
+def run(jira, username, args):
+    """Prints the status report of the options args, and writes it in HTML
+    with --html."""
+    from jinja2 import Template
+
+    if args.user is None:
+        args.user = [username]
+
+    if args.cached:
+        from jipdate import mirror
+
+        cli.phase("sync")
+        projects = [args.project] if args.project else []
+        jira = mirror.open_mirror(jira, username, projects)
+
+    cli.phase("query")
+    updates, pendings = [], []
+    try:
+        updates.extend(enumerate_updates(jira, args))
+        pendings.extend(enumerate_pending(jira, args))
+    except (deadline.Stopped, KeyboardInterrupt) as e:
+        # Report what has been collected so far.
+        if not deadline.stopping(e):
+            raise
+    incomplete = deadline.get_message() if deadline.is_stopped() else None
 
     assignees = sorted(
         set([u["assignee"] for u in updates]) | set([p["assignee"] for p in pendings])
@@ -341,6 +356,7 @@ def main():
     # Move "Unassigned" issues to the end
     assignees.sort(key="Unassigned".__eq__)
 
+    cli.phase("render")
     template = Template(output)
     print(
         template.render(
@@ -348,11 +364,13 @@ def main():
             updates=updates,
             pendings=pendings,
             url=jira.client_info(),
+            incomplete=incomplete,
         )
     )
 
-    if cfg.args.html:
-        f = open(cfg.args.html, "w")
+    if args.html:
+        cli.phase("write")
+        f = open(args.html, "w")
         template = Template(output_html)
         f.write(
             template.render(
@@ -360,9 +378,36 @@ def main():
                 updates=updates,
                 pendings=pendings,
                 url=jira.client_info(),
+                incomplete=incomplete,
             )
         )
         f.close()
+        metrics.add_output(args.html)
+
+
+def main():
+    argv = sys.argv
+    parser = get_parser()
+
+    # The parser arguments (cfg.args) are accessible everywhere after this call.
+    cfg.args = parser.parse_args()
+
+    initialize_logger(cfg.args)
+    cli.setup(cfg.args)
+    deadline.start(cfg.args.deadline)
+
+    # This initiates the global yml configuration instance so it will be
+    # accessible everywhere after this call.
+    cfg.initiate_config()
+
+    cli.phase("login")
+    try:
+        jira, username = jiralogin.get_jira_instance(cfg.args.test)
+    except deadline.Stopped:
+        # Stopped before anything could be collected.
+        deadline.finish()
+    run(jira, username, cfg.args)
+    deadline.finish()
 
 
 if __name__ == "__main__":
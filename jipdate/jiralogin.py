@@ -1,20 +1,18 @@
 import os
 import getpass
+import hashlib
 import logging as log
 import sys
+import time
 
 from jipdate import cfg
-from jira import JIRA
-from jira import JIRAError
+from jipdate import jsonlib
 
 
 def get_username_from_config():
     """Get the username for Jira from the config file."""
-    username = None
-    # First check if the username is in the config file.
-    try:
-        username = cfg.yml_config["username"]
-    except:
+    username = cfg.get_str("username")
+    if username is None:
         log.debug("username not set in config")
 
     return username
@@ -89,52 +87,144 @@ def get_password():
     return password
 
 
-def get_jira_instance(use_test_server):
+def get_server_info_file(url):
+    """Returns the name of the file caching the server information for url."""
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return cfg.get_cache_file("server-%s.json" % digest)
+
+
+def load_server_info(url, ttl):
+    """Returns the cached server information for url, or None if there is no
+    cached information or if it is older than ttl seconds."""
+    try:
+        with open(get_server_info_file(url), "r") as f:
+            cached = jsonlib.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("url") != url or time.time() - cached.get("fetched", 0) > ttl:
+        log.debug("Cached server information for %s is stale" % url)
+        return None
+    return cached["server_info"]
+
+
+def store_server_info(url, si):
+    """Stores the parts of the server information that we need between runs."""
+    cached = {
+        "url": url,
+        "fetched": time.time(),
+        "server_info": {
+            "versionNumbers": si["versionNumbers"],
+            "deploymentType": si.get("deploymentType"),
+            "baseUrl": si.get("baseUrl", url),
+        },
+    }
+    try:
+        with open(get_server_info_file(url), "w") as f:
+            jsonlib.dump(cached, f)
+    except OSError as e:
+        log.debug("Could not cache the server information: %s" % e)
+
+
+def get_server_info(jira, connection):
+    """
+    Sets the server information (deployment type and version) the JIRA instance
+    needs to know which API calls are available. With "cache_server_info"
+    enabled it is read from the cache instead of asking the server each time.
+    """
+    url = jira.client_info()
+    si = None
+    if connection["cache_server_info"]:
+        si = load_server_info(url, connection["server_info_ttl"])
+
+    if si is None:
+        si = jira.server_info()
+        if connection["cache_server_info"]:
+            store_server_info(url, si)
+    else:
+        log.debug("Using cached server information for %s" % url)
+
+    jira._version = tuple(si["versionNumbers"])
+    jira.deploymentType = si.get("deploymentType")
+
+
+def connect(url, username, secret, identity_map=True):
+    """
+    Creates a JIRA instance talking to the server through the pooled jipdate
+    transport. Retries are handled by the transport, hence they are disabled in
+    the JIRA session itself. With identity_map, an issue is only fetched once
+    for as long as the instance lives, see httpcache.IdentityMap.
+    """
+    from jira import JIRA
+    from jipdate import httpcache
+    from jipdate import metadata
+    from jipdate import transport
+
+    connection = cfg.get_connection_config()
+    jira = JIRA(
+        url,
+        basic_auth=(username, secret),
+        options={"headers": {"Accept": "application/json;1=1.0, */*;q=0.9"}},
+        timeout=transport.get_timeout(connection),
+        max_retries=0,
+        get_server_info=False,
+    )
+    identity = None
+    if identity_map and connection["identity_map"]:
+        identity = httpcache.IdentityMap()
+    transport.mount(jira._session, connection, httpcache.open_cache(url), identity)
+    get_server_info(jira, connection)
+    metadata.get_registry(jira)
+    return jira
+
+
+def get_jira_instance(use_test_server, identity_map=True):
     """
     Makes a connection to the Jira server and returns the Jira instance to the
-    caller.
+    caller. identity_map is False for the instances living longer than a run of
+    a command.
     """
-    username = get_username()
+    from jira import JIRAError
+    from jipdate import cassette
+    from jipdate import jipd
+
+    if cassette.player is not None:
+        # The recorded responses don't need the credentials.
+        username = cassette.player.username
+        return (
+            connect(cassette.player.server, username, "", identity_map),
+            username,
+        )
 
     server = cfg.get_server(use_test_server)
     url = server.get("url")
     token = server.get("token")
 
-    # password based authentication
-    if not token:
-        password = get_password()
+    # A running jipd daemon already holds an authenticated session, the
+    # requests recorded to a cassette must be sent by this process.
+    if not cassette.enabled():
+        j = jipd.get_jira_instance(url)
+        if j is not None:
+            return j
+
+    username = get_username()
+    if cassette.recorder is not None:
+        cassette.recorder.set_server(url, username)
+
+    # token based authentication, otherwise fall back to password
+    if token:
+        secret = token
+        method = "token"
+    else:
+        secret = get_password()
+        method = "password"
 
     try:
-        if token:
-            log.debug(
-                "Accessing %s with %s using token based authentication"
-                % (url, username)
-            )
-            j = (
-                JIRA(
-                    url,
-                    basic_auth=(username, token),
-                    options={
-                        "headers": {"Accept": "application/json;1=1.0, */*;q=0.9"}
-                    },
-                ),
-                username,
-            )
-        else:
-            log.debug(
-                "Accessing %s with %s using password based authentication"
-                % (url, username)
-            )
-            j = (
-                JIRA(
-                    url,
-                    basic_auth=(username, password),
-                    options={
-                        "headers": {"Accept": "application/json;1=1.0, */*;q=0.9"}
-                    },
-                ),
-                username,
-            )
+        log.debug(
+            "Accessing %s with %s using %s based authentication"
+            % (url, username, method)
+        )
+        j = (connect(url, username, secret, identity_map), username)
     except JIRAError as e:
         if e.text.find("CAPTCHA_CHALLENGE") != -1:
             log.error(
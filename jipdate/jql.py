@@ -0,0 +1,453 @@
+"""
+Local evaluation of JQL queries on raw (JSON) Jira issues.
+
+Only the subset of JQL used by the jip* commands is supported: AND, OR, NOT,
+parentheses, the = != < <= > >= ~ !~ [NOT] IN and IS [NOT] EMPTY operators,
+the currentUser() and membersOf() functions and ORDER BY. Anything else raises
+a JqlError, so that callers can fall back to asking the Jira server.
+
+The compiled query also tells the projects its issues can belong to (see
+JqlParser.projects), so that callers know whether the issues they hold locally
+are enough to answer it.
+"""
+
+import datetime
+import functools
+import re
+
+REGEX_TOKEN = re.compile(
+    r"""\s*(?:(?P<lparen>\()|(?P<rparen>\))|(?P<comma>,)|(?P<op>!=|>=|<=|!~|=|>|<|~)|
+    (?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|(?P<word>[^\s(),=!<>~"']+))""",
+    re.X,
+)
+
+REGEX_PERIOD = re.compile(r"^([-+]?)\s*((?:\d+\s*[wdhm]\s*)+)$")
+
+REGEX_KEY = re.compile(r"^([A-Z][A-Z0-9_]*)-(\d+)$")
+
+FIELD_ALIASES = {
+    "issuekey": "key",
+    "id": "key",
+    "type": "issuetype",
+    "createddate": "created",
+    "updateddate": "updated",
+    "epic link": "epiclink",
+    "parent link": "parentlink",
+    "component": "components",
+    "text": "summary",
+}
+
+DATE_FIELDS = ["created", "updated", "resolutiondate", "duedate"]
+
+# Fields that can be used in the queries, after FIELD_ALIASES.
+FIELDS = [
+    "key",
+    "project",
+    "issuetype",
+    "status",
+    "resolution",
+    "priority",
+    "assignee",
+    "reporter",
+    "components",
+    "labels",
+    "sprint",
+    "epiclink",
+    "parentlink",
+    "parentepic",
+    "parent",
+    "summary",
+    "description",
+] + DATE_FIELDS
+
+# Custom fields holding the sprints, the epic link and the parent link, when
+# the server doesn't tell their ids (see JqlParser).
+SPRINT_FIELD = "customfield_10020"
+EPIC_LINK_FIELD = "customfield_10014"
+PARENT_LINK_FIELD = "customfield_10005"
+
+
+class JqlError(Exception):
+    pass
+
+
+def tokenize(jql):
+    tokens = []
+    pos = 0
+    jql = jql.strip()
+    while pos < len(jql):
+        m = REGEX_TOKEN.match(jql, pos)
+        if m is None or m.end() == pos:
+            raise JqlError("Error in the JQL Query at '%s'" % jql[pos:])
+        pos = m.end()
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "str":
+            value = value[1:-1].replace('\\"', '"').replace("\\'", "'")
+        tokens.append((kind, value))
+    return tokens
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_jira_date(value):
+    """Converts a date from a Jira issue to an aware UTC datetime."""
+    if len(value) == 10:
+        d = datetime.datetime.strptime(value, "%Y-%m-%d")
+        return d.replace(tzinfo=datetime.timezone.utc)
+    d = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f%z")
+    return d.astimezone(datetime.timezone.utc)
+
+
+def to_datetime(value):
+    """Converts a JQL date ("-7d", "4w 2d", "2020/01/31 10:00", ...) to an
+    aware UTC datetime. Absolute dates are in local time, as in Jira."""
+    value = str(value).strip()
+    m = REGEX_PERIOD.match(value)
+    if m:
+        units = {"w": 7 * 24 * 60, "d": 24 * 60, "h": 60, "m": 1}
+        minutes = sum(
+            int(n) * units[u] for n, u in re.findall(r"(\d+)\s*([wdhm])", m.group(2))
+        )
+        sign = -1 if m.group(1) == "-" else 1
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return now + datetime.timedelta(minutes=sign * minutes)
+    for fmt in ["%Y/%m/%d %H:%M", "%Y-%m-%d %H:%M", "%Y/%m/%d", "%Y-%m-%d"]:
+        try:
+            d = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return d.astimezone(datetime.timezone.utc)
+    raise JqlError("Date value '%s' for field is invalid" % value)
+
+
+def sort_key(value):
+    """Sort key of a field value, issue keys are sorted by number."""
+    if value is None:
+        return (0, "", 0)
+    m = REGEX_KEY.match(str(value))
+    if m:
+        return (1, m.group(1), int(m.group(2)))
+    return (1, str(value).lower(), 0)
+
+
+class JqlParser:
+    """
+    Compiles a JQL query into a predicate taking a raw issue. current_user is
+    what currentUser() stands for, members_of(group) returns the
+    identifiers (account id, name, email) of the members of a group and
+    field_id(name, default) the id of a custom field from its name, e.g.,
+    metadata.Registry.field_id.
+
+    After compile(), projects is the set of the projects (upper case keys, or
+    names and ids as written in the query) the matching issues belong to, None
+    if the query doesn't restrict them.
+    """
+
+    def __init__(self, current_user=None, members_of=None, field_id=None):
+        self.current_user = current_user
+        self.members_of = members_of or (lambda group: [])
+        self.field_id = field_id or (lambda name, default: default)
+        self.order_by = []
+        self.projects = None
+
+    def compile(self, jql):
+        tokens = tokenize(jql)
+        self.order_by = []
+        self.projects = None
+        for i, (kind, value) in enumerate(tokens):
+            if kind == "word" and value.lower() == "order":
+                self.parse_order_by(tokens[i + 1 :])
+                tokens = tokens[:i]
+                break
+        self.tokens = tokens
+        self.pos = 0
+        if not tokens:
+            return lambda issue: True
+        predicate, self.projects = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise JqlError("Error in the JQL Query near '%s'" % self.peek()[1])
+        return predicate
+
+    def sort(self, issues):
+        """Sorts issues following the ORDER BY clause of the last compiled
+        query."""
+        issues = list(issues)
+        for field, descending in reversed(self.order_by):
+            getter = self.getter(field)
+
+            def key(issue):
+                values = getter(issue)
+                return sort_key(values[0] if values else None)
+
+            issues.sort(key=key, reverse=descending)
+        return issues
+
+    def parse_order_by(self, tokens):
+        if not tokens or tokens[0][1].lower() != "by":
+            raise JqlError("Expected BY after ORDER")
+        field = None
+        for kind, value in tokens[1:] + [("comma", ",")]:
+            if kind == "comma":
+                if field is None:
+                    raise JqlError("Error in the JQL Query: ORDER BY")
+                self.order_by.append(field)
+                field = None
+            elif field is None:
+                name = FIELD_ALIASES.get(value.lower(), value.lower())
+                self.getter(name)
+                field = (name, False)
+            elif value.lower() in ["asc", "desc"]:
+                field = (field[0], value.lower() == "desc")
+            else:
+                raise JqlError("Error in the JQL Query near '%s'" % value)
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise JqlError("Error in the JQL Query: unexpected end of query")
+        self.pos += 1
+        return token
+
+    def keyword(self, *words):
+        kind, value = self.peek()
+        if kind == "word" and value.lower() in words:
+            self.pos += 1
+            return value.lower()
+        return None
+
+    def expect(self, kind):
+        token = self.next()
+        if token[0] != kind:
+            raise JqlError("Error in the JQL Query: expected %s" % kind)
+        return token[1]
+
+    # The parse_* methods return the predicate of what they parsed and the
+    # projects its issues belong to (None: any project).
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.keyword("or"):
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        predicates = [t[0] for t in terms]
+        projects = None
+        if all(t[1] is not None for t in terms):
+            projects = set().union(*[t[1] for t in terms])
+        return lambda issue: any(p(issue) for p in predicates), projects
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.keyword("and"):
+            terms.append(self.parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        predicates = [t[0] for t in terms]
+        projects = None
+        for t in terms:
+            if t[1] is not None:
+                projects = t[1] if projects is None else projects & t[1]
+        return lambda issue: all(p(issue) for p in predicates), projects
+
+    def parse_not(self):
+        if self.keyword("not"):
+            term = self.parse_not()[0]
+            return lambda issue: not term(issue), None
+        if self.peek()[0] == "lparen":
+            self.next()
+            term = self.parse_or()
+            self.expect("rparen")
+            return term
+        return self.parse_clause()
+
+    def get_projects(self, field, values):
+        """Returns the projects of the issues whose field is one of values,
+        None if they can be in any project."""
+        if field == "project":
+            return set(str(v).upper() for v in values)
+        if field == "key":
+            keys = [REGEX_KEY.match(str(v).upper()) for v in values]
+            if all(keys):
+                return set(k.group(1) for k in keys)
+        return None
+
+    def parse_value(self):
+        kind, value = self.next()
+        if kind not in ["word", "str"]:
+            raise JqlError("Error in the JQL Query: expected a value")
+        if kind == "word" and self.peek()[0] == "lparen":
+            self.next()
+            params = []
+            while self.peek()[0] != "rparen":
+                params.append(self.parse_value())
+                if self.peek()[0] == "comma":
+                    self.next()
+            self.next()
+            return self.call(value, params)
+        return value
+
+    def call(self, function, params):
+        function = function.lower()
+        if function == "currentuser":
+            return self.current_user
+        if function == "membersof" and params:
+            return list(self.members_of(params[0]))
+        if function == "now":
+            return "0m"
+        raise JqlError("Unsupported JQL function %s()" % function)
+
+    def parse_clause(self):
+        kind, field = self.next()
+        if kind not in ["word", "str"]:
+            raise JqlError("Error in the JQL Query: expected a field")
+        field = FIELD_ALIASES.get(field.lower(), field.lower())
+        getter = self.getter(field)
+
+        if self.keyword("is"):
+            negate = self.keyword("not") is not None
+            if not self.keyword("empty", "null"):
+                raise JqlError("Expected EMPTY after IS")
+            return lambda issue: (not getter(issue)) != negate, None
+
+        negate = False
+        if self.keyword("not"):
+            negate = True
+            if not self.keyword("in"):
+                raise JqlError("Expected IN after NOT")
+            op = "in"
+        elif self.keyword("in"):
+            op = "in"
+        else:
+            op = self.expect("op")
+
+        if op == "in":
+            if self.peek()[0] == "lparen":
+                self.next()
+                values = []
+                while self.peek()[0] != "rparen":
+                    values.append(self.parse_value())
+                    if self.peek()[0] == "comma":
+                        self.next()
+                self.next()
+            else:
+                values = self.parse_value()
+            flat = []
+            for v in values if isinstance(values, list) else [values]:
+                flat.extend(v if isinstance(v, list) else [v])
+            match = self.matcher(field, "=", flat)
+            if negate:
+                return self.differs(getter, match), None
+            projects = self.get_projects(field, flat)
+            return lambda issue: match(getter(issue)), projects
+
+        value = self.parse_value()
+        if op in ["!=", "!~"]:
+            match = self.matcher(field, op[1:] if op == "!~" else "=", value)
+            return self.differs(getter, match), None
+        match = self.matcher(field, op, value)
+        projects = None
+        if op == "=":
+            values = value if isinstance(value, list) else [value]
+            projects = self.get_projects(field, values)
+        return lambda issue: match(getter(issue)), projects
+
+    def differs(self, getter, match):
+        """Returns the predicate of a negated clause (!=, !~, NOT IN), which
+        like in Jira doesn't match the issues where the field is empty."""
+
+        def predicate(issue):
+            values = getter(issue)
+            return any(values) and not match(values)
+
+        return predicate
+
+    def getter(self, field):
+        """Returns a function returning the values of field in an issue."""
+        if field not in FIELDS:
+            raise JqlError(
+                "Field '%s' does not exist or you do not have permission to view it."
+                % field
+            )
+        if field == "sprint":
+            sprint_field = self.field_id("Sprint", SPRINT_FIELD)
+        if field in ["epiclink", "parentlink", "parentepic"]:
+            epic_link_field = self.field_id("Epic Link", EPIC_LINK_FIELD)
+            parent_link_field = self.field_id("Parent Link", PARENT_LINK_FIELD)
+
+        def values(issue):
+            f = issue["fields"]
+            if field == "key":
+                return [issue["key"], issue.get("id")]
+            if field == "project":
+                p = f.get("project") or {}
+                return [p.get("key"), p.get("name"), p.get("id")]
+            if field in ["issuetype", "status", "resolution", "priority"]:
+                v = f.get(field)
+                return [v.get("name"), v.get("id")] if v else []
+            if field in ["assignee", "reporter"]:
+                u = f.get(field)
+                if not u:
+                    return []
+                return [
+                    u.get("accountId"),
+                    u.get("name"),
+                    u.get("emailAddress"),
+                    u.get("displayName"),
+                ]
+            if field == "components":
+                return [c["name"] for c in f.get("components") or []]
+            if field == "labels":
+                return f.get("labels") or []
+            if field == "sprint":
+                sprints = f.get(sprint_field) or []
+                return [s["name"] for s in sprints] + [str(s["id"]) for s in sprints]
+            if field == "epiclink":
+                return [f.get(epic_link_field)] if f.get(epic_link_field) else []
+            if field == "parentlink":
+                return [f.get(parent_link_field)] if f.get(parent_link_field) else []
+            if field == "parentepic":
+                # The issue itself and its epic (or initiative), like in Jira.
+                return [
+                    issue["key"],
+                    f.get(epic_link_field) or f.get(parent_link_field),
+                ]
+            if field == "parent":
+                # The parent of a sub-task.
+                p = f.get("parent")
+                return [p.get("key"), p.get("id")] if p else []
+            if field in DATE_FIELDS:
+                return [f.get(field)] if f.get(field) else []
+            # summary and description
+            return [f.get(field) or ""]
+
+        return values
+
+    def matcher(self, field, op, value):
+        if field in DATE_FIELDS:
+            limit = to_datetime(value)
+            ops = {
+                "=": lambda a: a.date() == limit.date(),
+                ">": lambda a: a > limit,
+                ">=": lambda a: a >= limit,
+                "<": lambda a: a < limit,
+                "<=": lambda a: a <= limit,
+            }
+            if op not in ops:
+                raise JqlError("Operator '%s' not supported for %s" % (op, field))
+            compare = ops[op]
+            return lambda values: any(compare(parse_jira_date(v)) for v in values)
+
+        if op == "~":
+            text = str(value).strip("*").lower()
+            return lambda values: any(text in v.lower() for v in values)
+
+        if op != "=":
+            raise JqlError("Operator '%s' not supported for %s" % (op, field))
+        wanted = set(
+            str(v).lower() for v in (value if isinstance(value, list) else [value])
+        )
+        return lambda values: any(str(v).lower() in wanted for v in values if v)
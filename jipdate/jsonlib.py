@@ -0,0 +1,85 @@
+"""
+JSON encoding and decoding for the Jira responses and the files we write.
+
+orjson is used when it is installed (see the "fast" extra), it decodes large
+search results several times faster than the json module of the standard
+library, which is used otherwise. Both give the same Python objects.
+"""
+
+import functools
+import json
+import logging as log
+
+# The orjson module, None if it isn't installed, see get_orjson().
+orjson = False
+
+
+def get_orjson():
+    global orjson
+    if orjson is False:
+        try:
+            import orjson as module
+        except ImportError:
+            module = None
+        orjson = module
+        log.debug("JSON backend: %s" % get_backend())
+    return orjson
+
+
+def get_backend():
+    """Returns the name of the module used to encode and decode JSON."""
+    return "orjson" if get_orjson() else "json"
+
+
+def loads(data):
+    """Decodes JSON from bytes or str."""
+    module = get_orjson()
+    if module is not None:
+        return module.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, indent=None, sort_keys=False):
+    """Encodes obj to a str. orjson only knows one indentation (2 spaces),
+    used for any indent."""
+    module = get_orjson()
+    if module is None:
+        return json.dumps(obj, indent=indent, sort_keys=sort_keys)
+    option = module.OPT_NON_STR_KEYS
+    if indent:
+        option |= module.OPT_INDENT_2
+    if sort_keys:
+        option |= module.OPT_SORT_KEYS
+    return module.dumps(obj, option=option).decode("utf-8")
+
+
+def load(f):
+    return loads(f.read())
+
+
+def dump(obj, f, indent=None, sort_keys=False):
+    f.write(dumps(obj, indent=indent, sort_keys=sort_keys))
+
+
+################################################################################
+# requests
+################################################################################
+def decode_response(response, **kwargs):
+    """Replaces Response.json(), the errors are ValueError like with it."""
+    encoding = (response.encoding or "utf-8").lower().replace("_", "-")
+    if encoding not in ["utf-8", "utf8"]:
+        return json.loads(response.text, **kwargs)
+    return loads(response.content)
+
+
+def use_jsonlib(response, *args, **kwargs):
+    """Response hook decoding the replies with this module."""
+    response.json = functools.partial(decode_response, response)
+    return response
+
+
+def install(session):
+    """Makes all the responses of a requests session decoded with this
+    module."""
+    if use_jsonlib not in session.hooks["response"]:
+        session.hooks["response"].append(use_jsonlib)
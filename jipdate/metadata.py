@@ -0,0 +1,178 @@
+"""
+Registry of the metadata of a Jira server: resolutions, statuses, issue types
+and fields.
+
+The metadata is kept in a file per server in the cache directory, stamped with
+the version of the server (and of the file format), so that it is only fetched
+when a command needs it for the first time. Once older than the configured TTL
+it is still used, and refreshed in the background for the next runs.
+
+Custom fields are resolved by name ("Epic Link", "Sponsors", ...), hence the
+commands don't depend on the ids used by a particular Jira instance.
+"""
+
+import hashlib
+import logging as log
+import os
+import threading
+import time
+
+# Local files
+from jipdate import cfg
+from jipdate import jsonlib
+
+# Default settings, each of them can be overridden in the "metadata" section of
+# the config file.
+DEFAULT_METADATA = {
+    # Seconds after which the metadata is refreshed in the background.
+    "ttl": 86400,
+}
+
+# Bumped when the content of the metadata file changes.
+FORMAT = 1
+
+# REST resource of each kind of metadata.
+RESOURCES = {
+    "resolutions": "resolution",
+    "statuses": "status",
+    "issuetypes": "issuetype",
+    "fields": "field",
+}
+
+# The registries of the servers used during this run, by HTTP session of the
+# JIRA instance, so that the instances of an api.Session use their own.
+registries = {}
+registries_lock = threading.Lock()
+
+
+def get_metadata_config():
+    config = dict(DEFAULT_METADATA)
+    config.update(cfg.get_option("metadata") or {})
+    return config
+
+
+def get_metadata_file(url):
+    """Returns the file holding the metadata of the server at url."""
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return cfg.get_cache_file("metadata-%s.json" % digest)
+
+
+class Registry:
+    """The metadata of a server, fetched when first needed."""
+
+    def __init__(self, jira, filename, ttl):
+        self.jira = jira
+        self.filename = filename
+        self.ttl = ttl
+        self.stamp = [FORMAT, list(getattr(jira, "_version", ()))]
+        self.lock = threading.Lock()
+        self.refreshed = set()
+        self.field_ids = None
+        self.data = self.read()
+
+    def read(self):
+        try:
+            with open(self.filename, "r") as f:
+                data = jsonlib.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get("stamp") != self.stamp:
+            log.debug("Metadata in %s is for another server version" % self.filename)
+            return {}
+        return data.get("metadata", {})
+
+    def write(self):
+        """Writes the metadata file, the lock must be held."""
+        tmp_file = "%s.%d" % (self.filename, os.getpid())
+        try:
+            with open(tmp_file, "w") as f:
+                jsonlib.dump({"stamp": self.stamp, "metadata": self.data}, f)
+            os.replace(tmp_file, self.filename)
+        except OSError as e:
+            log.debug("Could not store the metadata: %s" % e)
+
+    def fetch(self, kind):
+        items = self.jira._get_json(RESOURCES[kind])
+        with self.lock:
+            self.data[kind] = {"fetched": time.time(), "items": items}
+            if kind == "fields":
+                self.field_ids = None
+            self.write()
+        log.debug("Fetched the %s of %s" % (kind, self.jira.server_url))
+        return items
+
+    def refresh(self, kind):
+        """Fetches a kind of metadata again in the background, once per run."""
+
+        @cfg.bind
+        def run():
+            try:
+                self.fetch(kind)
+            except Exception as e:
+                log.debug("Could not refresh the %s: %s" % (kind, e))
+
+        with self.lock:
+            if kind in self.refreshed:
+                return
+            self.refreshed.add(kind)
+        # Never holds up the exit, e.g., at the deadline.
+        threading.Thread(target=run, name="refresh-%s" % kind, daemon=True).start()
+
+    def get(self, kind):
+        with self.lock:
+            entry = self.data.get(kind)
+        if entry is None:
+            with self.lock:
+                self.refreshed.add(kind)
+            return self.fetch(kind)
+        if time.time() - entry["fetched"] > self.ttl:
+            self.refresh(kind)
+        return entry["items"]
+
+    ############################################################################
+    # Queries
+    ############################################################################
+    def resolutions(self):
+        return self.get("resolutions")
+
+    def statuses(self):
+        return self.get("statuses")
+
+    def issue_types(self):
+        return self.get("issuetypes")
+
+    def fields(self):
+        return self.get("fields")
+
+    def field_id(self, name, default=None):
+        """Returns the id of a field from its name (case insensitive), e.g.,
+        "Epic Link" gives "customfield_10014" on the Linaro server. default is
+        returned if the server has no such field."""
+        if self.field_ids is None:
+            self.field_ids = dict(
+                (f["name"].lower(), f["id"]) for f in reversed(self.fields())
+            )
+        return self.field_ids.get(name.lower(), default)
+
+
+def get_registry(jira):
+    """Returns the metadata registry of the server of jira."""
+    with registries_lock:
+        registry = registries.get(jira._session)
+        if registry is None:
+            registry = Registry(
+                jira,
+                get_metadata_file(jira.server_url),
+                get_metadata_config()["ttl"],
+            )
+            registries[jira._session] = registry
+    # The jira library fetches the fields to translate the field names in
+    # searches, let it use ours.
+    jira.fields = registry.fields
+    return registry
+
+
+def forget(jira):
+    """Drops the registry of jira, which is being closed."""
+    with registries_lock:
+        registries.pop(jira._session, None)
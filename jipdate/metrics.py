@@ -0,0 +1,238 @@
+"""
+Metrics of a run in the OpenMetrics text format (--metrics), for the textfile
+collector of the Prometheus node_exporter when the commands run from cron.
+
+The file is replaced at the end of each run, so all metrics are gauges giving
+the values of the last run. The samples are labelled with the command and the
+run, i.e., the name of the file without its extension, so that several reports
+written to the same directory don't collide.
+"""
+
+import contextlib
+import os
+import sys
+import threading
+
+# Local files
+from jipdate import cfg
+from jipdate import trace
+
+# Issues received from Jira (or from the mirror) during this run.
+issues = 0
+
+# Files written by the command, measured when the metrics are written.
+outputs = []
+
+# The CountingWriter replacing sys.stdout while the metrics are collected.
+stdout = None
+
+# Whether the current thread runs for an api.Session, see disabled().
+local = threading.local()
+
+
+class CountingWriter:
+    """Text stream counting the bytes written to the stream it wraps."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def write(self, s):
+        self.size += len(s.encode(self.stream.encoding or "utf-8", "replace"))
+        return self.stream.write(s)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def enabled():
+    """Returns True when the metrics of this run are collected, in the current
+    thread."""
+    return stdout is not None and not getattr(local, "disabled", False)
+
+
+@contextlib.contextmanager
+def disabled(disable=True):
+    """Keeps what the current thread does out of the metrics of the run."""
+    previous = getattr(local, "disabled", False)
+    local.disabled = disable
+    try:
+        yield
+    finally:
+        local.disabled = previous
+
+
+def is_disabled():
+    """Returns True in the threads kept out of the metrics, see disabled()."""
+    return getattr(local, "disabled", False)
+
+
+cfg.thread_states.append((is_disabled, disabled))
+
+
+def start():
+    """Starts collecting the metrics of this run."""
+    global stdout
+    trace.enable()
+    if stdout is None:
+        stdout = CountingWriter(sys.stdout)
+        sys.stdout = stdout
+
+
+def count_issues(count):
+    global issues
+    if enabled():
+        issues += count
+
+
+def add_output(filename):
+    """Adds a file written by the command to the output size."""
+    if enabled():
+        outputs.append(filename)
+
+
+################################################################################
+# OpenMetrics
+################################################################################
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    return ",".join('%s="%s"' % (k, escape(v)) for k, v in labels)
+
+
+class Family:
+    """The samples of a metric."""
+
+    def __init__(self, name, help, unit=None):
+        self.name = name
+        self.help = help
+        self.unit = unit
+        self.samples = []
+
+    def add(self, value, **labels):
+        self.samples.append((sorted(labels.items()), value))
+
+    def format(self, common):
+        lines = ["# TYPE %s gauge" % self.name]
+        if self.unit:
+            lines.append("# UNIT %s %s" % (self.name, self.unit))
+        lines.append("# HELP %s %s" % (self.name, self.help))
+        for labels, value in self.samples:
+            lines.append(
+                "%s{%s} %s" % (self.name, format_labels(common + labels), repr(value))
+            )
+        return "\n".join(lines)
+
+
+def get_families(tracer):
+    """Returns the metrics of the run traced by tracer."""
+    duration = Family(
+        "jipdate_run_duration_seconds", "Wall time of the last run.", "seconds"
+    )
+    duration.add(round(tracer.now(), 3))
+    end = Family(
+        "jipdate_run_end_timestamp_seconds",
+        "Time the last run ended, since the epoch.",
+        "seconds",
+    )
+    end.add(round(tracer.epoch + tracer.now(), 3))
+
+    requests = Family(
+        "jipdate_requests", "Requests sent to Jira by endpoint and status."
+    )
+    retries = Family(
+        "jipdate_request_retries",
+        "Requests sent again after a connection error or a 502/504 response.",
+    )
+    downloaded = Family(
+        "jipdate_downloaded_bytes", "Size of the responses received.", "bytes"
+    )
+    counts = {}
+    retried = {}
+    for r in tracer.requests:
+        status = "error" if r["status"] is None else str(r["status"])
+        key = (r["method"], r["endpoint"], status)
+        counts[key] = counts.get(key, 0) + 1
+        key = (r["method"], r["endpoint"])
+        retried[key] = retried.get(key, 0) + r["retries"]
+    for (method, endpoint, status), count in sorted(counts.items()):
+        requests.add(count, method=method, endpoint=endpoint, status=status)
+    for (method, endpoint), count in sorted(retried.items()):
+        retries.add(count, method=method, endpoint=endpoint)
+    downloaded.add(sum(r["bytes"] for r in tracer.requests))
+    saved = Family(
+        "jipdate_saved_requests",
+        "Requests not sent as they were already sent during the run.",
+    )
+    for (method, endpoint, kind), count in sorted(tracer.saved.items()):
+        saved.add(count, method=method, endpoint=endpoint, kind=kind)
+    hedged = Family(
+        "jipdate_hedged_requests",
+        "Slow requests sent twice (sent) and answered first by the copy (won).",
+    )
+    for (method, endpoint, kind), count in sorted(tracer.hedged.items()):
+        hedged.add(count, method=method, endpoint=endpoint, kind=kind)
+
+    throttled_time, throttled_responses = 0.0, 0
+    # The transport is only there if the command talked to Jira.
+    transport = sys.modules.get("jipdate.transport")
+    if transport is not None:
+        throttled_time, throttled_responses = transport.get_throttling()
+    throttled = Family(
+        "jipdate_throttled_seconds",
+        "Time spent waiting for the rate limit of Jira.",
+        "seconds",
+    )
+    throttled.add(round(throttled_time, 3))
+    throttled_count = Family(
+        "jipdate_throttled_responses", "429 and 503 responses received from Jira."
+    )
+    throttled_count.add(throttled_responses)
+
+    processed = Family("jipdate_issues", "Issues received from Jira or the mirror.")
+    processed.add(issues)
+
+    output = Family(
+        "jipdate_output_bytes", "Size of the output, by destination.", "bytes"
+    )
+    output.add(stdout.size, output="stdout")
+    for filename in outputs:
+        if os.path.exists(filename):
+            output.add(os.path.getsize(filename), output=filename)
+
+    return [
+        duration,
+        end,
+        requests,
+        retries,
+        saved,
+        hedged,
+        throttled,
+        throttled_count,
+        processed,
+        downloaded,
+        output,
+    ]
+
+
+def get_command():
+    name = os.path.basename(sys.argv[0])
+    return os.path.splitext(name)[0]
+
+
+def write(filename):
+    """Writes the metrics of this run, called when the command exits. The file
+    is replaced atomically, so that it is never scraped half written."""
+    if not enabled() or trace.tracer is None:
+        return
+    run = os.path.splitext(os.path.basename(filename))[0]
+    common = [("command", get_command()), ("run", run)]
+    text = "\n".join(f.format(common) for f in get_families(trace.tracer))
+
+    # The textfile collector only reads *.prom files.
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(text + "\n# EOF\n")
+    os.replace(tmp, filename)
@@ -0,0 +1,425 @@
+"""
+Local mirror (SQLite) of the Jira issues of some projects.
+
+The mirror holds the issues, comments, changelog and links of each project. It
+is kept up to date with delta queries ("updated >= <last sync>") and a full
+sync every once in a while, to also catch issues that were deleted or moved
+away. With --cached, jipsearch, jipstatus and jipfp first sync the mirror and
+then answer their queries from it, evaluating the JQL locally (see jql.py).
+Queries using JQL that can't be evaluated locally are sent to Jira.
+"""
+
+import hashlib
+import logging as log
+import sqlite3
+import threading
+import time
+
+# Local files
+from jipdate import cfg
+from jipdate import jql
+from jipdate import jsonlib
+from jipdate import metadata
+from jipdate import records
+from jipdate import users
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    key TEXT PRIMARY KEY,
+    synced REAL,
+    full_synced REAL
+);
+CREATE TABLE IF NOT EXISTS issues (
+    key TEXT PRIMARY KEY,
+    id TEXT,
+    project TEXT,
+    updated TEXT,
+    raw TEXT
+);
+CREATE INDEX IF NOT EXISTS issues_project ON issues (project);
+CREATE TABLE IF NOT EXISTS comments (
+    issue TEXT,
+    id TEXT,
+    created TEXT,
+    raw TEXT,
+    PRIMARY KEY (issue, id)
+);
+CREATE TABLE IF NOT EXISTS changelog (
+    issue TEXT,
+    id TEXT,
+    created TEXT,
+    raw TEXT,
+    PRIMARY KEY (issue, id)
+);
+CREATE TABLE IF NOT EXISTS links (
+    issue TEXT,
+    type TEXT,
+    direction TEXT,
+    other TEXT
+);
+CREATE INDEX IF NOT EXISTS links_issue ON links (issue);
+"""
+
+# Default settings, each of them can be overridden in the "mirror" section of
+# the config file.
+DEFAULT_MIRROR = {
+    # Projects always synced, in addition to the ones given on the command line.
+    "projects": [],
+    # Seconds between two full syncs of a project.
+    "full_sync_interval": 7 * 24 * 3600,
+}
+
+# Issues fetched per search request while syncing.
+PAGE_SIZE = 100
+
+# Serializes the syncs of the commands running in the same process (jipbatch).
+sync_lock = threading.Lock()
+
+# Extra minutes added to the delta queries, in case our clock and the clock of
+# the server don't agree.
+SYNC_MARGIN = 5
+
+
+def get_mirror_config():
+    config = dict(DEFAULT_MIRROR)
+    config.update(cfg.get_option("mirror") or {})
+    return config
+
+
+def get_mirror_file(url):
+    """Returns the SQLite file used to mirror the server at url."""
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return cfg.get_cache_file("mirror-%s.sqlite" % digest)
+
+
+def fetch_issues(jira, query):
+    """Returns all issues (raw JSON) matching a query, with all fields and the
+    changelog."""
+    issues = []
+    for page in records.search_pages(
+        jira, query, PAGE_SIZE, fields="*all", expand="changelog"
+    ):
+        issues += page
+    return issues
+
+
+def project_issue(raw, fields=None, expand=None):
+    """Returns a copy of a raw issue with only the requested fields, like the
+    Jira server would."""
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    if isinstance(expand, str):
+        expand = expand.split(",")
+    fields = [f.strip() for f in fields or ["*all"]]
+    expand = [e.strip() for e in expand or []]
+
+    if "*all" in fields or "*navigable" in fields:
+        names = set(raw["fields"])
+    else:
+        names = set(fields)
+    names -= set(f[1:] for f in fields if f.startswith("-"))
+
+    issue = dict((k, v) for k, v in raw.items() if k not in ["fields", "changelog"])
+    issue["fields"] = dict((n, raw["fields"][n]) for n in names if n in raw["fields"])
+    if "changelog" in expand:
+        issue["changelog"] = raw["changelog"]
+    return issue
+
+
+class Mirror:
+    """The SQLite database mirroring the issues of a Jira server."""
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    ############################################################################
+    # Sync
+    ############################################################################
+    def sync(self, jira, project, full_sync_interval):
+        """Brings the mirror of a project up to date and returns the number of
+        issues that were fetched."""
+        row = self.db.execute(
+            "SELECT synced, full_synced FROM projects WHERE key = ?", (project,)
+        ).fetchone()
+        start = time.time()
+        full = row is None or start - row[1] > full_sync_interval
+
+        query = 'project = "%s"' % project
+        if not full:
+            minutes = int((start - row[0]) / 60) + SYNC_MARGIN
+            query += ' AND updated >= "-%dm"' % minutes
+        log.debug("Mirror sync: %s" % query)
+        issues = fetch_issues(jira, query)
+
+        with self.db:
+            if full:
+                self.delete_project(project)
+            for raw in issues:
+                self.store_issue(jira, raw)
+            self.db.execute(
+                "INSERT OR REPLACE INTO projects VALUES (?, ?, ?)",
+                (project, start, start if full else row[1]),
+            )
+        log.info(
+            "Mirror of %s: %s sync, %d issues fetched"
+            % (project, "full" if full else "delta", len(issues))
+        )
+        return len(issues)
+
+    def delete_project(self, project):
+        keys = "SELECT key FROM issues WHERE project = ?"
+        for table in ["comments", "changelog", "links"]:
+            self.db.execute(
+                "DELETE FROM %s WHERE issue IN (%s)" % (table, keys), (project,)
+            )
+        self.db.execute("DELETE FROM issues WHERE project = ?", (project,))
+
+    def store_issue(self, jira, raw):
+        """Stores an issue, its comments, changelog and links."""
+        key = raw["key"]
+        fields = dict(raw["fields"])
+        comment = fields.pop("comment", None) or {}
+        comments = comment.get("comments") or []
+        if comment.get("total", 0) > len(comments):
+            # Search results can be limited to the first comments.
+            comments = [c.raw for c in jira.comments(key)]
+        histories = (raw.get("changelog") or {}).get("histories") or []
+
+        issue = dict((k, v) for k, v in raw.items() if k != "changelog")
+        issue["fields"] = fields
+
+        for table in ["comments", "changelog", "links"]:
+            self.db.execute("DELETE FROM %s WHERE issue = ?" % table, (key,))
+        self.db.execute(
+            "INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, ?)",
+            (
+                key,
+                raw["id"],
+                (fields.get("project") or {}).get("key", key.split("-")[0]),
+                fields.get("updated"),
+                jsonlib.dumps(issue),
+            ),
+        )
+        self.db.executemany(
+            "INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?)",
+            [(key, c["id"], c.get("created"), jsonlib.dumps(c)) for c in comments],
+        )
+        self.db.executemany(
+            "INSERT OR REPLACE INTO changelog VALUES (?, ?, ?, ?)",
+            [(key, h["id"], h.get("created"), jsonlib.dumps(h)) for h in histories],
+        )
+        links = []
+        for link in fields.get("issuelinks") or []:
+            for direction in ["inwardIssue", "outwardIssue"]:
+                if direction in link:
+                    links.append(
+                        (
+                            key,
+                            link["type"]["name"],
+                            direction[:-5],
+                            link[direction]["key"],
+                        )
+                    )
+        self.db.executemany("INSERT INTO links VALUES (?, ?, ?, ?)", links)
+
+    ############################################################################
+    # Queries
+    ############################################################################
+    def load(self, projects):
+        """Returns the issues of projects (raw JSON, with their comments and
+        changelog) in a dict keyed by issue key."""
+        marks = ",".join("?" * len(projects))
+        issues = {}
+        for key, raw in self.db.execute(
+            "SELECT key, raw FROM issues WHERE project IN (%s) "
+            "ORDER BY CAST(id AS INTEGER)" % marks,
+            projects,
+        ):
+            issue = jsonlib.loads(raw)
+            issue["fields"]["comment"] = {"comments": []}
+            issue["changelog"] = {"histories": []}
+            issues[key] = issue
+
+        for table, parent, name in [
+            ("comments", "comment", "comments"),
+            ("changelog", "changelog", "histories"),
+        ]:
+            query = (
+                "SELECT issue, raw FROM %s WHERE issue IN "
+                "(SELECT key FROM issues WHERE project IN (%s)) ORDER BY rowid"
+                % (table, marks)
+            )
+            for key, raw in self.db.execute(query, projects):
+                if key not in issues:
+                    continue
+                if parent == "comment":
+                    container = issues[key]["fields"]["comment"]
+                else:
+                    container = issues[key]["changelog"]
+                container[name].append(jsonlib.loads(raw))
+
+        for issue in issues.values():
+            for container, name in [
+                (issue["fields"]["comment"], "comments"),
+                (issue["changelog"], "histories"),
+            ]:
+                count = len(container[name])
+                container.update({"startAt": 0, "maxResults": count, "total": count})
+        return issues
+
+
+class MirrorJira:
+    """
+    Stands in for a JIRA instance: searches and issue lookups are answered
+    from the mirror, everything else (writes included) goes to the server.
+    """
+
+    def __init__(self, jira, mirror, projects, username, config):
+        self.jira = jira
+        self.mirror = mirror
+        self.projects = set(projects)
+        self.username = username
+        self.config = config
+        self.issues = mirror.load(projects)
+
+    def __getattr__(self, name):
+        return getattr(self.jira, name)
+
+    def members_of(self, group):
+        return users.get_directory(self.jira).members_of(group)
+
+    def match(self, jql_str):
+        """Returns the mirrored issues matching jql_str, sorted, or None if the
+        mirror can't answer it: the query isn't understood, or its issues can
+        be in projects that aren't mirrored."""
+        parser = jql.JqlParser(
+            self.username,
+            self.members_of,
+            metadata.get_registry(self.jira).field_id,
+        )
+        try:
+            predicate = parser.compile(jql_str)
+        except jql.JqlError as e:
+            log.warning("Not in the mirror (%s), asking Jira" % e)
+            return None
+        if parser.projects is None or not parser.projects <= self.projects:
+            log.warning(
+                "Not in the mirror (the query isn't limited to the mirrored "
+                "projects: %s), asking Jira" % ", ".join(sorted(self.projects))
+            )
+            return None
+        try:
+            return parser.sort(i for i in self.issues.values() if predicate(i))
+        except jql.JqlError as e:
+            log.warning("Not in the mirror (%s), asking Jira" % e)
+            return None
+
+    def search_issues(
+        self,
+        jql_str,
+        startAt=0,
+        maxResults=50,
+        validate_query=True,
+        fields="*all",
+        expand=None,
+        properties=None,
+        json_result=False,
+        **kwargs,
+    ):
+        from jira.client import ResultList
+
+        matches = self.match(jql_str)
+        if matches is None:
+            return self.jira.search_issues(
+                jql_str,
+                startAt=startAt,
+                maxResults=maxResults,
+                validate_query=validate_query,
+                fields=fields,
+                expand=expand,
+                properties=properties,
+                json_result=json_result,
+                **kwargs,
+            )
+
+        end = startAt + maxResults if maxResults else None
+        raws = [project_issue(i, fields, expand) for i in matches[startAt:end]]
+        if json_result:
+            return {
+                "startAt": startAt,
+                "maxResults": maxResults,
+                "total": len(matches),
+                "issues": raws,
+            }
+        return ResultList(
+            [self.to_resource(r) for r in raws], startAt, maxResults, len(matches)
+        )
+
+    def enhanced_search_issues(
+        self,
+        jql_str,
+        nextPageToken=None,
+        maxResults=50,
+        fields="*all",
+        expand=None,
+        json_result=False,
+        **kwargs,
+    ):
+        """The search of Jira Cloud, the page tokens of the mirror being the
+        offsets of the pages."""
+        from jira.client import ResultList
+
+        matches = self.match(jql_str)
+        if matches is None:
+            return self.jira.enhanced_search_issues(
+                jql_str,
+                nextPageToken=nextPageToken,
+                maxResults=maxResults,
+                fields=fields,
+                expand=expand,
+                json_result=json_result,
+                **kwargs,
+            )
+
+        start = int(nextPageToken or 0)
+        end = start + maxResults if maxResults else len(matches)
+        raws = [project_issue(i, fields, expand) for i in matches[start:end]]
+        if json_result:
+            result = {"issues": raws, "isLast": end >= len(matches)}
+            if not result["isLast"]:
+                result["nextPageToken"] = str(end)
+            return result
+        return ResultList(
+            [self.to_resource(r) for r in raws], start, maxResults, len(matches)
+        )
+
+    def issue(self, id, fields=None, expand=None, properties=None):
+        raw = self.issues.get(str(id))
+        if raw is None:
+            return self.jira.issue(id, fields=fields, expand=expand)
+        return self.to_resource(project_issue(raw, fields, expand))
+
+    def to_resource(self, raw):
+        from jira.resources import Issue
+
+        return Issue(self.jira._options, self.jira._session, raw=raw)
+
+
+def open_mirror(jira, username, projects=None):
+    """Syncs the mirror of the configured projects and of projects, and returns
+    a JIRA stand-in answering from the mirror."""
+    config = get_mirror_config()
+    projects = [p.strip().upper() for p in list(config["projects"]) + (projects or [])]
+    projects = sorted(set(p for p in projects if p))
+    if not projects:
+        log.warning("No project to mirror, see the 'mirror' section of the config")
+
+    with sync_lock:
+        mirror = Mirror(get_mirror_file(jira.server_url))
+        for project in projects:
+            mirror.sync(jira, project, config["full_sync_interval"])
+        return MirrorJira(jira, mirror, projects, username, config)
@@ -0,0 +1,157 @@
+"""
+Profiling of a run (--profile), to attach to performance bug reports.
+
+When the command is done, the wall time of each of its phases (config, login,
+query, render, write, ...) is reported with the Jira requests sent and the peak
+memory during it, followed by the lines that allocated the most memory still
+held at the end of the heaviest phase (tracemalloc). When a file is given, the
+cProfile statistics are also written to it, see "python -m pstats FILE".
+
+tracemalloc makes the command noticeably slower, the wall times are for
+comparisons between profiled runs.
+"""
+
+import sys
+
+# Local files
+from jipdate import trace
+
+# Allocation sites listed in the report.
+TOP_ALLOCATIONS = 10
+
+# Modules whose allocations are not reported.
+IGNORED_FILES = ["<frozen *>", "<unknown>", "*/tracemalloc.py"]
+
+# The cProfile.Profile of this run, None unless the statistics are written.
+profile = None
+
+# Peak traced memory (bytes) of each phase.
+peaks = {}
+
+# (traced memory, phase, snapshot) at the end of the phase holding the most.
+heaviest = None
+
+
+def enabled():
+    """Returns True when this run is being profiled."""
+    return "tracemalloc" in sys.modules and sys.modules["tracemalloc"].is_tracing()
+
+
+def start(filename=None):
+    """Starts profiling this run, with cProfile if filename is given."""
+    import tracemalloc
+
+    global profile
+    trace.enable()
+    tracemalloc.start()
+    if filename:
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+
+
+def end_phase():
+    """Records the memory of the current phase, to be called when it ends."""
+    global heaviest
+    if not enabled() or trace.tracer is None:
+        return
+    import tracemalloc
+
+    ending = trace.tracer.current_phase()
+    if ending is None:
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    peaks[ending] = max(peaks.get(ending, 0), peak)
+    # Without reset_peak() (Python < 3.9) the peaks are the ones of the run so
+    # far.
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    if heaviest is None or current > heaviest[0]:
+        snapshot = tracemalloc.take_snapshot()
+        heaviest = (current, ending, snapshot)
+
+
+def get_max_rss():
+    """Returns the peak RSS of the process in MiB, None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere.
+    return rss / 1024.0 / (1024.0 if sys.platform == "darwin" else 1.0)
+
+
+def report(filename=None, f=None):
+    """Stops profiling and prints the report, called when the command exits."""
+    if not enabled():
+        return
+    import tracemalloc
+
+    f = f or sys.stderr
+    if profile is not None:
+        profile.disable()
+    end_phase()
+    trace.tracer.finish()
+    tracemalloc.stop()
+
+    mib = 1024.0 * 1024.0
+    print("\nProfile:", file=f)
+    print(
+        "%-12s %10s %9s %12s %10s"
+        % ("phase", "wall[ms]", "requests", "in req.[ms]", "peak[MiB]"),
+        file=f,
+    )
+    for p in trace.tracer.get_phases():
+        print(
+            "%-12s %10.1f %9d %12.1f %10.1f"
+            % (
+                p["phase"] or "-",
+                p["wall_ms"],
+                p["requests"],
+                p["request_ms"],
+                peaks.get(p["phase"], 0) / mib,
+            ),
+            file=f,
+        )
+    print(
+        "%-12s %10.1f %9s %12s %10.1f"
+        % (
+            "total",
+            trace.tracer.now() * 1000,
+            "",
+            "",
+            max(peaks.values() or [0]) / mib,
+        ),
+        file=f,
+    )
+    max_rss = get_max_rss()
+    if max_rss is not None:
+        print("Max RSS: %.1f MiB" % max_rss, file=f)
+
+    if heaviest is not None:
+        current, name, snapshot = heaviest
+        snapshot = snapshot.filter_traces(
+            [tracemalloc.Filter(False, pattern) for pattern in IGNORED_FILES]
+        )
+        print(
+            "\nTop allocations held at the end of '%s' (%.1f MiB):"
+            % (name, current / mib),
+            file=f,
+        )
+        for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+            frame = stat.traceback[0]
+            print(
+                "%10.1f KiB %9d blocks  %s:%d"
+                % (stat.size / 1024.0, stat.count, frame.filename, frame.lineno),
+                file=f,
+            )
+
+    if profile is not None and filename:
+        profile.dump_stats(filename)
+        print(
+            "\ncProfile statistics written to %s, see: python -m pstats %s"
+            % (filename, filename),
+            file=f,
+        )
@@ -0,0 +1,87 @@
+"""
+Field projection planner: which fields (and expansions) each command asks Jira
+for.
+
+Without "fields", Jira returns every field of an issue, custom fields included,
+which makes most of the payload on large projects. Each command gets its
+projection from here, derived from its flags and templates, and passes it to
+all its searches and issue fetches:
+
+    projection = projection.plan_jipdate(cfg.args)
+    jira.search_issues(jql, **projection.kwargs())
+"""
+
+import re
+
+# Fields of the issue lines of jipsearch (without --format).
+JIPSEARCH_FIELDS = ["summary", "created", "status", "issuetype", "assignee"]
+
+# Template variables of jipsearch --format, e.g., {assignee:emailAddress}.
+REGEX_FORMAT = r"\{(.+?)\}"
+
+
+class Projection:
+    """The fields and expansions of the issues a command reads."""
+
+    def __init__(self, fields, expand=None):
+        # Keep the order, drop duplicates and "key" (never a field).
+        self.fields = [f for f in dict.fromkeys(fields) if f and f != "key"]
+        self.expand = expand
+
+    def __repr__(self):
+        return "Projection(fields=%s, expand=%s)" % (self.fields, self.expand)
+
+    def kwargs(self):
+        """Returns the fields and expand arguments of JIRA.search_issues(),
+        JIRA.issue() and of the engine methods."""
+        return {"fields": ",".join(self.fields), "expand": self.expand}
+
+
+def plan_jipdate(args):
+    """The status file shows the summary, type and status of the issues, the
+    status is also checked before transitions. Comments (-l) are fetched on
+    their own."""
+    return Projection(["summary", "issuetype", "status"])
+
+
+def plan_jipsearch(args):
+    """--format prints its template variables only, else the issue lines show
+    JIPSEARCH_FIELDS, plus the description (-d), time tracking (-c) and the
+    parent (--parent)."""
+    if args.format:
+        return Projection(
+            [k.split(":")[0] for k in re.findall(REGEX_FORMAT, args.format)]
+        )
+
+    fields = list(JIPSEARCH_FIELDS)
+    if args.description:
+        fields.append("description")
+    if args.comments:
+        fields.append("timetracking")
+    if args.parent:
+        fields.append("parent")
+    return Projection(fields)
+
+
+def plan_jipfp(jira, args):
+    """The nodes of the mind map show the summary, type, assignee, status and
+    sponsors of the issues, the tree follows their links and parent links. The
+    description is only needed with --desc."""
+    from jipdate import metadata
+
+    registry = metadata.get_registry(jira)
+    fields = ["summary", "issuetype", "assignee", "status", "issuelinks"]
+    fields.append(registry.field_id("Sponsors", "customfield_10101"))
+    fields.append(registry.field_id("Parent Link", "customfield_10005"))
+    if args.desc:
+        fields.append("description")
+    return Projection(fields)
+
+
+def plan_jipstatus(report):
+    """The "updates" report reads the comments and the resolution changes (in
+    the changelog) of the issues, the "pending" report doesn't."""
+    fields = ["summary", "assignee", "created", "components"]
+    if report == "updates":
+        return Projection(fields + ["comment"], expand="changelog")
+    return Projection(fields)
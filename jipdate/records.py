@@ -0,0 +1,192 @@
+"""
+Compact issue records decoded from the raw JSON of the Jira server.
+
+The jira library turns every issue of a search into an Issue resource, wrapping
+each nested dict (statuses, users, comments, every changelog item, ...) into an
+object of its own. For thousands of issues with their changelog this is most of
+the time and memory of a command. Records hold the projected fields only (see
+projection.py) in __slots__, nested values are wrapped when they are read.
+
+Records are read like Issue resources, i.e., str(record) is the issue key and
+record.fields.status.name, record.changelog.histories etc. work the same, so
+they can be passed to the JIRA methods taking an issue.
+"""
+
+import functools
+
+# Local files
+from jipdate import deadline
+from jipdate import metrics
+
+# Issues asked per search request, the server returns at most its own maximum
+# (100 on Jira Cloud) and the next pages are then asked for.
+PAGE_SIZE = 1000
+
+# Keys making the string of a nested value, in order, like the jira library.
+READABLE_IDS = ["displayName", "key", "name", "accountId", "value", "id"]
+
+
+def wrap(value):
+    """Returns a value of the raw JSON of an issue as read from a record."""
+    if isinstance(value, dict):
+        return Item(value)
+    if isinstance(value, list):
+        return [wrap(v) for v in value]
+    return value
+
+
+class Item:
+    """A nested value (status, user, comment, link, ...) of an issue, its keys
+    are read as attributes."""
+
+    __slots__ = ("raw",)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __getattr__(self, name):
+        if name == "raw":
+            raise AttributeError(name)
+        try:
+            return wrap(self.raw[name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def __str__(self):
+        for name in READABLE_IDS:
+            if name in self.raw:
+                return str(self.raw[name])
+        return repr(self.raw)
+
+    def __repr__(self):
+        return "<Item %s>" % self
+
+
+class Fields:
+    """Base of the fields of the records, see get_fields_class()."""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        names = [n for n in self.__slots__ if hasattr(self, n)]
+        return "<Fields %s>" % ", ".join(names)
+
+
+@functools.lru_cache(maxsize=None)
+def get_fields_class(names):
+    """Returns the class holding the fields names (a tuple) of a record."""
+    return type("Fields", (Fields,), {"__slots__": names})
+
+
+class Record:
+    """An issue, with the projected fields only."""
+
+    __slots__ = ("id", "key", "fields", "changelog")
+
+    def __str__(self):
+        return self.key
+
+    def __repr__(self):
+        return "<Record %s>" % self.key
+
+
+def get_decoder(projection):
+    """Returns the function turning a raw issue into a record with the fields
+    of projection. Missing fields are missing attributes, like with the Issue
+    resources."""
+    names = tuple(f for f in projection.fields if f.isidentifier())
+    fields_class = get_fields_class(names)
+
+    def decode(raw):
+        record = Record()
+        record.id = raw["id"]
+        record.key = raw["key"]
+        record.fields = fields_class()
+        values = raw["fields"]
+        for name in names:
+            if name in values:
+                setattr(record.fields, name, wrap(values[name]))
+        if "changelog" in raw:
+            record.changelog = Item(raw["changelog"])
+        return record
+
+    return decode
+
+
+################################################################################
+# Queries
+################################################################################
+def search_pages(jira, jql, page_size, limit=None, **kwargs):
+    """Yields the pages (lists of raw issues) of the issues matching jql, or of
+    the first limit ones. Jira Cloud only has /search/jql, paged with
+    nextPageToken and not telling the total, the other servers are paged with
+    startAt on /search."""
+    cloud = getattr(jira, "_is_cloud", False)
+    total = limit or float("inf")
+    count = 0
+    token = None
+    while count < total:
+        size = min(page_size, total - count)
+        if cloud:
+            result = jira.enhanced_search_issues(
+                jql, nextPageToken=token, maxResults=size, json_result=True, **kwargs
+            )
+        else:
+            result = jira.search_issues(
+                jql, startAt=count, maxResults=size, json_result=True, **kwargs
+            )
+        issues = result["issues"]
+        if not issues:
+            return
+        yield issues
+        count += len(issues)
+        if cloud:
+            token = result.get("nextPageToken")
+            if result.get("isLast") or token is None:
+                return
+        else:
+            total = min(total, result["total"])
+
+
+def search(jira, jql, projection, engine=None, max_results=None):
+    """Returns the records of all the issues matching jql, or of the first
+    max_results ones. Stopped by the deadline, returns the records of the pages
+    received."""
+    kwargs = projection.kwargs()
+    if engine is not None:
+        try:
+            raws = engine.run(
+                engine.search(jql, page_size=PAGE_SIZE, limit=max_results, **kwargs)
+            )
+        except (deadline.Stopped, KeyboardInterrupt) as e:
+            if not deadline.stopping(e):
+                raise
+            raws = []
+    else:
+        raws = []
+        try:
+            for page in search_pages(jira, jql, PAGE_SIZE, max_results, **kwargs):
+                raws += page
+        except (deadline.Stopped, KeyboardInterrupt) as e:
+            # Go on with the pages we already have.
+            if not deadline.stopping(e):
+                raise
+    metrics.count_issues(len(raws))
+    decode = get_decoder(projection)
+    return [decode(r) for r in raws]
+
+
+def get_issue(jira, key, projection):
+    """Returns the record of an issue, raises JIRAError if it doesn't exist."""
+    issue = jira.issue(key, **projection.kwargs())
+    metrics.count_issues(1)
+    return get_decoder(projection)(issue.raw)
+
+
+def fetch(engine, keys, projection):
+    """Returns the records of the issues that exist in a dict keyed by issue
+    key, the issues being fetched concurrently."""
+    decode = get_decoder(projection)
+    raws = engine.fetch_issues(keys, **projection.kwargs())
+    metrics.count_issues(len(raws))
+    return dict((k, decode(r)) for k, r in raws.items())
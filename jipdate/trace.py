@@ -0,0 +1,435 @@
+"""
+Tracing of the requests sent to Jira.
+
+When enabled (--trace), every request is recorded with its method, endpoint
+template, status, size and latency, together with the phase of the command
+(login, query, render, write) it was sent in. A summary table is printed when
+the command is done and the full trace can be written to a JSON file, which can
+also be loaded in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+from urllib.parse import urlsplit
+
+import contextlib
+import logging as log
+import re
+import sys
+import threading
+import time
+
+# Local files
+from jipdate import cfg
+from jipdate import jsonlib
+
+# The tracer of this run, None when tracing is disabled.
+tracer = None
+
+# The tracers of the threads running for an api.Session, see using().
+local = threading.local()
+
+# Path segments replaced by placeholders, so that requests to the same endpoint
+# are counted together.
+ENDPOINT_PATTERNS = [
+    (re.compile(r"/[A-Z][A-Z0-9_]*-\d+(?=/|$)"), "/{key}"),
+    (re.compile(r"/project/[^/]+"), "/project/{project}"),
+    (re.compile(r"(?<!/api)/\d+(?=/|$)"), "/{id}"),
+]
+
+# Upper bounds (ms) of the latency histogram buckets.
+HISTOGRAM_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+def get_endpoint(url):
+    """Returns the endpoint template of an url, e.g. /rest/api/2/issue/{key}."""
+    path = urlsplit(url).path
+    for regex, placeholder in ENDPOINT_PATTERNS:
+        path = regex.sub(placeholder, path)
+    return path
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of a sorted list."""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class Tracer:
+    """Collects the requests and phases of a run."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.epoch = time.time()
+        self.requests = []
+        self.phases = []
+        self.current = None
+        self.saved = {}
+        self.hedged = {}
+        self.lock = threading.Lock()
+
+    def now(self):
+        """Returns the time (s) since the start of the run."""
+        return time.perf_counter() - self.start
+
+    def phase(self, name):
+        """Ends the current phase and starts a new one."""
+        with self.lock:
+            now = self.now()
+            if self.current is not None:
+                self.current["end"] = now
+                self.phases.append(self.current)
+            self.current = None
+            if name is not None:
+                self.current = {"name": name, "start": now}
+
+    def current_phase(self):
+        return self.current["name"] if self.current else None
+
+    def record(self, method, url, status, size, start, duration, retries=0):
+        request = {
+            "method": method,
+            "endpoint": get_endpoint(url),
+            "url": url,
+            "status": status,
+            "bytes": size,
+            "start": start - self.start,
+            "duration": duration,
+            "retries": retries,
+            "phase": self.current_phase(),
+            "thread": threading.get_ident(),
+        }
+        with self.lock:
+            self.requests.append(request)
+        return request
+
+    def record_saved(self, method, url, kind):
+        """Counts a request that wasn't sent, its response being memoized or
+        the one of the same request in flight (kind)."""
+        key = (method, get_endpoint(url), kind)
+        with self.lock:
+            self.saved[key] = self.saved.get(key, 0) + 1
+
+    def record_hedged(self, method, url, kind):
+        """Counts a request sent twice because it was slow ("sent") and the
+        ones for which the copy answered first ("won")."""
+        key = (method, get_endpoint(url), kind)
+        with self.lock:
+            self.hedged[key] = self.hedged.get(key, 0) + 1
+
+    def finish(self):
+        self.phase(None)
+
+    ############################################################################
+    # Reports
+    ############################################################################
+    def get_endpoints(self):
+        """Returns the per endpoint statistics, slowest endpoints first."""
+        endpoints = {}
+        for r in self.requests:
+            e = endpoints.setdefault(
+                (r["method"], r["endpoint"]),
+                {
+                    "method": r["method"],
+                    "endpoint": r["endpoint"],
+                    "count": 0,
+                    "errors": 0,
+                    "retries": 0,
+                    "bytes": 0,
+                    "latencies": [],
+                    "statuses": {},
+                },
+            )
+            e["count"] += 1
+            e["errors"] += r["status"] is None or r["status"] >= 400
+            e["retries"] += r["retries"]
+            e["bytes"] += r["bytes"]
+            e["latencies"].append(r["duration"] * 1000)
+            status = str(r["status"])
+            e["statuses"][status] = e["statuses"].get(status, 0) + 1
+
+        result = []
+        for e in endpoints.values():
+            latencies = sorted(e.pop("latencies"))
+            e["total_ms"] = sum(latencies)
+            e["mean_ms"] = e["total_ms"] / len(latencies)
+            e["p50_ms"] = percentile(latencies, 50)
+            e["p95_ms"] = percentile(latencies, 95)
+            e["max_ms"] = latencies[-1]
+            histogram = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+            b = 0
+            for l in latencies:
+                while b < len(HISTOGRAM_BUCKETS) and l > HISTOGRAM_BUCKETS[b]:
+                    b += 1
+                histogram[b] += 1
+            e["histogram"] = dict(
+                zip(["<=%d" % ms for ms in HISTOGRAM_BUCKETS] + ["inf"], histogram)
+            )
+            result.append(e)
+        return sorted(result, key=lambda e: -e["total_ms"])
+
+    def get_phases(self):
+        """Returns the wall time and the requests of each phase, in the order
+        the phases were first entered."""
+        phases = {}
+        for p in self.phases:
+            s = phases.setdefault(
+                p["name"],
+                {"phase": p["name"], "wall_ms": 0, "requests": 0, "request_ms": 0},
+            )
+            s["wall_ms"] += (p["end"] - p["start"]) * 1000
+        for r in self.requests:
+            s = phases.setdefault(
+                r["phase"],
+                {"phase": r["phase"], "wall_ms": 0, "requests": 0, "request_ms": 0},
+            )
+            s["requests"] += 1
+            s["request_ms"] += r["duration"] * 1000
+        return list(phases.values())
+
+    def print_summary(self, f=None):
+        f = f or sys.stderr
+        endpoints = self.get_endpoints()
+        print("\nJira requests:", file=f)
+        print(
+            "%-6s %-44s %6s %6s %9s %10s %8s %8s %8s"
+            % (
+                "method",
+                "endpoint",
+                "count",
+                "errors",
+                "KiB",
+                "total[ms]",
+                "p50[ms]",
+                "p95[ms]",
+                "max[ms]",
+            ),
+            file=f,
+        )
+        for e in endpoints:
+            print(
+                "%-6s %-44s %6d %6d %9.1f %10.1f %8.1f %8.1f %8.1f"
+                % (
+                    e["method"],
+                    e["endpoint"],
+                    e["count"],
+                    e["errors"],
+                    e["bytes"] / 1024.0,
+                    e["total_ms"],
+                    e["p50_ms"],
+                    e["p95_ms"],
+                    e["max_ms"],
+                ),
+                file=f,
+            )
+        print(
+            "%-51s %6d %6d %9.1f %10.1f"
+            % (
+                "total",
+                sum(e["count"] for e in endpoints),
+                sum(e["errors"] for e in endpoints),
+                sum(e["bytes"] for e in endpoints) / 1024.0,
+                sum(e["total_ms"] for e in endpoints),
+            ),
+            file=f,
+        )
+
+        if self.saved:
+            print("\nRequests not sent again:", file=f)
+            print(
+                "%-6s %-44s %9s %9s" % ("method", "endpoint", "memoized", "coalesced"),
+                file=f,
+            )
+            for method, endpoint in sorted(set(k[:2] for k in self.saved)):
+                print(
+                    "%-6s %-44s %9d %9d"
+                    % (
+                        method,
+                        endpoint,
+                        self.saved.get((method, endpoint, "memoized"), 0),
+                        self.saved.get((method, endpoint, "coalesced"), 0),
+                    ),
+                    file=f,
+                )
+
+        if self.hedged:
+            print("\nHedged requests:", file=f)
+            print("%-6s %-44s %9s %9s" % ("method", "endpoint", "sent", "won"), file=f)
+            for method, endpoint in sorted(set(k[:2] for k in self.hedged)):
+                print(
+                    "%-6s %-44s %9d %9d"
+                    % (
+                        method,
+                        endpoint,
+                        self.hedged.get((method, endpoint, "sent"), 0),
+                        self.hedged.get((method, endpoint, "won"), 0),
+                    ),
+                    file=f,
+                )
+
+        print("\nPhases:", file=f)
+        print(
+            "%-12s %10s %9s %12s" % ("phase", "wall[ms]", "requests", "in req.[ms]"),
+            file=f,
+        )
+        for p in self.get_phases():
+            print(
+                "%-12s %10.1f %9d %12.1f"
+                % (p["phase"] or "-", p["wall_ms"], p["requests"], p["request_ms"]),
+                file=f,
+            )
+        print("%-12s %10.1f" % ("total", self.now() * 1000), file=f)
+
+    def to_json(self):
+        """Returns the trace, as a dict following the Chrome trace event format
+        with the raw data and the summary as extra keys."""
+        events = []
+        pid = 1
+        for p in self.phases:
+            events.append(
+                {
+                    "name": p["name"],
+                    "cat": "phase",
+                    "ph": "X",
+                    "ts": p["start"] * 1e6,
+                    "dur": (p["end"] - p["start"]) * 1e6,
+                    "pid": pid,
+                    "tid": 0,
+                }
+            )
+        for r in self.requests:
+            events.append(
+                {
+                    "name": "%s %s" % (r["method"], r["endpoint"]),
+                    "cat": "request",
+                    "ph": "X",
+                    "ts": r["start"] * 1e6,
+                    "dur": r["duration"] * 1e6,
+                    "pid": pid,
+                    "tid": r["thread"],
+                    "args": {
+                        "url": r["url"],
+                        "status": r["status"],
+                        "bytes": r["bytes"],
+                        "phase": r["phase"],
+                    },
+                }
+            )
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"command": " ".join(sys.argv), "start": self.epoch},
+            "requests": self.requests,
+            "phases": self.get_phases(),
+            "endpoints": self.get_endpoints(),
+            "saved": [
+                {"method": m, "endpoint": e, "kind": k, "count": c}
+                for (m, e, k), c in sorted(self.saved.items())
+            ],
+            "hedged": [
+                {"method": m, "endpoint": e, "kind": k, "count": c}
+                for (m, e, k), c in sorted(self.hedged.items())
+            ],
+        }
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            jsonlib.dump(self.to_json(), f, indent=1)
+        log.debug("Trace written to %s" % filename)
+
+
+def enable():
+    """Starts tracing the requests of this run."""
+    global tracer
+    if tracer is None:
+        tracer = Tracer()
+    return tracer
+
+
+@contextlib.contextmanager
+def using(t):
+    """Makes the requests of the current thread be recorded by t (a Tracer, None
+    not to record them) instead of the tracer of the run."""
+    previous = (getattr(local, "active", False), getattr(local, "tracer", None))
+    local.active, local.tracer = True, t
+    try:
+        yield t
+    finally:
+        local.active, local.tracer = previous
+
+
+def get_tracer():
+    """Returns the tracer of the current thread, see using()."""
+    if getattr(local, "active", False):
+        return local.tracer
+    return tracer
+
+
+cfg.thread_states.append((get_tracer, using))
+
+
+def phase(name):
+    """Marks the start of a new phase of the command, no-op unless tracing."""
+    t = get_tracer()
+    if t is not None:
+        t.phase(name)
+
+
+def record(request, response, start, stream=False):
+    """Records a request sent at start (time.perf_counter()) and its response.
+    The body is read first, so that the latency includes the download."""
+    t = get_tracer()
+    if t is None:
+        return
+    size = 0
+    if not stream:
+        size = len(response.content or b"")
+    else:
+        size = int(response.headers.get("Content-Length") or 0)
+    duration = time.perf_counter() - start
+    retries = getattr(getattr(response.raw, "retries", None), "history", None) or ()
+    t.record(
+        request.method,
+        request.url,
+        response.status_code,
+        size,
+        start,
+        duration,
+        len(retries),
+    )
+
+
+def record_saved(request, kind):
+    """Records a request that didn't have to be sent, see
+    httpcache.IdentityMap."""
+    t = get_tracer()
+    if t is None:
+        return
+    t.record_saved(request.method, request.url, kind)
+
+
+def record_hedged(request, kind):
+    """Records a request sent twice, see transport.Hedger."""
+    t = get_tracer()
+    if t is None:
+        return
+    t.record_hedged(request.method, request.url, kind)
+
+
+def record_response(method, url, status, size, start):
+    """Records a request sent by another HTTP client than requests."""
+    t = get_tracer()
+    if t is None:
+        return
+    t.record(method, url, status, size, start, time.perf_counter() - start)
+
+
+def report(filename=None):
+    """Prints the summary and writes the trace file, called when the command
+    exits."""
+    if tracer is None:
+        return
+    tracer.finish()
+    tracer.print_summary()
+    if filename:
+        tracer.write(filename)
+        print("Trace written to %s" % filename, file=sys.stderr)
@@ -0,0 +1,488 @@
+"""
+HTTP transport used for all the communication with the Jira server.
+"""
+
+import atexit
+import collections
+import concurrent.futures
+import email.utils
+import functools
+import logging as log
+import random
+import sys
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from jipdate import cassette
+from jipdate import cfg
+from jipdate import deadline
+from jipdate import jsonlib
+from jipdate import trace
+
+# Only requests that can safely be sent twice are retried.
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+# Server side errors that are usually temporary (proxies, restarts etc).
+RETRY_STATUS_CODES = frozenset([502, 504])
+
+# Responses telling us to slow down, these are handled by the RateLimiter.
+THROTTLE_STATUS_CODES = frozenset([429, 503])
+
+# Latencies of an endpoint needed before its slow requests are hedged.
+HEDGE_MIN_SAMPLES = 10
+
+# Number of recent requests hedge_max_ratio applies to.
+HEDGE_WINDOW = 100
+
+# Most requests waited for by a Hedger at the same time, threads are only
+# started when needed.
+HEDGE_WORKERS = 64
+
+# The rate limiters of the open connections, used for the final report.
+limiters = []
+
+
+class JitteredRetry(Retry):
+    """Retry policy using exponential backoff with full jitter, so that many
+    clients failing at the same time don't come back at the same time. Nothing
+    is retried once the deadline has passed."""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        if backoff <= 0:
+            return 0
+        left = deadline.remaining()
+        if left is not None:
+            backoff = min(backoff, left)
+        return random.uniform(0, backoff)
+
+    def is_exhausted(self):
+        return deadline.expired() or super().is_exhausted()
+
+
+class RateLimiter:
+    """
+    Token bucket scheduling the requests sent to a server. The rate starts at
+    the configured value (unlimited if 0) and follows what the server tells us
+    in the X-RateLimit-* headers. When the server throttles us without telling
+    the rate, the rate is halved and then gradually increased again.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate or None
+        self.max_rate = self.rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.adaptive = False
+        self.recent = collections.deque(maxlen=100)
+        self.throttled_time = 0.0
+        self.throttled_responses = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+        self.updated = now
+
+    def _take(self, now):
+        """Takes a token if there is one, returns 0 then, how long (s) to wait
+        for one otherwise. The lock must be held."""
+        self._refill(now)
+        wait = self.blocked_until - now
+        if wait <= 0:
+            if self.rate is None or self.tokens >= 1:
+                self.tokens -= 1
+                self.recent.append(now)
+                return 0
+            wait = (1 - self.tokens) / self.rate
+        return wait
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            deadline.check()
+            with self.lock:
+                wait = self._take(time.monotonic())
+                if wait <= 0:
+                    return
+                self.throttled_time += wait
+            left = deadline.remaining()
+            time.sleep(wait if left is None else min(wait, left))
+
+    def try_acquire(self):
+        """Returns True if a request may be sent right away, False if acquire()
+        would block."""
+        with self.lock:
+            return self._take(time.monotonic()) <= 0
+
+    def current_rate(self):
+        """Returns the rate (requests/s) we recently sent requests at."""
+        if len(self.recent) < 2:
+            return self.rate or 1.0
+        elapsed = self.recent[-1] - self.recent[0]
+        return (len(self.recent) - 1) / max(elapsed, 0.001)
+
+    def update(self, response):
+        """Adjusts the bucket with the rate limit headers of a response."""
+        headers = response.headers
+        fill_rate = headers.get("X-RateLimit-FillRate")
+        interval = headers.get("X-RateLimit-Interval-Seconds")
+        limit = headers.get("X-RateLimit-Limit")
+        remaining = headers.get("X-RateLimit-Remaining")
+        with self.lock:
+            try:
+                if fill_rate is not None and interval is not None:
+                    self.rate = float(fill_rate) / max(float(interval), 1.0)
+                    self.adaptive = False
+                if limit is not None:
+                    self.burst = max(1, int(limit))
+                if remaining is not None:
+                    self.tokens = min(self.tokens, float(remaining))
+            except ValueError:
+                log.debug("Invalid rate limit headers: %s" % headers)
+
+            if self.adaptive and response.status_code not in THROTTLE_STATUS_CODES:
+                # Probe for a higher rate as long as the server accepts it.
+                self.rate += max(0.1, self.rate * 0.05)
+                if self.max_rate is not None:
+                    self.rate = min(self.rate, self.max_rate)
+
+    def throttle(self, response, attempt):
+        """Pauses all requests after a 429 or 503 response and returns the
+        delay."""
+        delay = get_retry_after(response)
+        with self.lock:
+            if delay is None:
+                delay = min(60, 2**attempt) * random.uniform(0.5, 1.0)
+            if response.status_code == 429 and "X-RateLimit-FillRate" not in (
+                response.headers
+            ):
+                # Multiplicative decrease, the server didn't tell the rate.
+                self.rate = max(0.5, min(self.rate or 1e9, self.current_rate()) / 2)
+                self.adaptive = True
+                self.tokens = 0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            self.throttled_responses += 1
+        log.warning(
+            "Throttled by Jira (%d), retrying in %.1f s" % (response.status_code, delay)
+        )
+        return delay
+
+
+def get_retry_after(response):
+    """Returns the delay (seconds) asked for by a Retry-After header, or None."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def should_retry(method, response, attempt, connection):
+    """Returns True if a request throttled by the server should be sent again."""
+    if response.status_code not in THROTTLE_STATUS_CODES:
+        return False
+    # 503 without Retry-After is only safe to repeat for idempotent requests, a
+    # 429 means that the request wasn't processed at all.
+    if (
+        response.status_code == 503
+        and method not in IDEMPOTENT_METHODS
+        and get_retry_after(response) is None
+    ):
+        return False
+    return attempt < connection["throttle_retries"]
+
+
+class Hedger:
+    """
+    Sends a copy of the idempotent requests that take longer than most of the
+    requests to the same endpoint did during the run (the given percentile of
+    their latencies) and returns the response that arrives first. A few
+    stragglers then don't make the whole run wait. At most ratio of the last
+    HEDGE_WINDOW requests are sent twice, and only when the rate limiter lets
+    the copy go right away.
+    """
+
+    def __init__(self, percentile, ratio, limiter):
+        self.percentile = percentile
+        self.ratio = ratio
+        self.limiter = limiter
+        # The requests are waited for in one pool and their copies sent from
+        # another, so that a copy never waits for a free worker.
+        self.executor = None
+        self.copies = None
+        self.latencies = {}
+        # Whether each of the last requests was sent twice, and the copies
+        # still waited for.
+        self.window = collections.deque(maxlen=HEDGE_WINDOW)
+        self.hedging = 0
+        self.lock = threading.Lock()
+
+    def observe(self, endpoint, latency, hedged=False):
+        """Learns the latency of a request to endpoint."""
+        with self.lock:
+            self.window.append(hedged)
+            latencies = self.latencies.get(endpoint)
+            if latencies is None:
+                latencies = collections.deque(maxlen=100)
+                self.latencies[endpoint] = latencies
+            latencies.append(latency)
+
+    def get_delay(self, endpoint):
+        """Returns how long (s) to wait for a response to a request to endpoint
+        before sending it again, None if there are too few samples yet."""
+        with self.lock:
+            latencies = self.latencies.get(endpoint)
+            if latencies is None or len(latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            return trace.percentile(sorted(latencies), self.percentile)
+
+    def may_hedge(self):
+        """Returns True, having taken a token of the rate limiter, if one more
+        request may be sent twice."""
+        with self.lock:
+            hedged = sum(self.window) + self.hedging
+            if hedged + 1 > self.ratio * (len(self.window) + 1):
+                return False
+            if not self.limiter.try_acquire():
+                return False
+            self.hedging += 1
+            return True
+
+    def send(self, send, request, delay):
+        """Returns send(request) and whether send(copy of request) was called
+        as well, which it is if there is no response after delay seconds."""
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=HEDGE_WORKERS, thread_name_prefix="jipdate-hedge"
+            )
+            self.copies = concurrent.futures.ThreadPoolExecutor(
+                max_workers=HEDGE_WORKERS, thread_name_prefix="jipdate-hedge-copy"
+            )
+        # The deadline, tracer etc. of an api.Session follow the request.
+        send = cfg.bind(send)
+        first = self.executor.submit(send, request)
+        concurrent.futures.wait([first], timeout=delay)
+        if first.done() or not self.may_hedge():
+            return first.result(), False
+
+        log.debug("Hedging %s %s after %.3f s" % (request.method, request.url, delay))
+        second = self.copies.submit(send, request.copy())
+        trace.record_hedged(request, "sent")
+        try:
+            winner = get_first_response([first, second])
+        finally:
+            with self.lock:
+                self.hedging -= 1
+        if winner is second:
+            trace.record_hedged(request, "won")
+        return winner.result(), True
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.copies.shutdown(wait=False)
+            self.executor = None
+            self.copies = None
+
+
+def get_first_response(futures):
+    """Returns the first of the futures sending a request to succeed, the
+    responses of the other ones are dropped. If they all fail, returns the
+    first one."""
+    pending = set(futures)
+    while pending:
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            if future.exception() is None:
+                for other in pending:
+                    other.add_done_callback(close_response)
+                return future
+    return futures[0]
+
+
+def close_response(future):
+    """Releases the connection of a response nobody waits for anymore."""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class JiraAdapter(HTTPAdapter):
+    """Pooled keep-alive adapter mounted on the session of the JIRA instance.
+    All requests are scheduled by the rate limiter and requests throttled by
+    the server are transparently retried. With a response cache, cached
+    responses are returned without asking the server, with an identity map
+    (httpcache.IdentityMap) the requests already sent during the run aren't
+    sent again. With "hedge" enabled, slow idempotent requests are sent twice
+    (see Hedger)."""
+
+    def __init__(self, connection, cache=None, identity=None):
+        self.connection = connection
+        self.cache = cache
+        self.identity = identity
+        self.limiter = RateLimiter(connection["rate_limit"], connection["rate_burst"])
+        limiters.append(self.limiter)
+        self.hedger = None
+        if connection["hedge"]:
+            self.hedger = Hedger(
+                connection["hedge_percentile"],
+                connection["hedge_max_ratio"],
+                self.limiter,
+            )
+        super().__init__(
+            pool_connections=connection["pool_connections"],
+            pool_maxsize=connection["pool_maxsize"],
+            max_retries=get_retry(connection),
+        )
+
+    def send(self, request, **kwargs):
+        if self.identity is not None:
+            return self.identity.send(request, self.send_cached, **kwargs)
+        return self.send_cached(request, **kwargs)
+
+    def send_cached(self, request, **kwargs):
+        if self.cache is not None:
+            response = self.cache.get(request)
+            if response is not None:
+                response.connection = self
+                return response
+        response = self.send_throttled(request, **kwargs)
+        if self.cache is not None:
+            self.cache.update(request, response, kwargs.get("stream"))
+        return response
+
+    def send_throttled(self, request, **kwargs):
+        from requests.exceptions import RequestException
+
+        timeout = kwargs.get("timeout")
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            log.debug("%s %s" % (request.method, request.url))
+            start = time.perf_counter()
+            kwargs["timeout"] = deadline.get_timeout(timeout)
+            try:
+                if cassette.player is not None:
+                    response = cassette.player.send(request)
+                else:
+                    response = self.send_hedged(request, start, **kwargs)
+            except RequestException as e:
+                if deadline.expired():
+                    raise deadline.stop("deadline") from e
+                raise
+            if cassette.recorder is not None:
+                cassette.recorder.record(request, response, start)
+            trace.record(request, response, start, kwargs.get("stream"))
+            self.limiter.update(response)
+
+            if not should_retry(request.method, response, attempt, self.connection):
+                return response
+
+            self.limiter.throttle(response, attempt)
+            response.close()
+            attempt += 1
+
+    def send_hedged(self, request, start, **kwargs):
+        """Sends a request, hedged if it is idempotent and the hedger knows
+        how long such requests take."""
+        # The traffic recorded to a cassette must be the one of a plain run.
+        if (
+            self.hedger is None
+            or request.method not in IDEMPOTENT_METHODS
+            or cassette.recorder is not None
+        ):
+            return super().send(request, **kwargs)
+
+        endpoint = trace.get_endpoint(request.url)
+        delay = self.hedger.get_delay(endpoint)
+        hedged = False
+        if delay is None:
+            response = super().send(request, **kwargs)
+        else:
+            send = functools.partial(super().send, **kwargs)
+            response, hedged = self.hedger.send(send, request, delay)
+        self.hedger.observe(endpoint, time.perf_counter() - start, hedged)
+        return response
+
+    def close(self):
+        super().close()
+        if self.limiter in limiters:
+            limiters.remove(self.limiter)
+        if self.hedger is not None:
+            self.hedger.close()
+        if self.identity is not None:
+            self.identity.close()
+            self.identity = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+
+def get_retry(connection):
+    """Returns the retry policy for the given connection config."""
+    retries = connection["retries"]
+    return JitteredRetry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        allowed_methods=IDEMPOTENT_METHODS,
+        status_forcelist=RETRY_STATUS_CODES,
+        backoff_factor=connection["backoff_factor"],
+        raise_on_status=False,
+        # Retry-After is handled by the rate limiter instead.
+        respect_retry_after_header=False,
+    )
+
+
+def get_timeout(connection):
+    """Returns the (connect, read) timeout tuple used by requests."""
+    return (connection["connect_timeout"], connection["read_timeout"])
+
+
+def get_throttling():
+    """Returns the time (s) we waited because of rate limiting and the number of
+    throttled responses."""
+    throttled_time = sum(l.throttled_time for l in limiters)
+    throttled_responses = sum(l.throttled_responses for l in limiters)
+    return throttled_time, throttled_responses
+
+
+def report_throttling():
+    """Tells the user how long we had to wait because of rate limiting."""
+    throttled_time, throttled_responses = get_throttling()
+    if throttled_responses or throttled_time >= 1:
+        print(
+            "Rate limited by Jira: waited %.1f s (%d throttled responses)"
+            % (throttled_time, throttled_responses),
+            file=sys.stderr,
+        )
+
+
+atexit.register(report_throttling)
+
+
+def mount(session, connection, cache=None, identity=None):
+    """Replaces the default adapters of a requests session with the pooled
+    jipdate adapter, and its JSON decoding with ours."""
+    adapter = JiraAdapter(connection, cache, identity)
+    jsonlib.install(session)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return adapter
@@ -0,0 +1,217 @@
+"""
+Directory of the users of a Jira server, shared by all the jip* commands.
+
+User searches (by email, name or account id), assignable user searches and the
+members of groups are kept in a file per server in the cache directory, for
+"ttl" seconds. Searches that found nobody are kept too, for "negative_ttl"
+seconds, so that a typo doesn't cost a request on every issue.
+"""
+
+import hashlib
+import logging as log
+import os
+import threading
+import time
+
+# Local files
+from jipdate import cfg
+from jipdate import jsonlib
+
+# Default settings, each of them can be overridden in the "users" section of
+# the config file.
+DEFAULT_USERS = {
+    # Seconds users and group members are kept.
+    "ttl": 7 * 86400,
+    # Seconds searches that didn't find anybody are kept.
+    "negative_ttl": 3600,
+}
+
+# Bumped when the content of the directory file changes.
+FORMAT = 1
+
+# User fields kept in the directory.
+USER_FIELDS = ["self", "key", "accountId", "name", "displayName", "emailAddress"]
+
+# The directories of the servers used during this run, by HTTP session of the
+# JIRA instance, so that the instances of an api.Session use their own.
+directories = {}
+directories_lock = threading.Lock()
+
+
+def get_users_config():
+    config = dict(DEFAULT_USERS)
+    config.update(cfg.get_option("users") or {})
+    return config
+
+
+def get_directory_file(url):
+    """Returns the file holding the user directory of the server at url."""
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return cfg.get_cache_file("users-%s.json" % digest)
+
+
+def get_user_id(user):
+    """Returns the identifier of a user (raw) in the directory, which is also
+    what JQL queries accept: the account id on Jira Cloud, the name on Jira
+    Server."""
+    return user.get("accountId") or user.get("name") or user.get("key")
+
+
+class Directory:
+    """The users of a server, looked up when first needed."""
+
+    def __init__(self, jira, filename, config):
+        self.jira = jira
+        self.filename = filename
+        self.config = config
+        self.lock = threading.Lock()
+        self.data = self.read()
+
+    def read(self):
+        data = {"format": FORMAT, "users": {}, "queries": {}, "groups": {}}
+        try:
+            with open(self.filename, "r") as f:
+                cached = jsonlib.load(f)
+        except (OSError, ValueError):
+            return data
+        if cached.get("format") != FORMAT:
+            return data
+        return cached
+
+    def write(self):
+        """Writes the directory file, the lock must be held."""
+        tmp_file = "%s.%d" % (self.filename, os.getpid())
+        try:
+            with open(tmp_file, "w") as f:
+                jsonlib.dump(self.data, f)
+            os.replace(tmp_file, self.filename)
+        except OSError as e:
+            log.debug("Could not store the user directory: %s" % e)
+
+    def is_fresh(self, entry, negative=False):
+        ttl = self.config["negative_ttl" if negative else "ttl"]
+        return entry is not None and time.time() - entry["fetched"] <= ttl
+
+    def store_user(self, raw):
+        """Adds a user (raw) to the directory, the lock must be held."""
+        user = dict((k, raw[k]) for k in USER_FIELDS if raw.get(k) is not None)
+        user["fetched"] = time.time()
+        self.data["users"][get_user_id(user)] = user
+        return user
+
+    def lookup(self, kind, query, fetch):
+        """Returns the users (raw) found by a search, from the directory if it
+        was done recently, else from fetch()."""
+        key = "%s:%s" % (kind, query.strip().lower())
+        with self.lock:
+            entry = self.data["queries"].get(key)
+            if self.is_fresh(entry, negative=not (entry or {}).get("ids")):
+                users = [self.data["users"].get(i) for i in entry["ids"]]
+                if None not in users:
+                    return users
+
+        found = fetch()
+        with self.lock:
+            users = [self.store_user(u.raw) for u in found]
+            self.data["queries"][key] = {
+                "ids": [get_user_id(u) for u in users],
+                "fetched": time.time(),
+            }
+            self.write()
+        log.debug("Users matching %s: %d" % (key, len(users)))
+        return users
+
+    def find(self, identifier):
+        """Returns the user (raw) with identifier as email, name or account id
+        if it's in the directory, else None."""
+        identifier = identifier.strip().lower()
+        with self.lock:
+            for user in self.data["users"].values():
+                if not self.is_fresh(user):
+                    continue
+                for k in ["emailAddress", "accountId", "name"]:
+                    if str(user.get(k, "")).lower() == identifier:
+                        return user
+        return None
+
+    def to_resource(self, user):
+        from jira.resources import User
+
+        raw = dict((k, v) for k, v in user.items() if k != "fetched")
+        return User(self.jira._options, self.jira._session, raw=raw)
+
+    ############################################################################
+    # Queries
+    ############################################################################
+    def search_users(self, query):
+        """Same as JIRA.search_users(query=query)."""
+        user = self.find(query)
+        if user is not None:
+            return [self.to_resource(user)]
+        users = self.lookup(
+            "search", query, lambda: self.jira.search_users(query=query)
+        )
+        return [self.to_resource(u) for u in users]
+
+    def search_assignable_users(self, query, project):
+        """Same as JIRA.search_assignable_users_for_issues(query=query,
+        project=project)."""
+        users = self.lookup(
+            "assignable:%s" % project,
+            query,
+            lambda: self.jira.search_assignable_users_for_issues(
+                query=query, project=project
+            ),
+        )
+        return [self.to_resource(u) for u in users]
+
+    def get_jql_user(self, user):
+        """Returns what stands for a user (email, name or account id) in JQL
+        queries, the user itself if nobody matches it."""
+        found = self.find(user)
+        if found is None:
+            matches = self.lookup(
+                "search", user, lambda: self.jira.search_users(query=user)
+            )
+            if len(matches) == 1:
+                found = matches[0]
+        return get_user_id(found) if found is not None else user
+
+    def members_of(self, group):
+        """Returns the identifiers (account id, name, email and display name)
+        of the members of a group."""
+        with self.lock:
+            entry = self.data["groups"].get(group.lower())
+            if self.is_fresh(entry):
+                return entry["members"]
+
+        members = []
+        for key, user in self.jira.group_members(group).items():
+            members += [key, user.get("accountId"), user.get("name")]
+            members += [user.get("email"), user.get("fullname")]
+        members = list(dict.fromkeys(m for m in members if m))
+        with self.lock:
+            self.data["groups"][group.lower()] = {
+                "members": members,
+                "fetched": time.time(),
+            }
+            self.write()
+        return members
+
+
+def get_directory(jira):
+    """Returns the user directory of the server of jira."""
+    with directories_lock:
+        directory = directories.get(jira._session)
+        if directory is None:
+            directory = Directory(
+                jira, get_directory_file(jira.server_url), get_users_config()
+            )
+            directories[jira._session] = directory
+    return directory
+
+
+def forget(jira):
+    """Drops the directory of jira, which is being closed."""
+    with directories_lock:
+        directories.pop(jira._session, None)
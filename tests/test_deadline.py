@@ -0,0 +1,65 @@
+"""
+The deadline of an api.Session also cuts off the requests sent from the threads
+of the asyncio engine and of the hedger.
+"""
+
+import time
+
+import pytest
+
+from jipdate import api
+from jipdate import cfg
+from jipdate import deadline
+from jipdate import engine
+from jipdate import fakejira
+
+# Seconds the server takes to answer once the session is set up, and the
+# deadline of the session.
+SLOW = 5
+DEADLINE = 0.5
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, "cache_path", str(tmp_path))
+    server = fakejira.start_server(fakejira.generate(initiatives=1))
+    yield server
+    server.shutdown()
+
+
+def open_session(server, **connection):
+    config = {
+        "server": {"url": server.url, "token": "token"},
+        "username": server.store.users[0]["emailAddress"],
+        "connection": dict(retries=5, **connection),
+    }
+    return api.Session(config)
+
+
+def test_engine(server):
+    with open_session(server) as session:
+        with session.using():
+            e = engine.Engine(session.jira, cfg.get_connection_config())
+        server.latency = SLOW
+        session.deadline = deadline.Deadline(DEADLINE)
+        start = time.monotonic()
+        with session.using():
+            with pytest.raises(deadline.Stopped):
+                e.run(e.request("GET", "/issue/SWG-1"))
+            # Waits for the thread that sent the request.
+            e.close()
+        assert time.monotonic() - start < SLOW / 2
+
+
+def test_hedged(server):
+    with open_session(server, hedge=True, hedge_max_ratio=1.0) as session:
+        # The hedger needs the latencies of the endpoint first.
+        for _ in range(10):
+            session.jira.issue("SWG-1")
+        server.latency = SLOW
+        session.deadline = deadline.Deadline(DEADLINE)
+        start = time.monotonic()
+        with session.using():
+            with pytest.raises(deadline.Stopped):
+                session.jira.issue("SWG-1")
+        assert time.monotonic() - start < SLOW / 2